@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""error_list_benchmark.py
+
+Replay a recorded build log through error list matching, comparing the
+old one-check-per-entry scan against mozharness.base.log.ErrorListMatcher.
+
+    python examples/error_list_benchmark.py [--error-list MakefileErrorList] log_raw.log
+"""
+
+from optparse import OptionParser
+import os
+import sys
+import time
+
+sys.path.insert(1, os.path.dirname(sys.path[0]))
+
+import mozharness.base.errors as errors
+from mozharness.base.log import get_error_list_matcher
+
+
+def linear_match(error_list, line):
+    for index, error_check in enumerate(error_list):
+        if 'substr' in error_check:
+            if error_check['substr'] in line:
+                return index
+        elif 'regex' in error_check:
+            if error_check['regex'].search(line):
+                return index
+
+
+def time_it(func, lines):
+    start = time.time()
+    results = [func(line) for line in lines]
+    return time.time() - start, results
+
+
+# __main__ {{{1
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options] LOGFILE")
+    parser.add_option("--error-list", action="append", dest="error_lists",
+                      help="Name of an error list in mozharness.base.errors; "
+                           "may be repeated (default: MakefileErrorList)")
+    parser.add_option("--repeat", type="int", dest="repeat", default=3,
+                      help="Number of timed passes over the log")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Specify a recorded log to replay.")
+    error_list = []
+    for name in options.error_lists or ['MakefileErrorList']:
+        error_list += getattr(errors, name)
+    fh = open(args[0])
+    lines = [line.decode('utf-8', 'replace').rstrip() for line in fh
+             if line and not line.isspace()]
+    fh.close()
+
+    start = time.time()
+    matcher = get_error_list_matcher(error_list)
+    print "Compiled %d error_list entries in %.4fs" % (len(error_list),
+                                                        time.time() - start)
+    linear_best = matcher_best = None
+    for _ in range(options.repeat):
+        linear_time, expected = time_it(lambda l: linear_match(error_list, l),
+                                        lines)
+        matcher_time, results = time_it(matcher.match, lines)
+        if results != expected:
+            print "ERROR: matcher results differ from the linear scan!"
+            sys.exit(1)
+        linear_best = min(linear_best or linear_time, linear_time)
+        matcher_best = min(matcher_best or matcher_time, matcher_time)
+    print "%d lines, %d matched" % (len(lines),
+                                    len([r for r in expected if r is not None]))
+    print "linear scan: %.3fs" % linear_best
+    print "matcher:     %.3fs" % matcher_best
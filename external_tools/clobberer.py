@@ -5,6 +5,7 @@ import shutil
 import urllib2
 import urllib
 import os
+import subprocess
 import traceback
 import time
 if os.name == 'nt':
@@ -104,14 +105,60 @@ def rmdirRecursive(dir):
     os.rmdir(dir)
 
 
-def do_clobber(dir, dryrun=False, skip=None):
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        rmdirRecursive(path)
+    else:
+        os.unlink(path)
+
+
+def remove_in_background(paths):
+    """Starts a detached, low priority copy of this script to remove
+    `paths`, which should already have been renamed out of the way."""
+    cmd = [sys.executable, os.path.abspath(__file__), '--remove'] + \
+        [os.path.abspath(p) for p in paths]
+    kwargs = {}
+    if os.name == 'nt':
+        # DETACHED_PROCESS | IDLE_PRIORITY_CLASS
+        kwargs['creationflags'] = 0x00000008 | 0x00000040
+    else:
+        cmd = ['nice', '-n', '19'] + cmd
+        if os.path.exists('/usr/bin/ionice'):
+            cmd = ['/usr/bin/ionice', '-c', '3'] + cmd
+        kwargs['close_fds'] = True
+        # Don't get killed along with the build step.
+        kwargs['preexec_fn'] = os.setsid
+    devnull = open(os.devnull, 'r+')
+    subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull,
+                     **kwargs)
+    devnull.close()
+
+
+def do_clobber(dir, dryrun=False, skip=None, background=False):
+    """Removes everything in the current directory except `skip`.
+
+    With background, everything is renamed to *.deleteme (which is
+    quick), and a detached process removes it all, along with anything
+    left over from earlier clobbers."""
+    tombstones = []
     try:
         for f in os.listdir(dir):
             if skip is not None and f in skip:
                 print "Skipping", f
                 continue
             clobber_path = f + clobber_suffix
-            if os.path.isfile(f):
+            if background and (os.path.isfile(f) or os.path.isdir(f)):
+                print "Removing %s in the background" % f
+                if not dryrun:
+                    if not f.endswith(clobber_suffix):
+                        n = 0
+                        while os.path.lexists(clobber_path):
+                            n += 1
+                            clobber_path = '%s.%d%s' % (f, n, clobber_suffix)
+                        os.rename(f, clobber_path)
+                        f = clobber_path
+                    tombstones.append(f)
+            elif os.path.isfile(f):
                 print "Removing", f
                 if not dryrun:
                     if os.path.exists(clobber_path):
@@ -136,6 +183,13 @@ def do_clobber(dir, dryrun=False, skip=None):
     except:
         print "Couldn't clobber properly, bailing out."
         sys.exit(1)
+    if tombstones:
+        try:
+            remove_in_background(tombstones)
+        except OSError:
+            print "Couldn't start removing in the background; removing now."
+            for f in tombstones:
+                remove_path(f)
 
 
 def getClobberDates(clobberURL, branch, buildername, builddir, slave, master):
@@ -166,7 +220,7 @@ def getClobberDates(clobberURL, branch, buildername, builddir, slave, master):
         raise
 
 if __name__ == "__main__":
-    from optparse import OptionParser
+    from optparse import OptionParser, SUPPRESS_HELP
     parser = OptionParser(
         "%prog [options] clobberURL branch buildername builddir slave master")
     parser.add_option("-n", "--dry-run", dest="dryrun", action="store_true",
@@ -179,8 +233,21 @@ if __name__ == "__main__":
                       dest='dir', default='.', type='string')
     parser.add_option('-v', '--verbose', help='be more verbose',
                       dest='verbose', action='store_true', default=False)
+    parser.add_option('--background', help='rename what we clobber out of '
+                      'the way, and remove it in a detached process',
+                      dest='background', action='store_true', default=False)
+    # Used by --background to do the removing.
+    parser.add_option('--remove', dest='remove', action='store_true',
+                      default=False, help=SUPPRESS_HELP)
 
     options, args = parser.parse_args()
+    if options.remove:
+        for path in args:
+            try:
+                remove_path(path)
+            except:
+                traceback.print_exc()
+        sys.exit(0)
     if len(args) != 6:
         parser.error("Incorrect number of arguments")
 
@@ -270,7 +337,8 @@ if __name__ == "__main__":
         if clobber:
             # Finally, perform a clobber if we're supposed to
             print "%s:Clobbering..." % builddir
-            do_clobber(builder_dir, options.dryrun, options.skip)
+            do_clobber(builder_dir, options.dryrun, options.skip,
+                       options.background)
             write_file(our_clobber_date, "last-clobber")
 
         # If this is the build dir for the current job, display the clobber type in TBPL.
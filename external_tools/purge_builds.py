@@ -20,12 +20,28 @@ example:
 """
 
 import os
-import shutil
+import subprocess
 import sys
+import time
 from fnmatch import fnmatch
+from multiprocessing.pool import ThreadPool
 import re
 
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+try:
+    # The os.scandir backport saves an lstat() per entry when sizing dirs.
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
 DEFAULT_BASE_DIRS = [".."]
+DEFAULT_JOBS = 4
+GB = 1024 * 1024 * 1024
 
 clobber_suffix = '.deleteme'
 
@@ -133,7 +149,176 @@ def str2seconds(s):
         raise ValueError("Unhandled time format '%s'" % s)
 
 
-def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
+def _walk_entries(dir):
+    "Yields (path, is_dir, lstat) for the entries of `dir`"
+    if scandir:
+        for entry in scandir(dir):
+            yield entry.path, entry.is_dir(follow_symlinks=False), \
+                entry.stat(follow_symlinks=False)
+    else:
+        for name in os.listdir(dir):
+            full_name = os.path.join(dir, name)
+            st = os.lstat(full_name)
+            yield full_name, os.path.isdir(full_name) and \
+                not os.path.islink(full_name), st
+
+
+def dir_size(dir):
+    """Returns the number of bytes of disk used under `dir`.
+
+    Hardlinked files are only counted once, and entries that vanish
+    while we look (e.g. because they're being deleted) are skipped.
+    """
+    total = 0
+    seen = set()
+    todo = [dir]
+    while todo:
+        d = todo.pop()
+        try:
+            entries = list(_walk_entries(d))
+        except OSError:
+            continue
+        for full_name, is_dir, st in entries:
+            if is_dir:
+                todo.append(full_name)
+            if getattr(st, 'st_nlink', 1) > 1 and not is_dir:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            blocks = getattr(st, 'st_blocks', None)
+            if blocks is None:
+                total += st.st_size
+            else:
+                total += blocks * 512
+    return total
+
+
+class SizeCache(object):
+    """Remembers dir_size() results between runs, keyed by path.
+
+    An entry is reused as long as the mtimes of the directory and of its
+    immediate subdirectories haven't changed.  That won't notice files
+    changing deeper down, so with --background, where sizes count as
+    freed space, it could overstate what was freed; it's only used when
+    asked for with --size-cache.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.sizes = {}
+        if path and os.path.exists(path):
+            try:
+                fh = open(path)
+                try:
+                    self.sizes = json.load(fh)
+                finally:
+                    fh.close()
+            except (IOError, ValueError):
+                print >>sys.stderr, "Ignoring unreadable size cache %s" % path
+
+    def _query_signature(self, dir):
+        signature = [os.path.getmtime(dir)]
+        for full_name, is_dir, st in sorted(_walk_entries(dir)):
+            if is_dir:
+                signature.append([os.path.basename(full_name), st.st_mtime])
+        return signature
+
+    def query_size(self, dir):
+        signature = self._query_signature(dir)
+        entry = self.sizes.get(dir)
+        if entry and entry[0] == signature:
+            return entry[1]
+        size = dir_size(dir)
+        self.sizes[dir] = [signature, size]
+        return size
+
+    def forget(self, dir):
+        self.sizes.pop(dir, None)
+
+    def save(self):
+        if not self.path:
+            return
+        for dir in self.sizes.keys():
+            if not os.path.exists(dir):
+                del self.sizes[dir]
+        tmp_path = '%s.tmp%d' % (self.path, os.getpid())
+        try:
+            fh = open(tmp_path, 'w')
+            try:
+                json.dump(self.sizes, fh)
+            finally:
+                fh.close()
+            if os.name == 'nt' and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            print >>sys.stderr, "Couldn't write size cache %s" % self.path
+
+
+def rename_for_deletion(d):
+    """Moves `d` aside to a name ending in clobber_suffix, and returns
+    that name.  This is quick, unlike the deletion itself."""
+    if d.endswith(clobber_suffix):
+        # Prevent repeated moving.
+        return d
+    clobber_path = d + clobber_suffix
+    n = 0
+    while os.path.exists(clobber_path):
+        # Left over from an earlier purge; it's a candidate of its own.
+        n += 1
+        clobber_path = '%s.%d%s' % (d, n, clobber_suffix)
+    os.rename(d, clobber_path)
+    return clobber_path
+
+
+def _remove_dir(d):
+    try:
+        rmdirRecursive(d)
+    except:
+        print >>sys.stderr, "Couldn't purge %s properly. Skipping." % d
+
+
+def remove_dirs(dirs, jobs=DEFAULT_JOBS):
+    "Deletes `dirs`, up to `jobs` at a time"
+    if not dirs:
+        return
+    if jobs > 1 and len(dirs) > 1:
+        pool = ThreadPool(min(jobs, len(dirs)))
+        try:
+            pool.map(_remove_dir, dirs, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for d in dirs:
+            _remove_dir(d)
+
+
+def remove_dirs_in_background(dirs, jobs=DEFAULT_JOBS):
+    """Starts a detached copy of this script to delete `dirs`, which
+    must already have been renamed with rename_for_deletion()."""
+    devnull = open(os.devnull, 'r+')
+    kwargs = {}
+    if os.name == 'nt':
+        # DETACHED_PROCESS
+        kwargs['creationflags'] = 0x00000008
+    else:
+        kwargs['close_fds'] = True
+        # Don't get killed along with the build step.
+        kwargs['preexec_fn'] = os.setsid
+    subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                      '--remove-renamed', '--jobs', str(jobs)] + list(dirs),
+                     stdin=devnull, stdout=devnull, stderr=devnull,
+                     **kwargs)
+    devnull.close()
+
+
+def pending_size(pending):
+    "Returns the number of bytes that renamed-but-undeleted `pending` holds"
+    return sum([size for d, size in pending or []])
+
+
+def purge(base_dirs, gigs, ignore, max_age, dry_run=False, size_cache=None,
+          jobs=DEFAULT_JOBS, pending=None):
     """Delete directories under `base_dirs` until `gigs` GB are free.
 
     Delete any directories older than max_age.
@@ -144,8 +329,17 @@ def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
       rel-*:40d
 
     Will not delete rel-* directories until they are over 40 days old.
+
+    Rather than checking the free space after each deletion, the size of
+    each candidate is worked out first (using `size_cache`), and the
+    oldest directories that add up to enough space are deleted `jobs` at
+    a time.  If `pending` is a list, the chosen directories are only
+    renamed, and (path, size) tuples for them are appended to it for the
+    caller to delete later; the space they hold counts as free.
     """
-    gigs *= 1024 * 1024 * 1024
+    gigs *= GB
+    if size_cache is None:
+        size_cache = SizeCache()
 
     # convert 'ignore' to a dict resembling { directory: cutoff_time }
     # where a cutoff time of -1 means 'never expire'.
@@ -175,31 +369,48 @@ def purge(base_dirs, gigs, ignore, max_age, dry_run=False):
     dirs.sort()
 
     while dirs:
-        mtime, d = dirs.pop(0)
-
-        # If we're newer than max_age, and don't need any more free space,
-        # we're all done here
-        if (not max_age) or (mtime > max_age):
-            if freespace(base_dirs[0]) >= gigs:
-                break
-
-        print "Deleting", d
-        if not dry_run:
+        needed = gigs - freespace(base_dirs[0]) - pending_size(pending)
+        chosen = []
+        chosen_size = 0
+        while dirs:
+            mtime, d = dirs[0]
+
+            # If we're newer than max_age, and the dirs chosen so far free
+            # up enough space, we're all done here
+            if (not max_age) or (mtime > max_age):
+                if chosen_size >= needed:
+                    break
+
+            dirs.pop(0)
             try:
-                clobber_path = d + clobber_suffix
-                if os.path.exists(clobber_path):
-                    rmdirRecursive(clobber_path)
-                # Prevent repeated moving.
-                if d.endswith(clobber_suffix):
-                    rmdirRecursive(d)
-                else:
-                    shutil.move(d, clobber_path)
-                    rmdirRecursive(clobber_path)
-            except:
+                size = size_cache.query_size(d)
+            except OSError:
+                # Gone already.
+                continue
+            print "Deleting %s (%1.2f GB)" % (d, size / float(GB))
+            chosen.append((d, size))
+            chosen_size += size
+
+        if not chosen or dry_run:
+            break
+
+        renamed = []
+        for d, size in chosen:
+            try:
+                renamed.append((rename_for_deletion(d), size))
+            except OSError:
                 print >>sys.stderr, "Couldn't purge %s properly. Skipping." % d
+            size_cache.forget(d)
+
+        if pending is not None:
+            pending.extend(renamed)
+            break
+        remove_dirs([d for d, size in renamed], jobs)
+        # If the sizes were off, go around again with the dirs that are left.
 
 
-def purge_hg_shares(share_dir, gigs, max_age, dry_run=False):
+def purge_hg_shares(share_dir, gigs, max_age, dry_run=False, size_cache=None,
+                    jobs=DEFAULT_JOBS, pending=None):
     """Deletes old hg directories under share_dir"""
     # Find hg directories
     hg_dirs = []
@@ -212,18 +423,31 @@ def purge_hg_shares(share_dir, gigs, max_age, dry_run=False):
                 dirs.remove(d)
 
     # Now we have a list of hg directories, call purge on them
-    purge(hg_dirs, gigs, [], max_age, dry_run)
+    purge(hg_dirs, gigs, [], max_age, dry_run, size_cache, jobs, pending)
 
     # Clean up empty directories
     for d in hg_dirs:
         if not os.path.exists(os.path.join(d, '.hg')):
             print "Cleaning up", d
-            if not dry_run:
+            if dry_run:
+                continue
+            if pending is None:
                 rmdirRecursive(d)
+                continue
+            # Move the whole repo aside, taking its pending .hg with it.
+            prefix = d + os.sep
+            size = 0
+            for entry in pending[:]:
+                if entry[0].startswith(prefix):
+                    pending.remove(entry)
+                    size += entry[1]
+            try:
+                pending.append((rename_for_deletion(d), size))
+            except OSError:
+                print >>sys.stderr, "Couldn't purge %s properly. Skipping." % d
 
 if __name__ == '__main__':
-    import time
-    from optparse import OptionParser
+    from optparse import OptionParser, SUPPRESS_HELP
     from ConfigParser import ConfigParser, NoOptionError
 
     max_age = 14
@@ -236,7 +460,9 @@ if __name__ == '__main__':
 
     cwd = os.path.basename(os.getcwd())
     parser = OptionParser(usage=__doc__)
-    parser.set_defaults(size=5, share_size=1, skip=[cwd], dry_run=False, max_age=max_age)
+    parser.set_defaults(size=5, share_size=1, skip=[cwd], dry_run=False, max_age=max_age,
+                        jobs=DEFAULT_JOBS, background=False,
+                        size_cache='', remove_renamed=False)
 
     parser.add_option('-s', '--size',
                       help='free space required (in GB, default 5)', dest='size',
@@ -252,17 +478,40 @@ if __name__ == '__main__':
     parser.add_option('', '--dry-run', action='store_true',
                       dest='dry_run',
                       help='''do not delete anything, just print out what would be
-deleted.  note that since no directories are deleted, if the amount of free
-disk space in base_dir(s) is less than the required size, then ALL directories
-will be listed in the order in which they would be deleted.''')
+deleted.  directories are listed, with their sizes, in the order in which
+they would be deleted.''')
 
     parser.add_option('', '--max-age', dest='max_age', type='int',
                       help='''maximum age (in days) for directories.  If any directory
             has an mtime older than this, it will be deleted, regardless of how
             much free space is required.  Set to 0 to disable.''')
 
+    parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                      help='number of directories to delete at once (default %d)' % DEFAULT_JOBS)
+
+    parser.add_option('', '--background', action='store_true',
+                      dest='background',
+                      help='''rename the directories to delete and return right away,
+            leaving a detached process to delete them.  The space they take
+            up is counted as free.''')
+
+    parser.add_option('', '--size-cache', dest='size_cache',
+                      help='''file to remember directory sizes in between runs
+            (e.g. ~/.purge_builds_sizes.json).  A cached size is reused while
+            the mtimes of the directory and its immediate subdirectories are
+            unchanged, so it can be stale if files deeper down change.''')
+
+    # Used by --background to delete the renamed directories.
+    parser.add_option('', '--remove-renamed', action='store_true',
+                      dest='remove_renamed', help=SUPPRESS_HELP)
+
     options, base_dirs = parser.parse_args()
 
+    if options.remove_renamed:
+        remove_dirs([d for d in base_dirs if d.endswith(clobber_suffix)],
+                    options.jobs)
+        sys.exit(0)
+
     if len(base_dirs) < 1:
         for d in DEFAULT_BASE_DIRS:
             if os.path.exists(d):
@@ -277,22 +526,37 @@ will be listed in the order in which they would be deleted.''')
     else:
         cutoff_time = None
 
-    purge(base_dirs, options.size, options.skip, cutoff_time, options.dry_run)
+    size_cache = SizeCache(options.size_cache and
+                           os.path.expanduser(options.size_cache))
+    pending = None
+    if options.background:
+        pending = []
+
+    purge(base_dirs, options.size, options.skip, cutoff_time, options.dry_run,
+          size_cache, options.jobs, pending)
 
     # Try to cleanup shared hg repos. We run here even if we've freed enough
     # space so we can be sure and delete repositories older than max_age
     if 'HG_SHARE_BASE_DIR' in os.environ:
         purge_hg_shares(os.environ['HG_SHARE_BASE_DIR'],
-                        options.share_size, cutoff_time, options.dry_run)
+                        options.share_size, cutoff_time, options.dry_run,
+                        size_cache, options.jobs, pending)
 
-    after = freespace(base_dirs[0]) / (1024 * 1024 * 1024.0)
+    after = (freespace(base_dirs[0]) + pending_size(pending)) / float(GB)
 
     # Try to cleanup the current dir if we still need space and it will
     # actually help.
     if after < options.size:
         # We skip the tools dir here because we've usually just cloned it.
-        purge(['.'], options.size, ['tools'], cutoff_time, options.dry_run)
-        after = freespace(base_dirs[0]) / (1024 * 1024 * 1024.0)
+        purge(['.'], options.size, ['tools'], cutoff_time, options.dry_run,
+              size_cache, options.jobs, pending)
+        after = (freespace(base_dirs[0]) + pending_size(pending)) / float(GB)
+
+    if pending:
+        print "Deleting %d directories (%1.2f GB) in the background" % \
+            (len(pending), pending_size(pending) / float(GB))
+        remove_dirs_in_background([d for d, size in pending], options.jobs)
+    size_cache.save()
 
     if after < options.size:
         print "Error: unable to free %1.2f GB of space. " % options.size + \
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Content-addressed file caches shared between jobs on one machine.
+
+Files are stored by their sha512 under cache_dir/blobs, and handed out
+as hardlinks (or copies, across filesystems).  cache_dir/entries maps
+other keys, like a url plus its ETag, to those digests.  The cache is
+kept under a byte budget by evicting the least recently used blobs.
+"""
+
+from contextlib import contextmanager
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+from mozharness.base.log import LogMixin, DEBUG, INFO, WARNING
+
+
+def query_file_digest(file_path, algorithm='sha512', chunk_size=1024 ** 2):
+    """Return the hex digest of file_path, read in chunk_size pieces."""
+    digest = hashlib.new(algorithm)
+    fh = open(file_path, 'rb')
+    try:
+        while True:
+            block = fh.read(chunk_size)
+            if not block:
+                break
+            digest.update(block)
+    finally:
+        fh.close()
+    return digest.hexdigest()
+
+
+# ContentCache {{{1
+class ContentCache(LogMixin, object):
+    """A sha512-addressed file store with an LRU byte budget.
+
+    Several processes may use the same cache_dir at once: lock() takes an
+    exclusive lock, by name, that is shared across processes.
+    """
+    def __init__(self, cache_dir, max_size=None, log_obj=None, config=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.log_obj = log_obj
+        self.config = config or {}
+        self.blob_dir = os.path.join(self.cache_dir, 'blobs')
+        self.entry_dir = os.path.join(self.cache_dir, 'entries')
+        self.lock_dir = os.path.join(self.cache_dir, 'locks')
+        for path in (self.blob_dir, self.entry_dir, self.lock_dir):
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # Another job may have just created it.
+                    if not os.path.isdir(path):
+                        raise
+
+    @contextmanager
+    def lock(self, name='cache'):
+        """Hold an exclusive, cross-process lock called name."""
+        fh = open(os.path.join(self.lock_dir, '%s.lock' % name), 'a+')
+        try:
+            if fcntl:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            else:
+                fh.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(fh.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except IOError:
+                        # LK_LOCK gives up after 10 seconds; keep waiting.
+                        pass
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+            else:
+                fh.seek(0)
+                msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+            fh.close()
+
+    def query_blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest)
+
+    def query_blob(self, digest, verify=True):
+        """Return the path of the blob with sha512 digest, or None if it
+        isn't cached.  With verify, a blob whose contents no longer match
+        its digest is removed and None is returned.
+        """
+        path = self.query_blob_path(digest)
+        if not os.path.isfile(path):
+            return None
+        if verify and query_file_digest(path) != digest:
+            self.warning("Cached %s is corrupt; removing it." % path)
+            self._remove(path)
+            return None
+        # Mark the blob as recently used for eviction.
+        os.utime(path, None)
+        return path
+
+    def add(self, file_path, digest=None, verify=True):
+        """Move file_path into the cache, and return its sha512.
+
+        If digest is given and doesn't match file_path, file_path is left
+        alone and None is returned.  With verify=False, digest is trusted
+        without reading file_path again, for callers that hashed it as
+        they wrote it.
+        """
+        if digest is not None and not verify:
+            actual_digest = digest
+        else:
+            actual_digest = query_file_digest(file_path)
+        if digest is not None and digest != actual_digest:
+            self.warning("%s has sha512 %s, expected %s!" %
+                         (file_path, actual_digest, digest))
+            return None
+        blob_path = self.query_blob_path(actual_digest)
+        if os.path.exists(blob_path):
+            os.remove(file_path)
+            os.utime(blob_path, None)
+        else:
+            shutil.move(file_path, blob_path)
+        return actual_digest
+
+    def query_temp_path(self, suffix=''):
+        """Return a new temporary file path on the cache's filesystem,
+        for downloading into before add().
+        """
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=self.blob_dir,
+                                    prefix='.tmp-')
+        os.close(fd)
+        return path
+
+    def materialize(self, digest, dest):
+        """Hardlink the blob with sha512 digest to dest, falling back to a
+        copy if that fails (e.g. across filesystems).  Returns dest, or
+        None if the blob has gone missing.
+
+        Since dest may share its contents with the cache, modifying it in
+        place will be caught by query_blob(verify=True) on the next hit.
+        """
+        blob_path = self.query_blob_path(digest)
+        # Keep evict() from removing the blob out from under us.
+        with self.lock():
+            if not os.path.isfile(blob_path):
+                return None
+            if os.path.lexists(dest):
+                os.remove(dest)
+            try:
+                os.link(blob_path, dest)
+                self.log("Linked %s from cache" % dest, level=DEBUG)
+            except (AttributeError, OSError):
+                shutil.copyfile(blob_path, dest)
+                self.log("Copied %s from cache" % dest, level=DEBUG)
+        return dest
+
+    def _entry_path(self, key):
+        return os.path.join(self.entry_dir,
+                            hashlib.sha1(key).hexdigest() + '.json')
+
+    def query_entry(self, key):
+        """Return the dict stored for key by set_entry(), or None."""
+        path = self._entry_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            fh = open(path)
+            try:
+                return json.load(fh)
+            finally:
+                fh.close()
+        except (IOError, ValueError):
+            return None
+
+    def set_entry(self, key, value):
+        """Store the dict value for key, atomically."""
+        path = self._entry_path(key)
+        tmp_path = '%s.tmp%d' % (path, os.getpid())
+        fh = open(tmp_path, 'w')
+        try:
+            json.dump(value, fh)
+        finally:
+            fh.close()
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self, max_size=None):
+        """Remove the least recently used blobs until the cache fits in
+        max_size bytes (self.max_size by default).  Stale temp files left
+        by interrupted downloads are removed too.
+        """
+        max_size = max_size or self.max_size
+        if not max_size:
+            return
+        with self.lock():
+            blobs = []
+            total_size = 0
+            for name in os.listdir(self.blob_dir):
+                path = os.path.join(self.blob_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if name.startswith('.tmp-'):
+                    if st.st_mtime < time.time() - 24 * 60 * 60:
+                        self._remove(path)
+                    continue
+                blobs.append((st.st_mtime, st.st_size, path))
+                total_size += st.st_size
+            blobs.sort()
+            for mtime, size, path in blobs:
+                if total_size <= max_size:
+                    break
+                self.log("Evicting %s (%d bytes) from cache" % (path, size),
+                         level=INFO)
+                self._remove(path)
+                total_size -= size
+            if total_size > max_size:
+                self.log("Cache %s is still %d bytes, over its %d byte budget" %
+                         (self.cache_dir, total_size, max_size), level=WARNING)
@@ -25,12 +25,17 @@ TODO:
 """
 
 from copy import deepcopy
+import hashlib
 from optparse import OptionParser, Option, OptionGroup
 import os
 import sys
 import urllib2
 import socket
 import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 try:
     import simplejson as json
 except ImportError:
@@ -64,8 +69,17 @@ class ExtendOption(Option):
                 self, action, dest, opt, value, values, parser)
 
 
+def _is_frozen(item):
+    """Return True if item is immutable all the way down."""
+    return isinstance(item, LockedTuple) or \
+        (isinstance(item, ReadOnlyDict) and item._lock)
+
+
 def make_immutable(item):
-    if isinstance(item, list) or isinstance(item, tuple):
+    if _is_frozen(item):
+        # Already immutable all the way down; share it.
+        result = item
+    elif isinstance(item, list) or isinstance(item, tuple):
         result = LockedTuple(item)
     elif isinstance(item, dict):
         result = ReadOnlyDict(item)
@@ -75,27 +89,65 @@ def make_immutable(item):
     return result
 
 
+def thaw(item):
+    """Return a mutable deep copy of a frozen item; anything else is
+    returned as is.
+
+    LockedTuples become lists, and locked ReadOnlyDicts become unlocked
+    ReadOnlyDicts.
+    """
+    if isinstance(item, LockedTuple):
+        return [thaw(x) for x in item]
+    if isinstance(item, ReadOnlyDict) and item._lock:
+        result = item.__class__.__new__(item.__class__)
+        result.__dict__.update(item.__dict__)
+        result._lock = False
+        for k, v in dict.items(item):
+            dict.__setitem__(result, k, thaw(v))
+        return result
+    return item
+
+
 class LockedTuple(tuple):
     def __new__(cls, items):
         return tuple.__new__(cls, (make_immutable(x) for x in items))
+
+    def __copy__(self):
+        return self
+
     def __deepcopy__(self, memo):
-        return [deepcopy(elem, memo) for elem in self]
+        result = thaw(self)
+        memo[id(self)] = result
+        return result
 
 
 # ReadOnlyDict {{{1
 class ReadOnlyDict(dict):
     def __init__(self, dictionary):
         self._lock = False
-        self.update(dictionary.copy())
+        self.update(dictionary)
 
     def _check_lock(self):
         assert not self._lock, "ReadOnlyDict is locked!"
 
     def lock(self):
-        for (k, v) in self.items():
-            self[k] = make_immutable(v)
+        for (k, v) in dict.items(self):
+            if not _is_frozen(v):
+                dict.__setitem__(self, k, make_immutable(v))
         self._lock = True
 
+    def override(self, *args, **kwargs):
+        """Return a locked ReadOnlyDict of our items, overlaid with
+        dict(*args, **kwargs).  Frozen values are shared, not copied.
+        """
+        result = self.__class__.__new__(self.__class__)
+        result.__dict__.update(self.__dict__)
+        result._lock = False
+        dict.update(result, self)
+        dict.update(result, dict(*args, **kwargs))
+        result.lock()
+        return result
+
     def __setitem__(self, *args):
         self._check_lock()
         return dict.__setitem__(self, *args)
@@ -124,17 +176,69 @@ class ReadOnlyDict(dict):
         self._check_lock()
         dict.update(self, *args)
 
+    def __copy__(self):
+        if self._lock:
+            # Nothing can change it, so it's its own copy.
+            return self
+        result = self.__class__.__new__(self.__class__)
+        result.__dict__.update(self.__dict__)
+        dict.update(result, self)
+        return result
+
     def __deepcopy__(self, memo):
+        if self._lock:
+            result = thaw(self)
+            memo[id(self)] = result
+            return result
         cls = self.__class__
         result = cls.__new__(cls)
         memo[id(self)] = result
         for k, v in self.__dict__.items():
             setattr(result, k, deepcopy(v, memo))
-        result._lock = False
-        for k, v in self.items():
-            result[k] = deepcopy(v, memo)
+        # Frozen values are thawed by their own __deepcopy__.
+        for k, v in dict.items(self):
+            dict.__setitem__(result, k, deepcopy(v, memo))
         return result
 
+
+# Config resolution cache {{{1
+# Bump when the cache entry format changes.
+CONFIG_CACHE_VERSION = 1
+
+# While BaseConfig resolves config files for its cache, this is a list of
+# every input read: ('file', path, sha1 or None if missing) and
+# ('url', url, file_name).
+_config_inputs = None
+
+
+def _track_config_input(*config_input):
+    if _config_inputs is not None:
+        _config_inputs.append(config_input)
+
+
+def _config_key_default(item):
+    # Compiled regexes' reprs include their address.
+    if hasattr(item, 'pattern') and hasattr(item, 'flags'):
+        return [item.pattern, item.flags]
+    return repr(item)
+
+
+def _query_sha1(contents):
+    return hashlib.sha1(contents).hexdigest()
+
+
+def _query_file_sha1(path):
+    """Return the sha1 of path's contents, or None if it doesn't exist."""
+    try:
+        fh = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        return _query_sha1(fh.read())
+    finally:
+        fh.close()
+
+
 # parse_config_file {{{1
 def parse_config_file(file_name, quiet=False, search_path=None,
                       config_dict_name="config"):
@@ -144,6 +248,8 @@ def parse_config_file(file_name, quiet=False, search_path=None,
     if os.path.exists(file_name):
         file_path = file_name
     else:
+        # If it turns up later, it'll take precedence.
+        _track_config_input('file', os.path.abspath(file_name), None)
         if not search_path:
             search_path = ['.', os.path.join(sys.path[0], '..', 'configs'),
                            os.path.join(sys.path[0], '..', '..', 'configs')]
@@ -151,26 +257,61 @@ def parse_config_file(file_name, quiet=False, search_path=None,
             if os.path.exists(os.path.join(path, file_name)):
                 file_path = os.path.join(path, file_name)
                 break
+            _track_config_input('file', os.path.abspath(os.path.join(path, file_name)),
+                                None)
         else:
             raise IOError("Can't find %s in %s!" % (file_name, search_path))
+    if not file_name.endswith('.py') and not file_name.endswith('.json'):
+        raise RuntimeError("Unknown config file type %s!" % file_name)
+    fh = open(file_path, 'rb')
+    try:
+        contents = fh.read()
+    finally:
+        fh.close()
+    _track_config_input('file', os.path.abspath(file_path), _query_sha1(contents))
     if file_name.endswith('.py'):
         global_dict = {}
         local_dict = {}
-        execfile(file_path, global_dict, local_dict)
+        exec compile(contents, file_path, 'exec') in global_dict, local_dict
         config = local_dict[config_dict_name]
-    elif file_name.endswith('.json'):
-        fh = open(file_path)
-        config = {}
-        json_config = json.load(fh)
-        config = dict(json_config)
-        fh.close()
     else:
-        raise RuntimeError("Unknown config file type %s!" % file_name)
+        json_config = json.loads(contents)
+        config = dict(json_config)
     # TODO return file_path
     return config
 
 
-def download_config_file(url, file_name):
+def download_config_file(url, file_name, cache_dir=None):
+    """Download url to file_name, retrying with backoff.
+
+    With cache_dir, the last copy of url is kept there, and revalidated
+    with If-None-Match/If-Modified-Since instead of downloaded again.
+    """
+    _track_config_input('url', url, os.path.abspath(file_name))
+    cached_path = cached_contents = None
+    cached_headers = {}
+    request = urllib2.Request(url)
+    if cache_dir:
+        cached_path = os.path.join(cache_dir, 'url-%s' % _query_sha1(url))
+        try:
+            fh = open(cached_path + '.json')
+            try:
+                cached_headers = json.load(fh)
+            finally:
+                fh.close()
+            fh = open(cached_path, 'rb')
+            try:
+                cached_contents = fh.read()
+            finally:
+                fh.close()
+        except (IOError, ValueError):
+            cached_headers = {}
+        else:
+            if cached_headers.get('etag'):
+                request.add_header('If-None-Match', cached_headers['etag'])
+            if cached_headers.get('last_modified'):
+                request.add_header('If-Modified-Since',
+                                   cached_headers['last_modified'])
     n = 0
     attempts = 5
     sleeptime = 60
@@ -180,8 +321,16 @@ def download_config_file(url, file_name):
             print "Failed to download from url %s after %d attempts, quiting..." % (url, attempts)
             raise SystemError(-1)
         try:
-            contents = urllib2.urlopen(url, timeout=30).read()
+            response = urllib2.urlopen(request, timeout=30)
+            contents = response.read()
+            if cached_path:
+                _write_cached_url(cached_path, contents, response.info())
             break
+        except urllib2.HTTPError, e:
+            if e.code == 304 and cached_contents is not None:
+                contents = cached_contents
+                break
+            print "Error downloading from url %s: %s" % (url, str(e))
         except urllib2.URLError, e:
             print "Error downloading from url %s: %s" % (url, str(e))
         except socket.timeout, e:
@@ -204,6 +353,26 @@ def download_config_file(url, file_name):
         raise SystemError(-1)
 
 
+def _write_cached_url(cached_path, contents, headers):
+    try:
+        for path, data in ((cached_path, contents),
+                           (cached_path + '.json', json.dumps({
+                               'etag': headers.get('ETag'),
+                               'last_modified': headers.get('Last-Modified'),
+                           }))):
+            tmp_path = '%s.tmp%d' % (path, os.getpid())
+            fh = open(tmp_path, 'wb')
+            try:
+                fh.write(data)
+            finally:
+                fh.close()
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+    except (IOError, OSError), e:
+        print "WARNING: Can't cache %s: %s" % (cached_path, str(e))
+
+
 # BaseConfig {{{1
 class BaseConfig(object):
     """Basic config setting/getting.
@@ -273,6 +442,12 @@ class BaseConfig(object):
             dest="opt_config_files", type="string", default=[],
             help="Specify the optional config files"
         )
+        self.config_parser.add_option(
+            "--config-cache-dir", action="store", dest="config_cache_dir",
+            type="string", default=os.environ.get('MOZHARNESS_CONFIG_CACHE_DIR'),
+            help="Cache the config files read, and the config they make up, "
+                 "in this directory (default $MOZHARNESS_CONFIG_CACHE_DIR)"
+        )
         self.config_parser.add_option(
             "--dump-config", action="store_true",
             dest="dump_config",
@@ -335,6 +510,11 @@ class BaseConfig(object):
             dest="no_actions", metavar="ACTIONS",
             help="Don't perform action"
         )
+        action_option_group.add_option(
+            "--parallel-actions", action="store", type="int",
+            dest="max_parallel_actions", metavar="N",
+            help="Run up to N actions at once, as their dependencies allow"
+        )
         for action in self.all_actions:
             action_option_group.add_option(
                 "--%s" % action, action="append_const",
@@ -417,7 +597,8 @@ class BaseConfig(object):
                 if '://' in cf:  # config file is an url
                     file_name = os.path.basename(cf)
                     file_path = os.path.join(os.getcwd(), file_name)
-                    download_config_file(cf, file_path)
+                    download_config_file(cf, file_path,
+                                         cache_dir=getattr(parser, 'config_cache_dir', None))
                     all_cfg_files_and_dicts.append(
                         (file_path, parse_config_file(file_path))
                     )
@@ -432,6 +613,93 @@ class BaseConfig(object):
                     raise
         return all_cfg_files_and_dicts
 
+    def _query_config_cache_key(self, args):
+        """ Everything besides the config files themselves that can change
+            what get_cfgs_from_files() returns.  Configs that look at
+            anything else, e.g. os.environ, shouldn't be used with the cache.
+            """
+        key = json.dumps([
+            CONFIG_CACHE_VERSION, self.__class__.__module__,
+            self.__class__.__name__, args, sys.argv[0], sys.path[0],
+            os.getcwd(), socket.gethostname(), sys.version,
+            json.dumps(self._config, sort_keys=True, default=_config_key_default),
+        ])
+        return _query_sha1(key)
+
+    def _query_cached_cfgs(self, entry_path, cache_dir):
+        """ Return the (file, dict) list cached in entry_path, if all of
+            the inputs it was made from are unchanged; otherwise None.
+            Config urls are revalidated (and downloaded again) as we go.
+            """
+        try:
+            fh = open(entry_path, 'rb')
+            try:
+                entry = pickle.load(fh)
+            finally:
+                fh.close()
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        for config_input in entry['inputs']:
+            if config_input[0] == 'url':
+                download_config_file(config_input[1], config_input[2],
+                                     cache_dir=cache_dir)
+            elif _query_file_sha1(config_input[1]) != config_input[2]:
+                return None
+        return entry['cfgs']
+
+    def _cache_cfgs(self, entry_path, inputs, cfgs):
+        tmp_path = '%s.tmp%d' % (entry_path, os.getpid())
+        try:
+            fh = open(tmp_path, 'wb')
+            try:
+                pickle.dump({'inputs': inputs, 'cfgs': cfgs}, fh,
+                            pickle.HIGHEST_PROTOCOL)
+            finally:
+                fh.close()
+            if os.name == 'nt' and os.path.exists(entry_path):
+                os.remove(entry_path)
+            os.rename(tmp_path, entry_path)
+        except (IOError, OSError, TypeError, pickle.PicklingError), e:
+            # e.g. a config with a function in it.
+            print "WARNING: Can't cache config in %s: %s" % (entry_path, str(e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def query_cfgs_from_files(self, all_config_files, parser, args):
+        """ get_cfgs_from_files(), through the cache in
+            parser.config_cache_dir if there is one.
+
+            A cache entry is keyed on the command line and the config
+            before the config files are read, and records every file
+            (found or not) and url read while resolving them.  It's used
+            as long as all of those files are unchanged; urls are
+            revalidated with conditional requests.
+            """
+        global _config_inputs
+        cache_dir = getattr(parser, 'config_cache_dir', None)
+        if not cache_dir:
+            return self.get_cfgs_from_files(all_config_files, parser=parser)
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Another job may have just created it.
+                if not os.path.isdir(cache_dir):
+                    raise
+        entry_path = os.path.join(cache_dir, '%s.pickle' %
+                                  self._query_config_cache_key(args))
+        cfgs = self._query_cached_cfgs(entry_path, cache_dir)
+        if cfgs is not None:
+            return cfgs
+        _config_inputs = []
+        try:
+            cfgs = self.get_cfgs_from_files(all_config_files, parser=parser)
+            inputs = _config_inputs
+        finally:
+            _config_inputs = None
+        self._cache_cfgs(entry_path, inputs, cfgs)
+        return cfgs
+
     def parse_args(self, args=None):
         """Parse command line arguments in a generic way.
         Return the parser object after adding the basic options, so
@@ -440,6 +708,7 @@ class BaseConfig(object):
         self.command_line = ' '.join(sys.argv)
         if not args:
             args = sys.argv[1:]
+        command_line_args = list(args)
         (options, args) = self.config_parser.parse_args(args)
 
         defaults = self.config_parser.defaults.copy()
@@ -455,9 +724,10 @@ class BaseConfig(object):
             # config file name and its assoctiated dict
             # eg ('builds/branch_specifics.py', {'foo': 'bar'})
             # let's store this to self for things like --interpret-config-files
-            self.all_cfg_files_and_dicts.extend(self.get_cfgs_from_files(
+            self.all_cfg_files_and_dicts.extend(self.query_cfgs_from_files(
                 # append opt_config to allow them to overwrite previous configs
-                options.config_files + options.opt_config_files, parser=options
+                options.config_files + options.opt_config_files, parser=options,
+                args=command_line_args
             ))
             config = {}
             for i, (c_file, c_dict) in enumerate(self.all_cfg_files_and_dicts):
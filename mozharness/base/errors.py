@@ -11,8 +11,8 @@ Error lists are used to parse output in mozharness.base.log.OutputParser.
 Each line of output is matched against each substring or regular expression
 in the error list.  On a match, we determine the 'level' of that line,
 whether IGNORE, DEBUG, INFO, WARNING, ERROR, CRITICAL, or FATAL.
-
-TODO: Context lines (requires work on the OutputParser side)
+An entry may also set 'context_lines' to 'PRE:POST' to log the
+surrounding lines of output at that level.
 
 TODO: We could also create classes that generate these, but with the
 appropriate level (please don't die on any errors; please die on any
@@ -11,9 +11,11 @@ TODO:
 - log rotation config
 """
 
+from collections import deque
 from datetime import datetime
 import logging
 import os
+import re
 import sys
 import traceback
 
@@ -120,25 +122,154 @@ class LogMixin(object):
         pass
 
 
+# ErrorListMatcher {{{1
+# Regexes that can't safely be OR'ed into a combined pattern: inline
+# flags apply to the whole pattern, and backreferences or named groups
+# would be renumbered or collide.  Compiled-in flags are checked separately.
+_UNCOMBINABLE_REGEX = re.compile(r'''\(\?[aiLmsux]|\(\?P[<=]|\\[1-9]''')
+# error_list contents -> ErrorListMatcher.  Error lists are mostly
+# module-level constants, so this stays small; it's cleared if it doesn't.
+_error_list_matchers = {}
+_MAX_CACHED_MATCHERS = 256
+
+
+def _literal_trie_pattern(strings):
+    """Build a regex pattern matching any of `strings`, sharing common
+    prefixes the way an Aho-Corasick trie would.  A single pass of the
+    regex engine over a line then replaces one `in` check per string.
+    """
+    trie = {}
+    for string in strings:
+        node = trie
+        for char in string:
+            node = node.setdefault(char, {})
+        node[''] = None
+
+    def _pattern(node):
+        alternatives = [re.escape(char) + _pattern(child)
+                        for char, child in sorted(node.items()) if char]
+        if not alternatives:
+            return ''
+        if len(alternatives) == 1:
+            pattern = alternatives[0]
+        else:
+            pattern = '(?:%s)' % '|'.join(alternatives)
+        if '' in node:
+            pattern = '(?:%s)?' % pattern
+        return pattern
+    return _pattern(trie)
+
+
+class ErrorListMatcher(object):
+    """An error_list compiled for matching output lines.
+
+    All 'substr' entries are merged into one prefix-sharing regex, and all
+    plain 'regex' entries into one alternation.  Together they act as a
+    prefilter: most output lines match nothing, and those are rejected
+    with two regex searches instead of one check per entry.  Lines that
+    get past the prefilter are walked in error_list order, so the first
+    matching entry still wins.
+
+    Use get_error_list_matcher() rather than instantiating this directly,
+    so each error_list is only compiled once.
+    """
+    def __init__(self, error_list):
+        self.checks = []
+        self.invalid_checks = []
+        # (index, regex) pairs that are searched even on a prefilter miss.
+        self.uncombined = []
+        literals = set()
+        regexes = []
+        for index, error_check in enumerate(error_list):
+            if 'substr' in error_check:
+                self.checks.append((index, error_check['substr'], None))
+                literals.add(error_check['substr'])
+            elif 'regex' in error_check:
+                regex = error_check['regex']
+                self.checks.append((index, None, regex))
+                if regex.flags or \
+                        _UNCOMBINABLE_REGEX.search(regex.pattern):
+                    self.uncombined.append((index, regex))
+                else:
+                    regexes.append('(?:%s)' % regex.pattern)
+            else:
+                self.invalid_checks.append(error_check)
+        self.prefilters = []
+        if literals:
+            self.prefilters.append(re.compile(_literal_trie_pattern(literals)))
+        if regexes:
+            self.prefilters.append(re.compile('|'.join(regexes)))
+
+    def match(self, line):
+        """Return the index of the first error_list entry that matches
+        line, or None.
+        """
+        for prefilter in self.prefilters:
+            if prefilter.search(line) is not None:
+                break
+        else:
+            for index, regex in self.uncombined:
+                if regex.search(line):
+                    return index
+            return None
+        for index, substr, regex in self.checks:
+            if substr is not None:
+                if substr in line:
+                    return index
+            elif regex.search(line):
+                return index
+
+
+def _error_list_key(error_list):
+    key = []
+    for error_check in error_list:
+        if 'substr' in error_check:
+            key.append(('substr', error_check['substr']))
+        elif 'regex' in error_check:
+            regex = error_check['regex']
+            key.append(('regex', regex.pattern, regex.flags))
+        else:
+            key.append(None)
+    return tuple(key)
+
+
+def get_error_list_matcher(error_list):
+    """Return a cached ErrorListMatcher for error_list.
+
+    The cache is keyed on the substrings and regexes in error_list rather
+    than on the list object, so copied or concatenated lists share a
+    matcher.  Levels and explanations aren't part of the key; the matcher
+    only returns indexes into whichever error_list is being parsed.
+    """
+    key = _error_list_key(error_list)
+    matcher = _error_list_matchers.get(key)
+    if matcher is None:
+        if len(_error_list_matchers) >= _MAX_CACHED_MATCHERS:
+            _error_list_matchers.clear()
+        matcher = ErrorListMatcher(error_list)
+        _error_list_matchers[key] = matcher
+    return matcher
+
+
 # OutputParser {{{1
 class OutputParser(LogMixin):
     """ Helper object to parse command output.
 
-This will buffer output if needed, so we can go back and mark
-[(linenum - 10):linenum+10] as errors if need be, without having to
-get all the output first.
-
-linenum+10 will be easy; we can set self.num_post_context_lines to 10,
-and self.num_post_context_lines-- as we mark each line to at least error
-level X.
-
-linenum-10 will be trickier. We'll not only need to save the line
-itself, but also the level that we've set for that line previously,
-whether by matching on that line, or by a previous line's context.
-We should only log that line if all output has ended (self.finish() ?);
-otherwise store a list of dictionaries in self.context_buffer that is
-buffered up to self.num_pre_context_lines (set to the largest
-pre-context-line setting in error_list.)
+Any error_list entry may set 'context_lines' to 'PRE:POST' (e.g. '5:5',
+'20:' or ':3') to also log the PRE lines before and POST lines after
+each matching line at that entry's level.  Lines that didn't match an
+entry themselves are promoted; lines that did keep their own level.
+
+For post-context we set self.num_post_context_lines to POST on a match,
+and self.num_post_context_lines-- as we mark each following line to at
+least that match's level.
+
+For pre-context, every line is held back in self.context_buffer, a
+deque of up to self.num_pre_context_lines entries (the largest
+pre-context setting in error_list), along with the level set for it so
+far; a line is only logged once it falls out of the buffer or when
+finish() is called after the output ends.  Without any pre-context
+settings, lines are logged as they arrive.
 """
     def __init__(self, config=None, log_obj=None, error_list=None, log_output=True):
         self.config = config
@@ -147,46 +278,85 @@ pre-context-line setting in error_list.)
         self.log_output = log_output
         self.num_errors = 0
         self.num_warnings = 0
-        # TODO context_lines.
-        # Not in use yet, but will be based off error_list.
-        self.context_buffer = []
-        self.num_pre_context_lines = 0
-        self.num_post_context_lines = 0
         self.worst_log_level = INFO
+        self.error_matcher = get_error_list_matcher(self.error_list)
+        for error_check in self.error_matcher.invalid_checks:
+            self.warning("error_list: 'substr' and 'regex' not in %s" %
+                         error_check)
+        self.context_lines = [self._parse_context_lines(error_check)
+                              for error_check in self.error_list]
+        self.num_pre_context_lines = max([pre for pre, post in self.context_lines] or [0])
+        self.num_post_context_lines = 0
+        self.post_context_level = INFO
+        self.context_buffer = deque(maxlen=self.num_pre_context_lines)
+
+    def _parse_context_lines(self, error_check):
+        """Return error_check's 'context_lines' as a (pre, post) tuple."""
+        context_lines = error_check.get('context_lines')
+        if not context_lines:
+            return (0, 0)
+        try:
+            pre, post = context_lines.split(':')
+            return (int(pre or 0), int(post or 0))
+        except ValueError:
+            self.warning("error_list: bad context_lines %s in %s" %
+                         (context_lines, error_check))
+            return (0, 0)
 
     def parse_single_line(self, line):
-        for error_check in self.error_list:
-            # TODO buffer for context_lines.
-            match = False
-            if 'substr' in error_check:
-                if error_check['substr'] in line:
-                    match = True
-            elif 'regex' in error_check:
-                if error_check['regex'].search(line):
-                    match = True
+        index = self.error_matcher.match(line)
+        if index is not None:
+            error_check = self.error_list[index]
+            log_level = error_check.get('level', INFO)
+            if self.log_output:
+                message = ' %s' % line
+                if error_check.get('explanation'):
+                    message += '\n %s' % error_check['explanation']
+                pre_context, post_context = self.context_lines[index]
+                self._buffer_line(message, log_level, matched=True,
+                                  summary=error_check.get('summary'),
+                                  pre_context=pre_context,
+                                  post_context=post_context)
+            if log_level in (ERROR, CRITICAL, FATAL):
+                self.num_errors += 1
+            if log_level == WARNING:
+                self.num_warnings += 1
+            self.worst_log_level = self.worst_level(log_level,
+                                                    self.worst_log_level)
+        elif self.log_output:
+            self._buffer_line(' %s' % line, INFO)
+
+    def _buffer_line(self, message, level, matched=False, summary=False,
+                     pre_context=0, post_context=0):
+        if self.num_post_context_lines:
+            self.num_post_context_lines -= 1
+            if not matched:
+                level = self.worst_level(self.post_context_level, level)
+        if post_context:
+            if self.num_post_context_lines:
+                self.post_context_level = self.worst_level(
+                    level, self.post_context_level)
             else:
-                self.warning("error_list: 'substr' and 'regex' not in %s" %
-                             error_check)
-            if match:
-                log_level = error_check.get('level', INFO)
-                if self.log_output:
-                    message = ' %s' % line
-                    if error_check.get('explanation'):
-                        message += '\n %s' % error_check['explanation']
-                    if error_check.get('summary'):
-                        self.add_summary(message, level=log_level)
-                    else:
-                        self.log(message, level=log_level)
-                if log_level in (ERROR, CRITICAL, FATAL):
-                    self.num_errors += 1
-                if log_level == WARNING:
-                    self.num_warnings += 1
-                self.worst_log_level = self.worst_level(log_level,
-                                                        self.worst_log_level)
-                break
+                self.post_context_level = level
+            self.num_post_context_lines = max(post_context,
+                                              self.num_post_context_lines)
+        if not self.num_pre_context_lines:
+            self._log_buffered_line([message, level, summary])
+            return
+        if pre_context:
+            for entry in list(self.context_buffer)[-pre_context:]:
+                if not entry[3]:
+                    entry[1] = self.worst_level(level, entry[1])
+        if len(self.context_buffer) == self.context_buffer.maxlen:
+            self._log_buffered_line(self.context_buffer.popleft())
+        self.context_buffer.append([message, level, summary, matched])
+
+    def _log_buffered_line(self, entry):
+        message, level, summary = entry[:3]
+        if summary:
+            self.add_summary(message, level=level)
         else:
-            if self.log_output:
-                self.info(' %s' % line)
+            self.log(message, level=level)
 
     def add_lines(self, output):
         if isinstance(output, basestring):
@@ -197,6 +367,15 @@ pre-context-line setting in error_list.)
             line = line.decode("utf-8", 'replace').rstrip()
             self.parse_single_line(line)
 
+    def finish(self):
+        """Log any lines still held back for pre-context.
+
+        Call this once all output has been passed to add_lines().
+        """
+        while self.context_buffer:
+            self._log_buffered_line(self.context_buffer.popleft())
+        self.num_post_context_lines = 0
+
 
 # BaseLogger {{{1
 class BaseLogger(object):
@@ -388,6 +567,28 @@ class MultiFileLogger(BaseLogger):
                                       log_level=level)
 
 
+# PrefixedLogger {{{1
+class PrefixedLogger(object):
+    """Wrap a logger so every line it logs starts with prefix.
+
+    Useful when several objects log through the same logger at once,
+    e.g. from worker threads, so their output can be told apart.
+    Everything other than log_message() is passed through to the
+    wrapped logger.
+    """
+    def __init__(self, log_obj, prefix):
+        self.log_obj = log_obj
+        self.prefix = prefix
+
+    def log_message(self, message, **kwargs):
+        message = '\n'.join(['%s%s' % (self.prefix, line)
+                              for line in message.splitlines()])
+        return self.log_obj.log_message(message, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.log_obj, name)
+
+
 # __main__ {{{1
 if __name__ == '__main__':
     pass
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Timing records for actions and commands.
+
+BaseScript keeps a MetricsRecorder in self.metrics.  run_action() adds
+an 'action' record when each action finishes, and run_command(),
+get_output_from_command() and iter_output_from_command() add a
+'command' record for each command they run, e.g.
+
+    {"type": "command", "time": 1400000000.0, "action": "build",
+     "command": "make -f client.mk build", "cwd": "/builds/slave/...",
+     "wall": 1812.4, "user": 9610.2, "sys": 702.9, "maxrss": 1843200,
+     "returncode": 0, "output_bytes": 48210113, "output_lines": 402117,
+     "errors": 0, "warnings": 12}
+
+user, sys and maxrss (KB on Linux, bytes on Mac) are the resource usage
+of the command and the children it waited for, where the platform can
+tell us.  Records are appended to path as JSON lines, and listeners
+added with add_listener() are called with each one as it's added.
+"""
+
+import threading
+import time
+
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+
+# MetricsRecorder {{{1
+class MetricsRecorder(object):
+    def __init__(self, path=None):
+        self.path = path
+        self.records = []
+        self.listeners = []
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        self._current_action = None
+
+    def _get_current_action(self):
+        # Actions run in parallel each set their own; threads an action
+        # starts itself fall back to the latest one set anywhere.
+        return getattr(self._local, 'action', self._current_action)
+
+    def _set_current_action(self, action):
+        self._local.action = action
+        self._current_action = action
+
+    current_action = property(_get_current_action, _set_current_action)
+
+    def add_listener(self, listener):
+        """Call listener(record) for every record added from now on."""
+        self.listeners.append(listener)
+
+    def add(self, record_type, **fields):
+        """Add a record of record_type with fields, and return it.
+        Records get the current time, and the current action if they
+        don't say otherwise.
+        """
+        record = {'type': record_type, 'time': time.time()}
+        if self.current_action:
+            record['action'] = self.current_action
+        record.update(fields)
+        with self.lock:
+            self.records.append(record)
+            if self.path:
+                # Reopened each time so nothing is lost if we die, and
+                # no handle is held open (which windows would mind).
+                fh = open(self.path, 'a')
+                try:
+                    fh.write(json.dumps(record, separators=(',', ':')) + '\n')
+                finally:
+                    fh.close()
+        for listener in self.listeners:
+            listener(record)
+        return record
+
+    def query_records(self, record_type=None, action=None):
+        with self.lock:
+            records = list(self.records)
+        return [r for r in records
+                if (record_type is None or r['type'] == record_type) and
+                (action is None or r.get('action') == action)]
+
+    def query_action(self, action):
+        """Return the latest 'action' record for action, or None if it
+        hasn't finished yet."""
+        records = self.query_records('action', action=action)
+        if records:
+            return records[-1]
+
+    def summarize_commands(self, action):
+        """Return a dict of the number of commands run during action
+        (commands), and their total wall, user and sys time (command_wall,
+        command_user, command_sys)."""
+        commands = self.query_records('command', action=action)
+        totals = {'commands': len(commands)}
+        for key in ('wall', 'user', 'sys'):
+            totals['command_' + key] = round(sum([c.get(key) or 0
+                                                  for c in commands]), 3)
+        return totals
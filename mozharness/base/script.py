@@ -11,21 +11,33 @@ mozharness.
 """
 
 import codecs
+from collections import deque
 from contextlib import contextmanager
+import errno
+import fnmatch
+import glob
 import gzip
+import hashlib
 import inspect
 import os
 import platform
 import pprint
 import re
+import select
 import shutil
+import signal
 import socket
+import stat
 import subprocess
 import sys
+import threading
 import time
 import traceback
 import urllib2
 import urlparse
+import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
 if os.name == 'nt':
     try:
         import win32file
@@ -41,9 +53,46 @@ except ImportError:
     import json
 
 from mozprocess import ProcessHandler
+from mozharness.base.cache import ContentCache
 from mozharness.base.config import BaseConfig
 from mozharness.base.log import SimpleFileLogger, MultiFileLogger, \
     LogMixin, OutputParser, DEBUG, INFO, ERROR, FATAL
+from mozharness.base.metrics import MetricsRecorder
+from mozharness.base.timeline import ResourceTimeline
+
+# Number of bytes of command output to read at a time.
+OUTPUT_CHUNK_SIZE = 64 * 1024
+# Number of bytes of a zip member to decompress at a time.
+UNZIP_CHUNK_SIZE = 1024 ** 2
+# rmtree(background=True) renames trees to <path>.<time>.<pid> + this,
+# the same suffix clobberer.py and purge_builds.py use.
+TOMBSTONE_SUFFIX = '.deleteme'
+# Written to the log dir by BaseScript when resource_timeline_interval is set.
+RESOURCE_TIMELINE_FILE = 'resource-timeline.jsonl'
+# Default name of BaseScript's action and command timing records, in the
+# log dir; see mozharness.base.metrics.
+METRICS_FILE = 'metrics.jsonl'
+# Run by reap_tombstones() in a detached process.
+REAP_TOMBSTONES_SCRIPT = """
+import os, shutil, stat, sys
+
+def onerror(func, path, exc_info):
+    try:
+        os.chmod(path, stat.S_IWRITE)
+        func(path)
+    except OSError:
+        pass
+
+for path in sys.argv[1:]:
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, onerror=onerror)
+    elif os.path.lexists(path):
+        onerror(os.remove, path, None)
+"""
+
+
+class RangeIgnoredError(Exception):
+    """The server sent a whole file when we asked for part of it."""
 
 
 # ScriptMixin {{{1
@@ -58,6 +107,10 @@ class ScriptMixin(object):
     """
 
     env = None
+    # query_env() caches; see _query_base_env() and _query_env_overlay().
+    _base_env = None
+    _env_overlays = None
+    _last_env_overlay = None
 
     # Simple filesystem commands {{{2
     def mkdir_p(self, path, error_level=ERROR):
@@ -76,12 +129,29 @@ class ScriptMixin(object):
             self.debug("mkdir_p: %s Already exists." % path)
 
     def rmtree(self, path, log_level=INFO, error_level=ERROR,
-               exit_code=-1):
+               exit_code=-1, background=False):
         """
         Returns None for success, not None for failure
+
+        With background, a directory is renamed out of the way and deleted
+        by a detached process (see reap_tombstones()), so the caller can
+        reuse path right away.
         """
         self.log("rmtree: %s" % path, level=log_level)
         error_message = "Unable to remove %s!" % path
+        if background and os.path.isdir(path) and not os.path.islink(path):
+            tombstone = '%s.%d.%d%s' % (path.rstrip('/\\'), int(time.time()),
+                                        os.getpid(), TOMBSTONE_SUFFIX)
+            try:
+                os.rename(path, tombstone)
+            except OSError, e:
+                self.warning("Can't move %s out of the way (%s); removing it now." %
+                             (path, str(e)))
+            else:
+                self.info("Moved %s to %s" % (path, tombstone))
+                if self.reap_tombstones([tombstone]) is None:
+                    return
+                path = tombstone
         if self._is_windows():
             # Call _rmtree_windows() directly, since even checking
             # os.path.exists(path) will hang if path is longer than MAX_PATH.
@@ -112,6 +182,68 @@ class ScriptMixin(object):
         else:
             self.debug("%s doesn't exist." % path)
 
+    def reap_tombstones(self, paths):
+        """ Delete paths in a detached process at low cpu and I/O priority,
+            which may outlive this script.
+            Returns None for success, not None for failure
+            """
+        cmd = [sys.executable, '-c', REAP_TOMBSTONES_SCRIPT] + list(paths)
+        kwargs = {}
+        if self._is_windows():
+            # DETACHED_PROCESS | IDLE_PRIORITY_CLASS; the idle class lowers
+            # the process's I/O priority as well.
+            kwargs['creationflags'] = 0x00000008 | 0x00000040
+        else:
+            cmd = ['nice', '-n', '19'] + cmd
+            ionice = self.which('ionice')
+            if ionice:
+                cmd = [ionice, '-c', '3'] + cmd
+            kwargs['close_fds'] = True
+            # Keep running if our process group is killed.
+            kwargs['preexec_fn'] = os.setsid
+        devnull = open(os.devnull, 'r+')
+        try:
+            try:
+                proc = subprocess.Popen(cmd, stdin=devnull, stdout=devnull,
+                                        stderr=devnull, **kwargs)
+            except OSError, e:
+                self.warning("Can't start a process to remove %s: %s" %
+                             (', '.join(paths), str(e)))
+                return -1
+        finally:
+            devnull.close()
+        self.info("Removing %s in the background (pid %d)." %
+                  (', '.join(paths), proc.pid))
+
+    def query_process_group_kwargs(self):
+        """Return subprocess.Popen() kwargs that start the child in a new
+        process group, so kill_process_group() can kill what it starts
+        along with it.
+        """
+        if self._is_windows():
+            # CREATE_NEW_PROCESS_GROUP
+            return {'creationflags': 0x00000200}
+        return {'preexec_fn': os.setpgrp}
+
+    def kill_process_group(self, p):
+        """Kill subprocess p and its descendants.  p must have been
+        started with query_process_group_kwargs().
+        """
+        self.info("Killing process group of %d" % p.pid)
+        if self._is_windows():
+            # /T takes the whole tree of processes p started.
+            subprocess.call(['taskkill', '/F', '/T', '/PID', str(p.pid)])
+            try:
+                p.kill()
+            except OSError:
+                pass
+            return
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
     def _is_windows(self):
         system = platform.system()
         if system in ("Windows", "Microsoft"):
@@ -172,26 +304,178 @@ class ScriptMixin(object):
         else:
             return parsed.netloc
 
-    def _download_file(self, url, file_name):
-        """ Helper script for download_file()
+    def _query_part_info(self, url, part_file):
+        """ Return the resume state for downloading url into part_file,
+            left behind by an earlier attempt, or start a new one.
             """
+        info_file = part_file + '.json'
+        info = None
+        if os.path.exists(info_file):
+            try:
+                fh = open(info_file)
+                try:
+                    info = json.load(fh)
+                finally:
+                    fh.close()
+            except (IOError, ValueError):
+                info = None
+            if info and info.get('url') == url:
+                self.info("Resuming download of %s" % url)
+                return info
+        # Nothing we can safely resume.
+        self._remove_part_files(part_file)
+        info = {'url': url}
+        num_segments = self.config.get('download_segments', 1)
+        if num_segments > 1:
+            headers = self._query_url_headers(url)
+            if headers and headers.get('accept-ranges') == 'bytes' and \
+                    headers.get('content-length'):
+                length = int(headers['content-length'])
+                validator = headers.get('etag') or headers.get('last-modified')
+                min_size = self.config.get('download_segment_min_size',
+                                           16 * 1024 ** 2)
+                if validator and length >= max(min_size, num_segments):
+                    segment_size = -(-length // num_segments)
+                    info['validator'] = validator
+                    info['segments'] = [
+                        [start, min(start + segment_size, length) - 1]
+                        for start in range(0, length, segment_size)
+                    ]
+                    self._write_part_info(part_file, info)
+                    self.info("Downloading %s in %d segments" %
+                              (url, len(info['segments'])))
+        return info
+
+    def _write_part_info(self, part_file, info):
+        fh = open(part_file + '.json', 'w')
+        try:
+            json.dump(info, fh)
+        finally:
+            fh.close()
+
+    def _remove_part_files(self, part_file):
+        paths = [part_file, part_file + '.json']
+        paths += glob.glob(part_file + '.[0-9]*')
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _download_range(self, url, file_name, info, start=0, end=None):
+        """ Download bytes start-end (inclusive; end=None for the rest of
+            the file) of url into file_name, appending to what's already
+            there.  Raises RangeIgnoredError if a range of the file was
+            asked for but the server sent all of it.
+            """
+        have = 0
+        if os.path.exists(file_name):
+            have = os.path.getsize(file_name)
+        if end is not None and start + have > end:
+            return
+        request = urllib2.Request(url)
+        if start + have or end is not None:
+            request.add_header('Range', 'bytes=%d-%s' %
+                               (start + have, '' if end is None else end))
+            if info.get('validator'):
+                request.add_header('If-Range', info['validator'])
+        try:
+            f = urllib2.urlopen(request, timeout=30)
+        except urllib2.HTTPError, e:
+            if e.code == 416:
+                # Our partial file doesn't fit what's on the server now.
+                self._remove_part_files(file_name)
+            raise
+        headers = f.info()
+        if request.has_header('Range') and f.getcode() != 206:
+            if start or end is not None:
+                raise RangeIgnoredError("%s ignored our Range request" % url)
+            self.info("%s changed or doesn't support resuming; starting over." % url)
+            have = 0
+        if not have and start == 0 and end is None:
+            # A fresh, whole-file download; remember what we're fetching.
+            validator = headers.get('etag') or headers.get('last-modified')
+            if validator:
+                info['validator'] = validator
+                self._write_part_info(file_name, info)
+            elif os.path.exists(file_name + '.json'):
+                os.remove(file_name + '.json')
+        f_length = None
+        if headers.get('content-length') is not None:
+            f_length = int(headers['content-length'])
+        got_length = 0
+        local_file = open(file_name, have and 'ab' or 'wb')
         try:
-            f_length = None
-            f = urllib2.urlopen(url, timeout=30)
-            if f.info().get('content-length') is not None:
-                f_length = int(f.info()['content-length'])
-                got_length = 0
-            local_file = open(file_name, 'wb')
             while True:
                 block = f.read(1024 ** 2)
                 if not block:
-                    if f_length is not None and got_length != f_length:
-                        raise urllib2.URLError("Download incomplete; content-length was %d, but only received %d" % (f_length, got_length))
                     break
                 local_file.write(block)
-                if f_length is not None:
-                    got_length += len(block)
+                got_length += len(block)
+        finally:
+            local_file.close()
+        if f_length is not None and got_length != f_length:
+            raise urllib2.URLError("Download incomplete; content-length was %d, but only received %d" % (f_length, got_length))
+
+    def _download_segments(self, url, part_file, info):
+        """ Download info['segments'] of url in parallel, then join them
+            into part_file.
+            """
+        segments = info['segments']
+        pool = ThreadPool(len(segments))
+        results = [
+            pool.apply_async(self._download_range,
+                             args=(url, '%s.%d' % (part_file, i), info,
+                                   start, end))
+            for i, (start, end) in enumerate(segments)
+        ]
+        pool.close()
+        try:
+            # Re-raises the first failure; the other segments still get to
+            # finish, so the next attempt resumes from where they got to.
+            for result in results:
+                result.get()
+        finally:
+            pool.join()
+        local_file = open(part_file, 'wb')
+        try:
+            for i in range(len(segments)):
+                segment_file = open('%s.%d' % (part_file, i), 'rb')
+                try:
+                    shutil.copyfileobj(segment_file, local_file, 1024 ** 2)
+                finally:
+                    segment_file.close()
+        finally:
             local_file.close()
+
+    def _download_file(self, url, file_name):
+        """ Helper script for download_file()
+
+            Downloads into file_name.part, which is kept across retries
+            (and runs) along with the url's ETag or Last-Modified, so an
+            incomplete download resumes with an HTTP Range request.  If the
+            file changed on the server, or the server ignores the Range,
+            the download starts over.
+
+            With config['download_segments'] > 1, files of at least
+            config['download_segment_min_size'] bytes from servers that
+            accept ranges are fetched over that many connections at once.
+            """
+        part_file = file_name + '.part'
+        try:
+            info = self._query_part_info(url, part_file)
+            if info.get('segments'):
+                try:
+                    self._download_segments(url, part_file, info)
+                except RangeIgnoredError, e:
+                    self.warning("%s; downloading %s in one piece." % (str(e), url))
+                    self._remove_part_files(part_file)
+                    info = {'url': url}
+                    self._download_range(url, part_file, info)
+            else:
+                self._download_range(url, part_file, info)
+            if os.name == 'nt' and os.path.exists(file_name):
+                os.remove(file_name)
+            os.rename(part_file, file_name)
+            self._remove_part_files(part_file)
             return file_name
         except urllib2.HTTPError, e:
             self.warning("Server returned status %s %s for %s" % (str(e.code), str(e), url))
@@ -216,6 +500,79 @@ class ScriptMixin(object):
             self.warning("Socket error when accessing %s: %s" % (url, str(e)))
             raise
 
+    def _retry_download_file(self, url, file_name, error_level=ERROR):
+        return self.retry(
+            self._download_file,
+            args=(url, file_name),
+            failure_status=None,
+            retry_exceptions=(urllib2.HTTPError, urllib2.URLError,
+                              socket.timeout, socket.error),
+            error_message="Can't download from %s to %s!" % (url, file_name),
+            error_level=error_level,
+        )
+
+    def _query_url_headers(self, url):
+        """Return the headers of a HEAD request for url, or None if the
+        request fails.
+        """
+        request = urllib2.Request(url)
+        request.get_method = lambda: 'HEAD'
+        try:
+            return urllib2.urlopen(request, timeout=30).info()
+        except (urllib2.URLError, socket.timeout, socket.error, ValueError), e:
+            self.info("HEAD %s failed: %s" % (url, str(e)))
+            return None
+
+    def _download_file_via_cache(self, url, file_name, error_level=ERROR):
+        """ Helper for download_file() when config['download_cache_dir'] is
+            set.
+
+            Downloads are cached by sha512, keyed on the url plus the
+            server's ETag, Last-Modified and Content-Length, and hardlinked
+            (or copied) to file_name.  Concurrent jobs fetching the same
+            url wait for each other instead of downloading it twice.
+            config['download_cache_size'] bounds the cache in bytes.
+
+            Urls without an ETag or Last-Modified aren't cached.
+            """
+        headers = self._query_url_headers(url)
+        validators = [headers and headers.get(h) or ''
+                      for h in ('etag', 'last-modified', 'content-length')]
+        if not (validators[0] or validators[1]):
+            self.info("Not caching %s: no ETag or Last-Modified." % url)
+            return self._retry_download_file(url, file_name,
+                                             error_level=error_level)
+        cache = ContentCache(self.config['download_cache_dir'],
+                             max_size=self.config.get('download_cache_size'),
+                             log_obj=self.log_obj, config=self.config)
+        key = '\n'.join([url] + validators)
+        with cache.lock(hashlib.sha1(key).hexdigest()):
+            entry = cache.query_entry(key)
+            if entry and cache.query_blob(entry['sha512']) and \
+                    cache.materialize(entry['sha512'], file_name):
+                self.info("Using cached copy of %s (sha512 %s)" %
+                          (url, entry['sha512']))
+                return file_name
+            tmp_file_name = cache.query_temp_path()
+            status = self._retry_download_file(url, tmp_file_name,
+                                               error_level=error_level)
+            if status != tmp_file_name:
+                self.rmtree(tmp_file_name, log_level=DEBUG)
+                return status
+            digest = cache.add(tmp_file_name)
+            cache.set_entry(key, {
+                'url': url,
+                'etag': validators[0],
+                'last-modified': validators[1],
+                'content-length': validators[2],
+                'sha512': digest,
+            })
+            if not cache.materialize(digest, file_name):
+                return self._retry_download_file(url, file_name,
+                                                 error_level=error_level)
+        cache.evict()
+        return file_name
+
     # http://www.techniqal.com/blog/2008/07/31/python-file-read-write-with-urllib2/
     # TODO thinking about creating a transfer object.
     def download_file(self, url, file_name=None, parent_dir=None,
@@ -235,15 +592,12 @@ class ScriptMixin(object):
             if create_parent_dir:
                 self.mkdir_p(parent_dir, error_level=error_level)
         self.info("Downloading %s to %s" % (url, file_name))
-        status = self.retry(
-            self._download_file,
-            args=(url, file_name),
-            failure_status=None,
-            retry_exceptions=(urllib2.HTTPError, urllib2.URLError,
-                              socket.timeout, socket.error),
-            error_message="Can't download from %s to %s!" % (url, file_name),
-            error_level=error_level,
-        )
+        if self.config.get('download_cache_dir'):
+            status = self._download_file_via_cache(url, file_name,
+                                                   error_level=error_level)
+        else:
+            status = self._retry_download_file(url, file_name,
+                                               error_level=error_level)
         if status == file_name:
             self.info("Downloaded %d bytes." % os.path.getsize(file_name))
         return status
@@ -519,9 +873,42 @@ class ScriptMixin(object):
                     if sleeptime > max_sleeptime:
                         sleeptime = max_sleeptime
 
+    def _query_base_env(self):
+        """Return a copy of os.environ.
+
+        os.environ.copy() goes through UserDict one item at a time, so
+        keep a plain dict copy and only refresh it when os.environ has
+        changed.
+        """
+        environ = getattr(os.environ, 'data', os.environ)
+        if self._base_env is None or self._base_env != environ:
+            self._base_env = dict(environ)
+        return self._base_env.copy()
+
+    def _query_env_overlay(self, partial_env, replace_dict):
+        """Return a dict of partial_env's values %-formatted with
+        replace_dict, memoized on the two of them."""
+        if self._env_overlays is None:
+            self._env_overlays = {}
+        try:
+            key = (tuple(sorted(partial_env.items())),
+                   tuple(sorted(replace_dict.items())))
+            overlay = self._env_overlays.get(key)
+        except TypeError:
+            # Unhashable values; nothing to memoize on.
+            key = overlay = None
+        if overlay is None:
+            overlay = {}
+            for env_key in partial_env.keys():
+                overlay[env_key] = partial_env[env_key] % replace_dict
+            if key is not None:
+                self._env_overlays[key] = overlay
+        return overlay
+
     def query_env(self, partial_env=None, replace_dict=None,
                   purge_env=(),
-                  set_self_env=None, log_level=DEBUG):
+                  set_self_env=None, log_level=DEBUG,
+                  log_changes_only=None):
         """Environment query/generation method.
 
         The default, self.query_env(), will look for self.config['env']
@@ -530,7 +917,12 @@ class ScriptMixin(object):
 
         If you specify partial_env, partial_env will be used instead of
         self.config['env'], and we don't save self.env as it's a one-off.
+        The formatted partial_env is memoized, so building the same
+        environment over and over (per suite, per locale) is cheap.
 
+        If log_changes_only (default: self.config['log_env_changes_only'])
+        is set, only the variables that differ from the previous
+        query_env() call are logged.
         """
         if partial_env is None:
             if self.env is not None:
@@ -540,18 +932,30 @@ class ScriptMixin(object):
                 partial_env = {}
             if set_self_env is None:
                 set_self_env = True
-        env = os.environ.copy()
-        default_replace_dict = self.query_abs_dirs()
-        default_replace_dict['PATH'] = os.environ['PATH']
+        if log_changes_only is None:
+            log_changes_only = self.config.get('log_env_changes_only', False)
+        env = self._query_base_env()
+        default_replace_dict = dict(self.query_abs_dirs())
+        default_replace_dict['PATH'] = env['PATH']
         if not replace_dict:
             replace_dict = default_replace_dict
         else:
             for key in default_replace_dict:
                 if key not in replace_dict:
                     replace_dict[key] = default_replace_dict[key]
+        overlay = self._query_env_overlay(partial_env, replace_dict)
+        last_overlay = self._last_env_overlay or {}
+        unchanged = 0
         for key in partial_env.keys():
-            env[key] = partial_env[key] % replace_dict
-            self.log("ENV: %s is now %s" % (key, env[key]), level=log_level)
+            if log_changes_only and last_overlay.get(key) == overlay[key]:
+                unchanged += 1
+                continue
+            self.log("ENV: %s is now %s" % (key, overlay[key]), level=log_level)
+        if unchanged:
+            self.log("ENV: %d other variables are unchanged" % unchanged,
+                     level=log_level)
+        self._last_env_overlay = overlay
+        env.update(overlay)
         for k in purge_env:
             if k in env:
                 del env[k]
@@ -602,14 +1006,15 @@ class ScriptMixin(object):
                     halt_on_failure=False, success_codes=None,
                     env=None, partial_env=None, return_type='status',
                     throw_exception=False, output_parser=None,
-                    output_timeout=None, fatal_exit_code=2, **kwargs):
+                    output_timeout=None, timeout=None, fatal_exit_code=2,
+                    **kwargs):
         """Run a command, with logging and error parsing.
 
         output_timeout is the number of seconds without output before the process
-        is killed; it requires that mozprocess is installed in the script's
+        is killed; timeout is the number of seconds the process may run in total.
+        On Windows these require that mozprocess is installed in the script's
         virtualenv.
 
-        TODO: context_lines
         TODO: error_level_override?
 
         output_parser lets you provide an instance of your own OutputParser
@@ -617,10 +1022,9 @@ class ScriptMixin(object):
 
         error_list example:
         [{'regex': re.compile('^Error: LOL J/K'), level=IGNORE},
-         {'regex': re.compile('^Error:'), level=ERROR, contextLines='5:5'},
-         {'substr': 'THE WORLD IS ENDING', level=FATAL, contextLines='20:'}
+         {'regex': re.compile('^Error:'), level=ERROR, context_lines='5:5'},
+         {'substr': 'THE WORLD IS ENDING', level=FATAL, context_lines='20:'}
         ]
-        (context_lines isn't written yet)
         """
         if success_codes is None:
             success_codes = [0]
@@ -653,13 +1057,19 @@ class ScriptMixin(object):
         else:
             parser = output_parser
 
+        start_time = time.time()
+        stats = {'output_bytes': 0, 'output_lines': 0}
         try:
-            if output_timeout:
+            if self._is_windows() and (output_timeout or timeout):
+                # select() only works on sockets on Windows, so fall back
+                # to mozprocess' reader threads for timeouts there.
                 def processOutput(line):
+                    stats['output_bytes'] += len(line)
+                    stats['output_lines'] += 1
                     parser.add_lines(line)
 
                 def onTimeout():
-                    self.info("Automation Error: mozprocess timed out after %s seconds running %s" % (str(output_timeout), str(command)))
+                    self.info("Automation Error: mozprocess timed out after %s seconds running %s" % (str(output_timeout or timeout), str(command)))
 
                 p = ProcessHandler(command,
                                    env=env,
@@ -667,27 +1077,29 @@ class ScriptMixin(object):
                                    storeOutput=False,
                                    onTimeout=(onTimeout,),
                                    processOutputLine=[processOutput])
-                self.info("Calling %s with output_timeout %d" % (command, output_timeout))
-                p.run(outputTimeout=output_timeout)
+                self.info("Calling %s with output_timeout %s and timeout %s" % (command, output_timeout, timeout))
+                p.run(outputTimeout=output_timeout, timeout=timeout)
                 p.wait()
+                parser.finish()
                 if p.timedOut:
-                    self.error('timed out after %s seconds of no output' % output_timeout)
+                    self.error('timed out after %s seconds' % (output_timeout or timeout))
                 returncode = int(p.proc.returncode)
             else:
+                popen_kwargs = {}
+                if output_timeout or timeout:
+                    # So a timeout kills whatever the command started too.
+                    popen_kwargs = self.query_process_group_kwargs()
                 p = subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE,
-                                     cwd=cwd, stderr=subprocess.STDOUT, env=env)
-                loop = True
-                while loop:
-                    if p.poll() is not None:
-                        """Avoid losing the final lines of the log?"""
-                        loop = False
-                    while True:
-                        line = p.stdout.readline()
-                        if not line:
-                            break
-                        parser.add_lines(line)
+                                     cwd=cwd, stderr=subprocess.STDOUT, env=env,
+                                     **popen_kwargs)
+                if output_timeout:
+                    self.info("Calling %s with output_timeout %d" % (command, output_timeout))
+                self._pump_output(p, parser, output_timeout=output_timeout,
+                                  timeout=timeout, stats=stats)
+                parser.finish()
                 returncode = p.returncode
         except OSError, e:
+            self._record_command_metrics(command, cwd, start_time, -1, stats)
             level = ERROR
             if halt_on_failure:
                 level = FATAL
@@ -695,6 +1107,10 @@ class ScriptMixin(object):
                      e.strerror, command), level=level)
             return -1
 
+        stats['errors'] = parser.num_errors
+        stats['warnings'] = parser.num_warnings
+        self._record_command_metrics(command, cwd, start_time, returncode,
+                                     stats)
         return_level = INFO
         if returncode not in success_codes:
             return_level = ERROR
@@ -719,24 +1135,168 @@ class ScriptMixin(object):
             return parser.num_errors
         return returncode
 
-    def get_output_from_command(self, command, cwd=None,
-                                halt_on_failure=False, env=None,
-                                silent=False, log_level=INFO,
-                                tmpfile_base_path='tmpfile',
-                                return_type='output', save_tmpfiles=False,
-                                throw_exception=False, fatal_exit_code=2):
-        """Similar to run_command, but where run_command is an
-        os.system(command) analog, get_output_from_command is a `command`
-        analog.
+    def _pump_output(self, p, parser, output_timeout=None, timeout=None,
+                     stats=None):
+        """Feed p's stdout to parser until EOF, then wait for p.
 
-        Less error checking by design, though if we figure out how to
-        do it without borking the output, great.
+        Output is read in large chunks as soon as select() reports it, and
+        split into lines here, so the loop sleeps while the process is quiet.
+        If output_timeout seconds pass without output, or timeout seconds
+        pass in total, p's process group is killed, so p must have been
+        started with query_process_group_kwargs() to use them.
 
-        TODO: binary mode? silent is kinda like that.
-        TODO: since p.wait() can take a long time, optionally log something
-        every N seconds?
-        TODO: optionally only keep the first or last (N) line(s) of output?
-        TODO: optionally only return the tmp_stdout_filename?
+        If stats is given, its output_bytes and output_lines are added to,
+        and p's resource usage is put in stats['rusage'] where available.
+
+        Returns True if p was killed for timing out.
+        """
+        if stats is None:
+            stats = {'output_bytes': 0, 'output_lines': 0}
+        if self._is_windows():
+            # select() only works on sockets on Windows.
+            for line in iter(p.stdout.readline, ''):
+                stats['output_bytes'] += len(line)
+                stats['output_lines'] += 1
+                parser.add_lines(line)
+            self._wait_for_process(p, stats)
+            return False
+        fd = p.stdout.fileno()
+        start_time = last_output_time = time.time()
+        partial_line = ''
+        timed_out = False
+        while True:
+            deadlines = []
+            if output_timeout:
+                deadlines.append(last_output_time + output_timeout)
+            if timeout:
+                deadlines.append(start_time + timeout)
+            wait = None
+            if deadlines:
+                wait = min(deadlines) - time.time()
+                if wait <= 0:
+                    if output_timeout and time.time() - last_output_time >= output_timeout:
+                        self.error('timed out after %s seconds of no output' % output_timeout)
+                    else:
+                        self.error('timed out after %s seconds' % timeout)
+                    self.info("Automation Error: killing %s after timeout" % str(p.pid))
+                    self.kill_process_group(p)
+                    timed_out = True
+                    break
+            try:
+                readable = select.select([fd], [], [], wait)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                continue
+            chunk = os.read(fd, OUTPUT_CHUNK_SIZE)
+            if not chunk:
+                break
+            last_output_time = time.time()
+            stats['output_bytes'] += len(chunk)
+            lines = (partial_line + chunk).split('\n')
+            partial_line = lines.pop()
+            stats['output_lines'] += len(lines)
+            parser.add_lines(lines)
+        if partial_line:
+            stats['output_lines'] += 1
+            parser.add_lines(partial_line)
+        p.stdout.close()
+        self._wait_for_process(p, stats)
+        return timed_out
+
+    def _wait_for_process(self, p, stats=None):
+        """Wait for p to exit.  Where os.wait4() is available, also put
+        the resource usage of p and the children it waited for in
+        stats['rusage'].
+        """
+        if not hasattr(os, 'wait4') or p.returncode is not None:
+            p.wait()
+            return
+        while True:
+            try:
+                pid, status, rusage = os.wait4(p.pid, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                # Reaped elsewhere; let subprocess sort out the returncode.
+                p.wait()
+                return
+            break
+        if os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
+        else:
+            p.returncode = os.WEXITSTATUS(status)
+        if stats is not None:
+            stats['rusage'] = rusage
+
+    def _record_command_metrics(self, command, cwd, start_time, returncode,
+                                stats):
+        """Add a 'command' record to self.metrics, if we have one."""
+        metrics = getattr(self, 'metrics', None)
+        if not metrics:
+            return
+        if isinstance(command, (list, tuple)):
+            command = subprocess.list2cmdline(command)
+        fields = dict(stats)
+        rusage = fields.pop('rusage', None)
+        if rusage:
+            fields['user'] = round(rusage.ru_utime, 3)
+            fields['sys'] = round(rusage.ru_stime, 3)
+            fields['maxrss'] = rusage.ru_maxrss
+        metrics.add('command', command=command, cwd=cwd,
+                    wall=round(time.time() - start_time, 3),
+                    returncode=returncode, **fields)
+
+    def _iter_process_output(self, p, stats=None):
+        """Yield (stream, line) pairs from p's stdout and stderr, where
+        stream is 'stdout' or 'stderr', as the lines arrive.
+
+        Both pipes are read concurrently, so a command that fills one
+        pipe while we're blocked on the other can't deadlock.  Lines keep
+        their trailing newline; the last line of a stream may not have
+        one.  p has been waited for once this is exhausted, and its
+        resource usage put in stats['rusage'] where available.
+        """
+        if self._is_windows():
+            # select() only works on sockets on Windows; communicate()
+            # reads both pipes with threads instead.
+            stdout, stderr = p.communicate()
+            for stream, output in (('stdout', stdout), ('stderr', stderr)):
+                for line in (output or '').splitlines(True):
+                    yield stream, line
+            return
+        partial_lines = {p.stdout.fileno(): ['stdout', ''],
+                         p.stderr.fileno(): ['stderr', '']}
+        while partial_lines:
+            try:
+                readable = select.select(partial_lines.keys(), [], [])[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in readable:
+                stream, partial_line = partial_lines[fd]
+                chunk = os.read(fd, OUTPUT_CHUNK_SIZE)
+                if not chunk:
+                    if partial_line:
+                        yield stream, partial_line
+                    del partial_lines[fd]
+                    continue
+                lines = (partial_line + chunk).split('\n')
+                partial_lines[fd][1] = lines.pop()
+                for line in lines:
+                    yield stream, line + '\n'
+        p.stdout.close()
+        p.stderr.close()
+        self._wait_for_process(p, stats)
+
+    def _log_command_start(self, command, cwd, halt_on_failure):
+        """Log how get_output_from_command() and friends are about to run
+        command.  Returns False if cwd doesn't exist.
         """
         if cwd:
             if not os.path.isdir(cwd):
@@ -745,85 +1305,114 @@ class ScriptMixin(object):
                     level = FATAL
                 self.log("Can't run command %s in non-existent directory %s!" %
                          (command, cwd), level=level)
-                return None
+                return False
             self.info("Getting output from command: %s in %s" % (command, cwd))
         else:
             self.info("Getting output from command: %s" % command)
         if isinstance(command, list):
             self.info("Copy/paste: %s" % subprocess.list2cmdline(command))
-        # This could potentially return something?
-        tmp_stdout = None
-        tmp_stderr = None
-        tmp_stdout_filename = '%s_stdout' % tmpfile_base_path
-        tmp_stderr_filename = '%s_stderr' % tmpfile_base_path
+        return True
 
-        # TODO probably some more elegant solution than 2 similar passes
-        try:
-            tmp_stdout = open(tmp_stdout_filename, 'w')
-        except IOError:
-            level = ERROR
-            if halt_on_failure:
-                level = FATAL
-            self.log("Can't open %s for writing!" % tmp_stdout_filename +
-                     self.exception(), level=level)
+    def _check_command_status(self, command, returncode, got_errors,
+                              halt_on_failure, throw_exception,
+                              fatal_exit_code):
+        return_level = DEBUG
+        if got_errors or returncode:
+            return_level = ERROR
+        if returncode and throw_exception:
+            raise subprocess.CalledProcessError(returncode, command)
+        self.log("Return code: %d" % returncode, level=return_level)
+        if halt_on_failure and return_level == ERROR:
+            self.return_code = fatal_exit_code
+            self.fatal("Halting on failure while running %s" % command,
+                       exit_code=fatal_exit_code)
+
+    def get_output_from_command(self, command, cwd=None,
+                                halt_on_failure=False, env=None,
+                                silent=False, log_level=INFO,
+                                tmpfile_base_path='tmpfile',
+                                return_type='output', save_tmpfiles=False,
+                                throw_exception=False, fatal_exit_code=2,
+                                max_output_lines=None, keep_output='first'):
+        """Similar to run_command, but where run_command is an
+        os.system(command) analog, get_output_from_command is a `command`
+        analog.
+
+        Less error checking by design, though if we figure out how to
+        do it without borking the output, great.
+
+        stdout and stderr are read concurrently into memory.  If
+        max_output_lines is set, only the first (keep_output='first') or
+        last (keep_output='last') max_output_lines lines of stdout are
+        kept and returned, though all of them are still logged unless
+        silent.
+
+        With save_tmpfiles or a return_type other than 'output', stdout
+        and stderr are also written to tmpfile_base_path + '_stdout' and
+        '_stderr', and return_type != 'output' returns those paths.
+
+        TODO: binary mode? silent is kinda like that.
+        TODO: since p.wait() can take a long time, optionally log something
+        every N seconds?
+        """
+        if not self._log_command_start(command, cwd, halt_on_failure):
             return None
-        try:
-            tmp_stderr = open(tmp_stderr_filename, 'w')
-        except IOError:
-            level = ERROR
-            if halt_on_failure:
-                level = FATAL
-            self.log("Can't open %s for writing!" % tmp_stderr_filename +
-                     self.exception(), level=level)
+        if keep_output not in ('first', 'last'):
+            self.log("Unknown keep_output %s requested in get_output_from_command!" % keep_output,
+                     level=ERROR)
             return None
         shell = True
         if isinstance(command, list):
             shell = False
-        p = subprocess.Popen(command, shell=shell, stdout=tmp_stdout,
-                             cwd=cwd, stderr=tmp_stderr, env=env)
-        #XXX: changed from self.debug to self.log due to this error:
-        #     TypeError: debug() takes exactly 1 argument (2 given)
-        self.log("Temporary files: %s and %s" % (tmp_stdout_filename, tmp_stderr_filename), level=DEBUG)
-        p.wait()
-        tmp_stdout.close()
-        tmp_stderr.close()
-        return_level = DEBUG
+        start_time = time.time()
+        stats = {'output_bytes': 0, 'output_lines': 0}
+        p = subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE,
+                             cwd=cwd, stderr=subprocess.PIPE, env=env)
+        if max_output_lines and keep_output == 'last':
+            output_lines = deque(maxlen=max_output_lines)
+        else:
+            output_lines = []
+        error_lines = []
+        logged_output_header = False
+        for stream, line in self._iter_process_output(p, stats):
+            stats['output_bytes'] += len(line)
+            stats['output_lines'] += 1
+            if stream == 'stderr':
+                error_lines.append(line)
+                continue
+            if not max_output_lines or keep_output == 'last' or \
+                    len(output_lines) < max_output_lines:
+                output_lines.append(line)
+            if not silent and line and not line.isspace():
+                if not logged_output_header:
+                    self.log("Output received:", level=log_level)
+                    logged_output_header = True
+                self.log(' %s' % line.rstrip().decode("utf-8", "replace"),
+                         level=log_level)
         output = None
-        if os.path.exists(tmp_stdout_filename) and os.path.getsize(tmp_stdout_filename):
-            output = self.read_from_file(tmp_stdout_filename,
-                                         verbose=False)
+        if output_lines:
+            output = ''.join(output_lines)
             if not silent:
-                self.log("Output received:", level=log_level)
-                output_lines = output.rstrip().splitlines()
-                for line in output_lines:
-                    if not line or line.isspace():
-                        continue
-                    line = line.decode("utf-8")
-                    self.log(' %s' % line, level=log_level)
-                output = '\n'.join(output_lines)
-        if os.path.exists(tmp_stderr_filename) and os.path.getsize(tmp_stderr_filename):
-            return_level = ERROR
+                output = '\n'.join(output.rstrip().splitlines())
+        if error_lines:
             self.error("Errors received:")
-            errors = self.read_from_file(tmp_stderr_filename,
-                                         verbose=False)
-            for line in errors.rstrip().splitlines():
+            for line in error_lines:
                 if not line or line.isspace():
                     continue
-                line = line.decode("utf-8")
-                self.error(' %s' % line)
-        elif p.returncode:
-            return_level = ERROR
-        # Clean up.
-        if not save_tmpfiles:
-            self.rmtree(tmp_stderr_filename, log_level=DEBUG)
-            self.rmtree(tmp_stdout_filename, log_level=DEBUG)
-        if p.returncode and throw_exception:
-            raise subprocess.CalledProcessError(p.returncode, command)
-        self.log("Return code: %d" % p.returncode, level=return_level)
-        if halt_on_failure and return_level == ERROR:
-            self.return_code = fatal_exit_code
-            self.fatal("Halting on failure while running %s" % command,
-                       exit_code=fatal_exit_code)
+                self.error(' %s' % line.rstrip().decode("utf-8", "replace"))
+        if save_tmpfiles or return_type != 'output':
+            tmp_stdout_filename = '%s_stdout' % tmpfile_base_path
+            tmp_stderr_filename = '%s_stderr' % tmpfile_base_path
+            self.write_to_file(tmp_stdout_filename, ''.join(output_lines),
+                               verbose=False)
+            self.write_to_file(tmp_stderr_filename, ''.join(error_lines),
+                               verbose=False)
+        stats['errors'] = len(error_lines)
+        self._record_command_metrics(command, cwd, start_time, p.returncode,
+                                     stats)
+        self._check_command_status(command, p.returncode, bool(error_lines),
+                                   halt_on_failure, throw_exception,
+                                   fatal_exit_code)
         # Hm, options on how to return this? I bet often we'll want
         # output_lines[0] with no newline.
         if return_type != 'output':
@@ -831,6 +1420,48 @@ class ScriptMixin(object):
         else:
             return output
 
+    def iter_output_from_command(self, command, cwd=None,
+                                 halt_on_failure=False, env=None,
+                                 silent=False, log_level=INFO,
+                                 throw_exception=False, fatal_exit_code=2):
+        """Generator version of get_output_from_command().
+
+        Yields each line of stdout, without its newline, as the command
+        prints it, so callers can act on output without holding all of it
+        in memory.  stderr lines are logged as errors as they arrive.
+        Return code checking, halt_on_failure and throw_exception happen
+        once the output is exhausted.
+        """
+        if not self._log_command_start(command, cwd, halt_on_failure):
+            return
+        shell = True
+        if isinstance(command, list):
+            shell = False
+        start_time = time.time()
+        stats = {'output_bytes': 0, 'output_lines': 0, 'errors': 0}
+        p = subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE,
+                             cwd=cwd, stderr=subprocess.PIPE, env=env)
+        got_errors = False
+        for stream, line in self._iter_process_output(p, stats):
+            stats['output_bytes'] += len(line)
+            stats['output_lines'] += 1
+            line = line.rstrip('\r\n')
+            if stream == 'stderr':
+                if line and not line.isspace():
+                    got_errors = True
+                    stats['errors'] += 1
+                    self.error(' %s' % line.decode("utf-8", "replace"))
+                continue
+            if not silent and line and not line.isspace():
+                self.log(' %s' % line.decode("utf-8", "replace"),
+                         level=log_level)
+            yield line
+        self._record_command_metrics(command, cwd, start_time, p.returncode,
+                                     stats)
+        self._check_command_status(command, p.returncode, got_errors,
+                                   halt_on_failure, throw_exception,
+                                   fatal_exit_code)
+
     def _touch_file(self, file_name, times=None):
         """touch a file; If times is None, then the file's access and modified
            times are set to the current time
@@ -846,6 +1477,236 @@ class ScriptMixin(object):
 
         os.utime(file_name, times)
 
+    def _query_zip_members(self, bundle, members=None):
+        """ Return the ZipInfos in bundle whose names match any of the
+            unzip-style wildcards in members (all of them if members is
+            None).  Unsafe names (absolute, or containing ..) are skipped.
+            """
+        infos = []
+        for info in bundle.infolist():
+            name = info.filename
+            if members and not [m for m in members
+                                if fnmatch.fnmatchcase(name, m)]:
+                continue
+            parts = name.replace('\\', '/').split('/')
+            if os.path.isabs(name) or '..' in parts or \
+                    os.path.splitdrive(name)[0]:
+                self.warning("Skipping unsafe zip member %s" % name)
+                continue
+            infos.append(info)
+        return infos
+
+    def _zip_member_is_current(self, info, path):
+        """ Return True if path already has info's size and CRC32.
+            """
+        try:
+            if os.path.islink(path) or os.path.getsize(path) != info.file_size:
+                return False
+        except OSError:
+            return False
+        crc = 0
+        fh = open(path, 'rb')
+        try:
+            while True:
+                block = fh.read(UNZIP_CHUNK_SIZE)
+                if not block:
+                    break
+                crc = zlib.crc32(block, crc)
+        finally:
+            fh.close()
+        return (crc & 0xffffffff) == info.CRC
+
+    def _query_zip_manifest(self, manifest_path):
+        """ Return the {member: [size, crc, mtime]} manifest unzip() wrote
+            to manifest_path, or {} if there isn't a readable one.
+            """
+        if not os.path.exists(manifest_path):
+            return {}
+        try:
+            fh = open(manifest_path)
+            try:
+                manifest = json.load(fh)
+            finally:
+                fh.close()
+        except (IOError, ValueError), e:
+            self.warning("Ignoring unreadable %s: %s" % (manifest_path, str(e)))
+            return {}
+        if not isinstance(manifest, dict):
+            return {}
+        return manifest
+
+    def _write_zip_manifest(self, manifest_path, manifest):
+        tmp_path = manifest_path + '.tmp'
+        fh = open(tmp_path, 'w')
+        try:
+            json.dump(manifest, fh)
+        finally:
+            fh.close()
+        if os.name == 'nt' and os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        os.rename(tmp_path, manifest_path)
+
+    def _remove_stale_zip_members(self, extract_to, manifest, names):
+        """ Delete the files in manifest that aren't in the archive any
+            more (names), along with any directories that leaves empty.
+            """
+        extract_to = os.path.abspath(extract_to)
+        stale = sorted(set(manifest) - names)
+        for name in stale:
+            path = os.path.join(extract_to, *name.split('/'))
+            if os.path.lexists(path):
+                os.remove(path)
+            del manifest[name]
+            parent_dir = os.path.dirname(path)
+            while parent_dir.startswith(extract_to + os.sep):
+                try:
+                    os.rmdir(parent_dir)
+                except OSError:
+                    break
+                parent_dir = os.path.dirname(parent_dir)
+        if stale:
+            self.info("Removed %d files no longer in the archive." %
+                      len(stale))
+
+    def _extract_zip_members(self, zip_path, infos, extract_to,
+                             manifest=None):
+        """ Extract infos from zip_path into extract_to, streaming each in
+            UNZIP_CHUNK_SIZE blocks.  Members already on disk with the same
+            size and CRC32 are left alone.  If manifest has an entry for a
+            member, that is trusted instead of reading the file back, as
+            long as the file's size and mtime haven't changed since.
+
+            Returns the number of members written.  Runs in unzip()'s
+            worker threads, so it opens its own ZipFile.
+            """
+        written = 0
+        bundle = zipfile.ZipFile(zip_path)
+        try:
+            for info in infos:
+                path = os.path.join(extract_to, *info.filename.split('/'))
+                mode = (info.external_attr >> 16) & 0xffff
+                if info.filename.endswith('/'):
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+                    continue
+                parent_dir = os.path.dirname(path)
+                if not os.path.isdir(parent_dir):
+                    try:
+                        os.makedirs(parent_dir)
+                    except OSError:
+                        # Another worker may have just created it.
+                        if not os.path.isdir(parent_dir):
+                            raise
+                if stat.S_ISLNK(mode) and hasattr(os, 'symlink'):
+                    target = bundle.read(info)
+                    if os.path.islink(path) and os.readlink(path) == target:
+                        continue
+                    if os.path.lexists(path):
+                        os.remove(path)
+                    os.symlink(target, path)
+                    written += 1
+                    continue
+                if manifest is not None and info.filename in manifest:
+                    size, crc, mtime = manifest[info.filename]
+                    if (size, crc) == (info.file_size, info.CRC):
+                        try:
+                            st = os.lstat(path)
+                            if (st.st_size, int(st.st_mtime)) == (size, mtime):
+                                continue
+                        except OSError:
+                            pass
+                elif self._zip_member_is_current(info, path):
+                    continue
+                if os.path.lexists(path):
+                    # Don't write through hardlinks or read-only files.
+                    os.remove(path)
+                src = bundle.open(info)
+                dest = open(path, 'wb')
+                try:
+                    shutil.copyfileobj(src, dest, UNZIP_CHUNK_SIZE)
+                finally:
+                    dest.close()
+                    src.close()
+                if mode & 0777:
+                    os.chmod(path, mode & 0777)
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                os.utime(path, (mtime, mtime))
+                written += 1
+        finally:
+            bundle.close()
+        return written
+
+    def unzip(self, zip_path, extract_to, members=None, manifest_path=None,
+              error_level=ERROR, exit_code=-1):
+        """ Extract zip_path into extract_to, like `unzip -q -o`.
+
+            members is a list of unzip-style wildcards (e.g. ['bin/*']);
+            only the matching members are extracted, and none matching
+            isn't an error.  Members are streamed to disk, skipped if an
+            identical file (by size and CRC32) is already there, and
+            extracted across config['unzip_parallelism'] threads.
+
+            If manifest_path is set, the size, CRC32 and mtime of each file
+            extracted is recorded there.  The next unzip() into the same
+            directory with that manifest_path compares against it with a
+            stat() rather than reading each file back, and deletes the
+            files it recorded that are no longer in the archive.
+
+            Returns None for success, not None for failure.
+            """
+        self.info("Extracting %s to %s" % (zip_path, extract_to))
+        try:
+            bundle = zipfile.ZipFile(zip_path)
+            try:
+                infos = self._query_zip_members(bundle, members)
+                names = set(bundle.namelist())
+            finally:
+                bundle.close()
+            if members and not infos:
+                self.info("No members of %s match %s" % (zip_path, members))
+            self.mkdir_p(extract_to)
+            manifest = None
+            if manifest_path:
+                manifest = self._query_zip_manifest(manifest_path)
+                self._remove_stale_zip_members(extract_to, manifest, names)
+            # Create the directories up front, then spread the files,
+            # biggest first, round-robin across the workers.
+            self._extract_zip_members(
+                zip_path, [i for i in infos if i.filename.endswith('/')],
+                extract_to)
+            file_infos = [i for i in infos if not i.filename.endswith('/')]
+            file_infos.sort(key=lambda i: -i.file_size)
+            num_workers = max(1, min(self.config.get('unzip_parallelism', 4),
+                                     len(file_infos)))
+            batches = [file_infos[i::num_workers] for i in range(num_workers)]
+            if num_workers == 1:
+                written = self._extract_zip_members(zip_path, batches[0],
+                                                    extract_to, manifest)
+            else:
+                pool = ThreadPool(num_workers)
+                try:
+                    written = sum(pool.map(
+                        lambda batch: self._extract_zip_members(
+                            zip_path, batch, extract_to, manifest),
+                        batches))
+                finally:
+                    pool.close()
+                    pool.join()
+            if manifest is not None:
+                for info in file_infos:
+                    path = os.path.join(extract_to, *info.filename.split('/'))
+                    st = os.lstat(path)
+                    manifest[info.filename] = [info.file_size, info.CRC,
+                                               int(st.st_mtime)]
+                self._write_zip_manifest(manifest_path, manifest)
+        except (IOError, OSError, zipfile.BadZipfile, zlib.error), e:
+            self.log("Can't extract %s to %s: %s" % (zip_path, extract_to,
+                                                      str(e)),
+                     level=error_level, exit_code=exit_code)
+            return -1
+        self.info("Extracted %d of %d files; the rest were up to date." %
+                  (written, len(file_infos)))
+
     def unpack(self, filename, extract_to):
         '''
         This method allows us to extract a file regardless of its extension
@@ -859,6 +1720,8 @@ class ScriptMixin(object):
                 tar_cmd = "zxfv"
             command.extend([tar_cmd, filename, "-C", extract_to])
             self.run_command(command, halt_on_failure=True)
+        elif filename.endswith('.zip'):
+            self.unzip(filename, extract_to, error_level=FATAL)
         else:
             # XXX implement
             pass
@@ -943,6 +1806,27 @@ def PostScriptAction(action=None):
     return _wrapped
 
 
+def DependsOnActions(*actions):
+    """Decorator for action methods, declaring which earlier actions they
+    need to have finished.
+
+    With max_parallel_actions (--parallel-actions) above 1, an action
+    starts as soon as the actions it depends on are done, alongside any
+    other ready actions.  Actions that don't declare dependencies wait
+    for every action before them in all_actions, as when run one at a
+    time.  e.g.
+
+        @DependsOnActions('build')
+        def package_symbols(self):
+
+    The action_dependencies config, {action: [actions]}, overrides this.
+    """
+    def _wrapped(func):
+        func._depends_on_actions = actions
+        return func
+    return _wrapped
+
+
 # BaseScript {{{1
 class BaseScript(ScriptMixin, LogMixin, object):
     def __init__(self, config_options=None, ConfigClass=BaseConfig,
@@ -993,6 +1877,8 @@ class BaseScript(ScriptMixin, LogMixin, object):
         self.actions = tuple(rw_config.actions)
         self.all_actions = tuple(rw_config.all_actions)
         self.env = None
+        self.resource_timeline = None
+        self.metrics = None
         self.new_log_obj(default_log_level=default_log_level)
 
         # Set self.config to read-only.
@@ -1010,6 +1896,8 @@ class BaseScript(ScriptMixin, LogMixin, object):
         self._config_lock()
 
         self.info("Run as %s" % rw_config.command_line)
+        self._start_resource_timeline()
+        self._start_metrics()
         if self.config.get("dump_config_hierarchy"):
             # we only wish to dump and display what self.config is made up of,
             # against the current script + args, without actually running any
@@ -1098,6 +1986,11 @@ class BaseScript(ScriptMixin, LogMixin, object):
         """Copies logs to the upload directory"""
         self.info("Copying logs to upload dir...")
         log_files = ['localconfig.json']
+        if self.resource_timeline:
+            log_files.append(RESOURCE_TIMELINE_FILE)
+        if self.metrics and self.metrics.path and \
+                os.path.exists(self.metrics.path):
+            log_files.append(os.path.basename(self.metrics.path))
         for log_name in self.log_obj.log_files.keys():
             log_files.append(self.log_obj.log_files[log_name])
         dirs = self.query_abs_dirs()
@@ -1115,6 +2008,11 @@ class BaseScript(ScriptMixin, LogMixin, object):
 
         method_name = action.replace("-", "_")
         self.action_message("Running %s step." % action)
+        if self.resource_timeline:
+            self.resource_timeline.mark('action_start', action=action)
+        action_start_time = time.time()
+        if self.metrics:
+            self.metrics.current_action = action
 
         # An exception during a pre action listener should abort execution.
         for fn, target in self._listeners['pre_action']:
@@ -1153,6 +2051,15 @@ class BaseScript(ScriptMixin, LogMixin, object):
             self._possibly_run_method("postflight_%s" % method_name)
             success = True
         finally:
+            if self.resource_timeline:
+                self.resource_timeline.mark('action_end', action=action,
+                                            success=success)
+            # Recorded before the post-action listeners run, so they can
+            # look at it with self.metrics.query_action(action).
+            if self.metrics:
+                self.metrics.add('action', action=action, success=success,
+                                 wall=round(time.time() - action_start_time, 3),
+                                 **self.metrics.summarize_commands(action))
             post_success = True
             for fn, target in self._listeners['post_action']:
                 if target is not None and target != action:
@@ -1167,6 +2074,8 @@ class BaseScript(ScriptMixin, LogMixin, object):
                     self.error("Exception during post-action for %s: %s" % (
                         action, traceback.format_exc()))
 
+            if self.metrics:
+                self.metrics.current_action = None
             if not post_success:
                 self.fatal("Aborting due to failure in post-action listener.")
 
@@ -1185,6 +2094,7 @@ class BaseScript(ScriptMixin, LogMixin, object):
         Postflight is quick testing for success after an action.
 
         """
+        self._reap_leftover_tombstones()
         for fn in self._listeners['pre_run']:
             try:
                 self.info("Running pre-run listener: %s" % fn)
@@ -1206,8 +2116,12 @@ class BaseScript(ScriptMixin, LogMixin, object):
 
         self.dump_config()
         try:
-            for action in self.all_actions:
-                self.run_action(action)
+            max_parallel_actions = self.config.get('max_parallel_actions') or 1
+            if max_parallel_actions > 1:
+                self._run_actions_in_parallel(max_parallel_actions)
+            else:
+                for action in self.all_actions:
+                    self.run_action(action)
         except Exception:
             self.fatal("Uncaught exception: %s" % traceback.format_exc())
         finally:
@@ -1224,11 +2138,88 @@ class BaseScript(ScriptMixin, LogMixin, object):
 
             if not post_success:
                 self.fatal("Aborting due to failure in post-run listener.")
+        if self.resource_timeline:
+            self.resource_timeline.stop()
         if self.config.get("copy_logs_post_run", True):
             self.copy_logs_to_upload_dir()
 
         return self.return_code
 
+    def query_action_dependencies(self):
+        """ Return {action: set of actions it has to wait for}, from the
+            action_dependencies config and DependsOnActions.
+            """
+        dependencies = {}
+        config_dependencies = self.config.get('action_dependencies') or {}
+        for i, action in enumerate(self.all_actions):
+            earlier_actions = self.all_actions[:i]
+            depends_on = config_dependencies.get(action)
+            if depends_on is None:
+                method = getattr(self, action.replace("-", "_"), None)
+                depends_on = getattr(method, '_depends_on_actions', None)
+            if depends_on is None:
+                depends_on = earlier_actions
+            for other_action in depends_on:
+                if other_action not in earlier_actions:
+                    self.fatal("Action %s can only depend on actions before it "
+                               "in %s, not %s!" % (action, self.all_actions,
+                                                   other_action))
+            dependencies[action] = set(depends_on)
+        return dependencies
+
+    def _run_actions_in_parallel(self, max_parallel_actions):
+        """ Run up to max_parallel_actions actions at once, each as soon as
+            the actions it depends on are done.  Each action's pre- and
+            post-action listeners still run around it, in its thread.
+
+            Once an action fails, no more are started; the first failure is
+            raised once the running ones have finished.
+            """
+        dependencies = self.query_action_dependencies()
+        pending = list(self.all_actions)
+        done = set()
+        running = set()
+        failures = []
+        condition = threading.Condition()
+
+        def run_action(action):
+            try:
+                self.run_action(action)
+            except BaseException:
+                # Including SystemExit from fatal().
+                with condition:
+                    failures.append(sys.exc_info())
+            with condition:
+                running.discard(action)
+                done.add(action)
+                condition.notify()
+
+        self.info("Running up to %d actions at once." % max_parallel_actions)
+        with condition:
+            while pending and not failures:
+                ready = [a for a in pending if dependencies[a] <= done]
+                if not ready or (ready[0] in self.actions and
+                                 len(running) >= max_parallel_actions):
+                    # Nothing else can start until something finishes.
+                    # The timeout keeps us responsive to ^C.
+                    condition.wait(1)
+                    continue
+                action = ready[0]
+                pending.remove(action)
+                if action not in self.actions:
+                    # Just logs that it's skipped.
+                    self.run_action(action)
+                    done.add(action)
+                    continue
+                running.add(action)
+                thread = threading.Thread(target=run_action, args=(action, ),
+                                          name=action)
+                thread.start()
+            while running:
+                condition.wait(1)
+        if failures:
+            raise failures[0][0], failures[0][1], failures[0][2]
+
     def run_and_exit(self):
         """Runs the script and exits the current interpreter."""
         sys.exit(self.run())
@@ -1238,7 +2229,54 @@ class BaseScript(ScriptMixin, LogMixin, object):
         Delete the working directory
         """
         dirs = self.query_abs_dirs()
-        self.rmtree(dirs['abs_work_dir'], error_level=FATAL)
+        self.rmtree(dirs['abs_work_dir'], error_level=FATAL,
+                    background=self.config.get('background_clobber'))
+
+    def _start_resource_timeline(self):
+        """ With resource_timeline_interval set, sample cpu, memory, and
+            our child processes' rss, fds and I/O that often (in seconds)
+            into RESOURCE_TIMELINE_FILE in the log dir, along with action
+            boundaries.  It's copied to the upload dir with the logs.
+            """
+        interval = self.config.get('resource_timeline_interval')
+        if not interval:
+            return
+        dirs = self.query_abs_dirs()
+        self.mkdir_p(dirs['abs_log_dir'])
+        timeline = ResourceTimeline(
+            os.path.join(dirs['abs_log_dir'], RESOURCE_TIMELINE_FILE),
+            interval=float(interval), log_obj=self.log_obj,
+            config=self.config)
+        if timeline.start():
+            self.resource_timeline = timeline
+
+    def _start_metrics(self):
+        """ Set up self.metrics to record action and command timings in
+            config['metrics_file'] (e.g. METRICS_FILE) in the log dir.
+            Metrics are off unless metrics_file is set.
+            """
+        metrics_file = self.config.get('metrics_file')
+        if not metrics_file:
+            return
+        dirs = self.query_abs_dirs()
+        path = os.path.join(dirs['abs_log_dir'], metrics_file)
+        self.mkdir_p(dirs['abs_log_dir'])
+        if os.path.exists(path):
+            os.remove(path)
+        self.metrics = MetricsRecorder(path)
+
+    def _reap_leftover_tombstones(self):
+        """ Background clobbers that didn't finish, e.g. because the machine
+            rebooted, leave tombstones next to the working directory; start
+            removing those again.
+            """
+        if not self.config.get('background_clobber'):
+            return
+        dirs = self.query_abs_dirs()
+        tombstones = glob.glob(os.path.join(os.path.dirname(dirs['abs_work_dir']),
+                                            '*' + TOMBSTONE_SUFFIX))
+        if tombstones:
+            self.reap_tombstones(tombstones)
 
     def query_abs_dirs(self):
         """We want to be able to determine where all the important things
@@ -1325,6 +2363,33 @@ class BaseScript(ScriptMixin, LogMixin, object):
                     """log is closed; print as a default. Ran into this
                     when calling from __del__()"""
                     print "### Log is closed! (%s)" % item['message']
+        self._summarize_metrics()
+
+    def _summarize_metrics(self, num_commands=10):
+        """Log a table of how long each action took, and the
+        num_commands slowest commands."""
+        if not self.metrics:
+            return
+        actions = self.metrics.query_records('action')
+        if not actions:
+            return
+        row = "%-28s %10s %10s %10s %8s"
+        self.info(row % ("Action", "Wall (s)", "Cmds (s)", "CPU (s)",
+                         "Commands"))
+        for record in actions:
+            self.info(row % (record['action'], "%.1f" % record['wall'],
+                             "%.1f" % record['command_wall'],
+                             "%.1f" % (record['command_user'] +
+                                       record['command_sys']),
+                             record['commands']))
+        commands = self.metrics.query_records('command')
+        commands.sort(key=lambda r: r['wall'], reverse=True)
+        if commands:
+            self.info("Slowest commands:")
+        for record in commands[:num_commands]:
+            self.info("%10.1fs %s: %s" % (record['wall'],
+                                          record.get('action', '-'),
+                                          record['command'][:200]))
 
     def add_summary(self, message, level=INFO):
         self.summary_list.append({'message': message, 'level': level})
@@ -135,6 +135,7 @@ class AndroidSigningMixin(object):
                 loop = False
             for line in p.stdout:
                 parser.add_lines(line)
+        parser.finish()
         if parser.num_errors:
             self.log("(failure)", level=error_level)
         else:
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""Resource usage timeline for a script and its child processes.
+
+ResourceTimeline samples system cpu and memory use, and the rss, open
+fds, cpu time and I/O of every process under a pid, every interval
+seconds, from a background thread.  Each sample, and each mark() (e.g.
+action boundaries), is written as a line of JSON:
+
+    {"type": "start", "time": 1400000000.0, "interval": 1.0, "pid": 123,
+     "cpus": 8, "mem_total": 16000000000}
+    {"type": "sample", "t": 1.0, "cpu": 37.5, "mem": 4000000000,
+     "procs": [[pid, ppid, name, rss, fds, cpu_secs, read_bytes,
+                write_bytes], ...]}
+    {"type": "action_start", "t": 1.2, "action": "build"}
+    {"type": "action_end", "t": 900.3, "action": "build", "success": true}
+    {"type": "end", "t": 901.0}
+
+t is seconds since the start record.  Values we couldn't read are null.
+
+psutil is used if it can be imported; otherwise /proc is read directly,
+so on Linux this works without any extra packages.
+"""
+
+import os
+import threading
+import time
+import traceback
+
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from mozharness.base.log import LogMixin
+
+
+# Sources {{{1
+class ProcfsSource(object):
+    """Reads resource usage from Linux's /proc."""
+    def __init__(self):
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.clock_ticks = float(os.sysconf('SC_CLK_TCK'))
+
+    @staticmethod
+    def is_available():
+        return os.path.exists('/proc/self/stat')
+
+    def _read(self, path):
+        fh = open(path)
+        try:
+            return fh.read()
+        finally:
+            fh.close()
+
+    def query_cpu_count(self):
+        return os.sysconf('SC_NPROCESSORS_ONLN')
+
+    def query_cpu_times(self):
+        """Return (busy, total) cpu ticks since boot, across all cpus."""
+        fields = [int(f) for f in self._read('/proc/stat').split('\n', 1)[0].split()[1:]]
+        # idle and iowait
+        idle = sum(fields[3:5])
+        total = sum(fields)
+        return total - idle, total
+
+    def _query_meminfo(self):
+        meminfo = {}
+        for line in self._read('/proc/meminfo').splitlines():
+            fields = line.split()
+            if len(fields) >= 2:
+                meminfo[fields[0].rstrip(':')] = int(fields[1]) * 1024
+        return meminfo
+
+    def query_memory_total(self):
+        return self._query_meminfo().get('MemTotal')
+
+    def query_memory_used(self):
+        meminfo = self._query_meminfo()
+        if 'MemAvailable' in meminfo:
+            available = meminfo['MemAvailable']
+        else:
+            available = sum([meminfo.get(k, 0) for k in
+                             ('MemFree', 'Buffers', 'Cached')])
+        return meminfo['MemTotal'] - available
+
+    def _query_stat(self, pid):
+        stat = self._read('/proc/%d/stat' % pid)
+        # The name is in parentheses, and may contain spaces or parens.
+        name = stat[stat.index('(') + 1:stat.rindex(')')]
+        fields = stat[stat.rindex(')') + 2:].split()
+        return name, fields
+
+    def query_processes(self, root_pid):
+        """Return a list of [pid, ppid, name, rss, fds, cpu_secs,
+        read_bytes, write_bytes] for root_pid and its descendants."""
+        stats = {}
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                name, fields = self._query_stat(int(entry))
+            except (IOError, OSError, ValueError):
+                # Exited while we looked.
+                continue
+            ppid = int(fields[1])
+            stats[int(entry)] = (name, fields)
+            children.setdefault(ppid, []).append(int(entry))
+        processes = []
+        todo = [root_pid]
+        while todo:
+            pid = todo.pop()
+            todo.extend(children.get(pid, []))
+            if pid not in stats:
+                continue
+            name, fields = stats[pid]
+            # utime + stime, in ticks
+            cpu_secs = (int(fields[11]) + int(fields[12])) / self.clock_ticks
+            rss = int(fields[21]) * self.page_size
+            try:
+                fds = len(os.listdir('/proc/%d/fd' % pid))
+            except OSError:
+                fds = None
+            read_bytes = write_bytes = None
+            try:
+                for line in self._read('/proc/%d/io' % pid).splitlines():
+                    if line.startswith('read_bytes:'):
+                        read_bytes = int(line.split()[1])
+                    elif line.startswith('write_bytes:'):
+                        write_bytes = int(line.split()[1])
+            except (IOError, OSError):
+                pass
+            processes.append([pid, int(fields[1]), name, rss, fds,
+                              round(cpu_secs, 2), read_bytes, write_bytes])
+        return processes
+
+
+class PsutilSource(object):
+    """Reads resource usage through psutil, old (0.7) or new."""
+    @staticmethod
+    def is_available():
+        return psutil is not None
+
+    def _call(self, obj, name, *args, **kwargs):
+        # psutil 2.0 dropped the get_ prefixes.
+        method = getattr(obj, name, None) or getattr(obj, 'get_' + name)
+        return method(*args, **kwargs)
+
+    def query_cpu_count(self):
+        if hasattr(psutil, 'cpu_count'):
+            return psutil.cpu_count()
+        return psutil.NUM_CPUS
+
+    def query_cpu_times(self):
+        times = psutil.cpu_times()
+        total = sum(times)
+        idle = times.idle + getattr(times, 'iowait', 0)
+        return total - idle, total
+
+    def query_memory_total(self):
+        return psutil.virtual_memory().total
+
+    def query_memory_used(self):
+        memory = psutil.virtual_memory()
+        return memory.total - memory.available
+
+    def query_processes(self, root_pid):
+        root = psutil.Process(root_pid)
+        processes = []
+        for proc in [root] + self._call(root, 'children', recursive=True):
+            try:
+                ppid = proc.ppid() if callable(proc.ppid) else proc.ppid
+                name = proc.name() if callable(proc.name) else proc.name
+                rss = self._call(proc, 'memory_info').rss
+                cpu_times = self._call(proc, 'cpu_times')
+                try:
+                    fds = self._call(proc, 'num_fds')
+                except (AttributeError, psutil.AccessDenied):
+                    fds = None
+                try:
+                    io = self._call(proc, 'io_counters')
+                    read_bytes, write_bytes = io.read_bytes, io.write_bytes
+                except (AttributeError, psutil.AccessDenied):
+                    read_bytes = write_bytes = None
+            except psutil.NoSuchProcess:
+                continue
+            processes.append([proc.pid, ppid, name, rss, fds,
+                              round(cpu_times.user + cpu_times.system, 2),
+                              read_bytes, write_bytes])
+        return processes
+
+
+def query_resource_source():
+    """Return the best available source of resource usage, or None."""
+    for source_class in (PsutilSource, ProcfsSource):
+        if source_class.is_available():
+            return source_class()
+
+
+# ResourceTimeline {{{1
+class ResourceTimeline(LogMixin, object):
+    def __init__(self, path, interval=1.0, pid=None, log_obj=None,
+                 config=None):
+        self.path = path
+        self.interval = interval
+        self.pid = pid or os.getpid()
+        self.log_obj = log_obj
+        self.config = config or {}
+        self.source = query_resource_source()
+        self.start_time = None
+        self.fh = None
+        self.thread = None
+        self.write_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self._last_cpu_times = None
+
+    def _write(self, record):
+        line = json.dumps(record, separators=(',', ':'))
+        with self.write_lock:
+            if self.fh:
+                self.fh.write(line + '\n')
+                # Keep what we have if the script dies.
+                self.fh.flush()
+
+    def _offset(self):
+        return round(time.time() - self.start_time, 3)
+
+    def start(self):
+        """Start sampling in a background thread.  Returns False if
+        there's no way to sample on this platform."""
+        if not self.source:
+            self.warning("Can't sample resource usage here: no psutil or /proc.")
+            return False
+        self.fh = open(self.path, 'w')
+        self.start_time = time.time()
+        self._write({
+            'type': 'start', 'time': self.start_time,
+            'interval': self.interval, 'pid': self.pid,
+            'cpus': self.source.query_cpu_count(),
+            'mem_total': self.source.query_memory_total(),
+        })
+        self._last_cpu_times = self.source.query_cpu_times()
+        self.thread = threading.Thread(target=self._run,
+                                       name='ResourceTimeline')
+        # Don't keep the script alive if it exits without calling stop().
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:
+                self.warning("Resource sampling failed; stopping: %s" %
+                             traceback.format_exc())
+                return
+
+    def sample(self):
+        """Write one sample."""
+        busy, total = self.source.query_cpu_times()
+        last_busy, last_total = self._last_cpu_times
+        self._last_cpu_times = (busy, total)
+        cpu = None
+        if total > last_total:
+            cpu = round(100.0 * (busy - last_busy) / (total - last_total), 1)
+        self._write({
+            'type': 'sample', 't': self._offset(), 'cpu': cpu,
+            'mem': self.source.query_memory_used(),
+            'procs': self.source.query_processes(self.pid),
+        })
+
+    def mark(self, event, **kwargs):
+        """Record event (e.g. 'action_start') at the current time, with
+        kwargs as extra fields."""
+        if not self.fh:
+            return
+        record = {'type': event, 't': self._offset()}
+        record.update(kwargs)
+        self._write(record)
+
+    def stop(self):
+        """Stop sampling and close the timeline file."""
+        if not self.thread:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.mark('end')
+        with self.write_lock:
+            self.fh.close()
+            self.fh = None
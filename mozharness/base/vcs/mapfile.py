@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+# ***** END LICENSE BLOCK *****
+"""hg<->git mapfile index.
+
+hg-git's .hg/git-mapfile has a "GIT_SHA HG_SHA" line per converted
+changeset.  MapfileIndex keeps those pairs in a sqlite database indexed
+both ways, and remembers how far into each mapfile it has read, so a
+mapfile that has only been appended to since the last update() is read
+from where we left off rather than from the top.
+
+One index can combine several mapfiles; each pair is kept per mapfile,
+so prune() can drop the pairs of mapfiles that are no longer wanted.
+"""
+
+import os
+import sqlite3
+
+from mozharness.base.log import LogMixin
+
+# Bump when the schema changes; older indexes are rebuilt from scratch.
+INDEX_VERSION = 1
+
+
+# MapfileIndex {{{1
+class MapfileIndex(LogMixin, object):
+    def __init__(self, index_path, log_obj=None, config=None):
+        self.index_path = index_path
+        self.log_obj = log_obj
+        self.config = config or {}
+        self.db = sqlite3.connect(index_path)
+        self.db.text_factory = str
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != INDEX_VERSION:
+            self.db.executescript("""
+                DROP TABLE IF EXISTS revisions;
+                DROP TABLE IF EXISTS mapfiles;
+                PRAGMA user_version = %d;
+            """ % INDEX_VERSION)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS revisions (
+                hg TEXT NOT NULL,
+                git TEXT NOT NULL,
+                path TEXT NOT NULL,
+                PRIMARY KEY (hg, path)
+            );
+            CREATE INDEX IF NOT EXISTS revisions_git ON revisions (git);
+            CREATE INDEX IF NOT EXISTS revisions_path ON revisions (path);
+            CREATE TABLE IF NOT EXISTS mapfiles (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                tail TEXT NOT NULL
+            );
+        """)
+
+    def close(self):
+        self.db.close()
+
+    def _read_mapfile(self, fh, path, state):
+        """ Yield (hg, git, path, hg, path, git) from the complete lines
+            of fh, for update()'s INSERT, keeping track of the offset and
+            contents of the last one in state.
+            """
+        for line in fh:
+            if not line.endswith('\n'):
+                # Still being written; pick it up next time.
+                break
+            state['size'] += len(line)
+            state['tail'] = line
+            fields = line.split()
+            if len(fields) == 2:
+                hg, git = fields[1].lower(), fields[0].lower()
+                yield hg, git, path, hg, path, git
+
+    def update(self, mapfile):
+        """ Add the revisions in mapfile that we haven't seen yet, and
+            return how many were added or changed.
+
+            If mapfile has only grown since the last update(), only the
+            new lines are read.  If it was rewritten, all of it is read
+            again and replaces what the index had from it, and the count
+            also includes revisions that it dropped or now maps to a
+            different git sha (say, after the git repo was regenerated).
+            """
+        path = os.path.abspath(mapfile)
+        st = os.stat(path)
+        state = {'size': 0, 'tail': ''}
+        row = self.db.execute(
+            "SELECT size, mtime, tail FROM mapfiles WHERE path = ?", (path, )
+        ).fetchone()
+        fh = open(path, 'rb')
+        try:
+            if row:
+                size, mtime, tail = row
+                if size == st.st_size and mtime == st.st_mtime:
+                    return 0
+                if tail and st.st_size >= size:
+                    fh.seek(size - len(tail))
+                    if fh.read(len(tail)) == tail:
+                        state = {'size': size, 'tail': tail}
+                if tail and not state['size']:
+                    self.info("%s was rewritten; reindexing all of it." % path)
+                    fh.seek(0)
+            rewritten = row and not state['size']
+            before = self.db.total_changes
+            with self.db:
+                if rewritten:
+                    self.db.execute("DROP TABLE IF EXISTS temp.old_revisions")
+                    self.db.execute(
+                        "CREATE TEMP TABLE old_revisions AS "
+                        "SELECT hg, git FROM revisions WHERE path = ?", (path, ))
+                    self.db.execute("DELETE FROM revisions WHERE path = ?",
+                                    (path, ))
+                # Only touch rows that are new or changed, so total_changes
+                # doesn't count lines we already had.
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO revisions (hg, git, path) "
+                    "SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM revisions "
+                    "WHERE hg = ? AND path = ? AND git = ?)",
+                    self._read_mapfile(fh, path, state)
+                )
+                added = self.db.total_changes - before
+                if rewritten:
+                    added = self.db.execute("""
+                        SELECT
+                            (SELECT COUNT(*) FROM (
+                                SELECT hg, git FROM revisions WHERE path = ?
+                                EXCEPT SELECT hg, git FROM old_revisions)) +
+                            (SELECT COUNT(*) FROM (
+                                SELECT hg FROM old_revisions
+                                EXCEPT SELECT hg FROM revisions
+                                WHERE path = ?))
+                    """, (path, path)).fetchone()[0]
+                    self.db.execute("DROP TABLE temp.old_revisions")
+                # If the last line is incomplete, size stops short of
+                # st_size, and we'll look again next time.
+                self.db.execute(
+                    "INSERT OR REPLACE INTO mapfiles (path, size, mtime, tail) "
+                    "VALUES (?, ?, ?, ?)",
+                    (path, state['size'], st.st_mtime, state['tail'])
+                )
+        finally:
+            fh.close()
+        self.info("Indexed %d new or changed revisions from %s." %
+                  (added, path))
+        return added
+
+    def prune(self, mapfiles):
+        """ Forget the revisions from every mapfile not in mapfiles, and
+            return how many were forgotten.
+            """
+        paths = set([os.path.abspath(mapfile) for mapfile in mapfiles])
+        removed = 0
+        with self.db:
+            # Every mapfile we've read has a row in mapfiles.
+            for (path, ) in self.db.execute(
+                    "SELECT path FROM mapfiles").fetchall():
+                if path in paths:
+                    continue
+                self.info("Forgetting the revisions from %s." % path)
+                removed += self.db.execute(
+                    "DELETE FROM revisions WHERE path = ?", (path, )).rowcount
+                self.db.execute("DELETE FROM mapfiles WHERE path = ?", (path, ))
+        return removed
+
+    def _query_revision(self, column, key_column, revision):
+        revision = revision.lower()
+        # Allow short hashes: everything starting with revision.
+        rows = self.db.execute(
+            "SELECT DISTINCT %s FROM revisions WHERE %s >= ? AND %s < ? "
+            "LIMIT 2" %
+            (column, key_column, key_column),
+            (revision, revision + 'g')
+        ).fetchall()
+        if len(rows) > 1:
+            self.warning("%s revision %s is ambiguous!" % (key_column, revision))
+            return None
+        if rows:
+            return rows[0][0]
+
+    def query_git_revision(self, hg_revision):
+        """ Return the git sha for hg_revision (which may be a short hash),
+            or None if it isn't mapped.
+            """
+        return self._query_revision('git', 'hg', hg_revision)
+
+    def query_hg_revision(self, git_revision):
+        """ Return the hg sha for git_revision (which may be a short hash),
+            or None if it isn't mapped.
+            """
+        return self._query_revision('hg', 'git', git_revision)
+
+    def write_mapfile(self, path):
+        """ Write every indexed revision to path, sorted by hg sha, in
+            mapfile format.
+            """
+        tmp_path = '%s.tmp' % path
+        fh = open(tmp_path, 'wb')
+        try:
+            for git, hg in self.db.execute(
+                    "SELECT DISTINCT git, hg FROM revisions ORDER BY hg, git"):
+                fh.write('%s %s\n' % (git, hg))
+        finally:
+            fh.close()
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
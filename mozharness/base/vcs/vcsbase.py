@@ -8,13 +8,15 @@
 """
 
 from copy import deepcopy
+from multiprocessing.pool import ThreadPool
 import os
 import sys
+import traceback
 
 sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(sys.path[0]))))
 
 from mozharness.base.errors import VCSException
-from mozharness.base.log import FATAL
+from mozharness.base.log import PrefixedLogger, ERROR, FATAL
 from mozharness.base.script import BaseScript
 from mozharness.base.vcs.mercurial import MercurialVCS
 from mozharness.base.vcs.hgtool import HgtoolVCS
@@ -51,8 +53,10 @@ class VCSMixin(object):
             self.rmtree(dest)
             raise
 
-    def vcs_checkout(self, vcs=None, error_level=FATAL, **kwargs):
-        """ Check out a single repo.
+    def _query_vcs_obj(self, vcs, kwargs, log_obj=None):
+        """Return a vcs_class object for checking out the repo described
+        by kwargs.  kwargs['dest'] and kwargs['vcs_share_base'] are filled
+        in if they're missing.
         """
         c = self.config
         if not vcs:
@@ -72,12 +76,17 @@ class VCSMixin(object):
             kwargs['dest'] = self.query_dest(kwargs)
         if 'vcs_share_base' not in kwargs:
             kwargs['vcs_share_base'] = c.get('%s_share_base' % vcs, c.get('vcs_share_base'))
-        vcs_obj = vcs_class(
-            log_obj=self.log_obj,
+        return vcs_class(
+            log_obj=log_obj or self.log_obj,
             config=self.config,
             vcs_config=kwargs,
             script_obj=self,
         )
+
+    def vcs_checkout(self, vcs=None, error_level=FATAL, **kwargs):
+        """ Check out a single repo.
+        """
+        vcs_obj = self._query_vcs_obj(vcs, kwargs)
         return self.retry(
             self._get_revision,
             error_level=error_level,
@@ -85,9 +94,39 @@ class VCSMixin(object):
             args=(vcs_obj, kwargs['dest']),
         )
 
+    def _vcs_checkout_worker(self, kwargs):
+        """ Check out a single repo from a vcs_checkout_repos() worker
+        thread.
+
+        Everything the checkout logs is prefixed with its dest.  Failures
+        are only logged at ERROR here, since a FATAL would just end the
+        worker thread; vcs_checkout_repos() escalates them afterwards.
+        Returns the revision, or -1 on failure.
+        """
+        dest = kwargs['dest']
+        log_obj = None
+        if self.log_obj:
+            log_obj = PrefixedLogger(self.log_obj, '[%s] ' % dest)
+        try:
+            vcs_obj = self._query_vcs_obj(kwargs.pop('vcs', None), kwargs,
+                                          log_obj=log_obj)
+            return vcs_obj.retry(
+                self._get_revision,
+                error_level=ERROR,
+                error_message="Automation Error: Can't checkout %s!" % kwargs['repo'],
+                args=(vcs_obj, dest),
+            )
+        except (Exception, SystemExit):
+            self.error("[%s] Exception while checking out %s: %s" %
+                       (dest, kwargs['repo'], traceback.format_exc()))
+            return -1
+
     def vcs_checkout_repos(self, repo_list, parent_dir=None,
                            tag_override=None, **kwargs):
         """Check out a list of repos.
+
+        If self.config['vcs_checkout_parallelism'] is more than 1, up to
+        that many repos are checked out at once, each with its own retries.
         """
         orig_dir = os.getcwd()
         c = self.config
@@ -96,6 +135,7 @@ class VCSMixin(object):
         self.mkdir_p(parent_dir)
         self.chdir(parent_dir)
         revision_dict = {}
+        checkouts = []
         kwargs_orig = deepcopy(kwargs)
         for repo_dict in repo_list:
             kwargs = deepcopy(kwargs_orig)
@@ -104,8 +144,34 @@ class VCSMixin(object):
                 kwargs['revision'] = tag_override
             dest = self.query_dest(kwargs)
             revision_dict[dest] = {'repo': kwargs['repo']}
-            revision_dict[dest]['revision'] = self.vcs_checkout(**kwargs)
-        self.chdir(orig_dir)
+            checkouts.append((dest, kwargs))
+        parallelism = c.get('vcs_checkout_parallelism', 1)
+        if parallelism > 1 and len(checkouts) > 1:
+            parallelism = min(parallelism, len(checkouts))
+            self.info("Checking out %d repos, %d at a time." %
+                      (len(checkouts), parallelism))
+            worker_args = []
+            for dest, kwargs in checkouts:
+                kwargs = deepcopy(kwargs)
+                kwargs['dest'] = dest
+                worker_args.append(kwargs)
+            worker_pool = ThreadPool(parallelism)
+            try:
+                revisions = worker_pool.map(self._vcs_checkout_worker,
+                                            worker_args)
+            finally:
+                worker_pool.close()
+                worker_pool.join()
+            self.chdir(orig_dir)
+            for (dest, kwargs), revision in zip(checkouts, revisions):
+                revision_dict[dest]['revision'] = revision
+                if revision == -1:
+                    self.log("Automation Error: Can't checkout %s!" % kwargs['repo'],
+                             level=kwargs.get('error_level', FATAL))
+        else:
+            for dest, kwargs in checkouts:
+                revision_dict[dest]['revision'] = self.vcs_checkout(**kwargs)
+            self.chdir(orig_dir)
         return revision_dict
 
 
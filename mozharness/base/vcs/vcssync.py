@@ -7,10 +7,22 @@
 """Generic VCS support.
 """
 
+from contextlib import contextmanager
 import os
 import smtplib
 import sys
+import threading
 import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
 
 sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.dirname(sys.path[0]))))
 
@@ -18,6 +30,200 @@ from mozharness.base.log import ERROR, INFO
 from mozharness.base.vcs.vcsbase import VCSScript
 
 
+# RepoUpdateStore {{{1
+class RepoUpdateStore(object):
+    """ A json file (e.g. repo_update.json) of {'repos': {repo_name: {...}}}
+        plus whatever top-level keys, where single repos can be updated
+        without rewriting the whole file.
+
+        update_repo() appends the repo's new entry to a journal next to the
+        json; reading replays the journal over the json, and cuts off a
+        last line left short by a crash so later entries aren't appended
+        to it.  write() rewrites the json atomically and empties the
+        journal, which also happens every max_journal_entries updates.
+        Writers are serialized with a lock file, as well as with
+        thread_lock (which should also guard changes to the dict read()
+        returns), and both re-read the files under the lock before
+        rewriting them, so updates from other processes aren't lost.
+
+        The journal and lock file go in state_dir, if the json's own dir
+        is e.g. uploaded.
+        """
+    def __init__(self, path, state_dir=None, thread_lock=None,
+                 max_journal_entries=100):
+        self.path = path
+        state_path = path
+        if state_dir:
+            state_path = os.path.join(state_dir, os.path.basename(path))
+        self.journal_path = '%s.journal' % state_path
+        self.lock_path = '%s.lock' % state_path
+        self.thread_lock = thread_lock or threading.RLock()
+        self.max_journal_entries = max_journal_entries
+        self.journal_entries = 0
+        self.lock_depth = 0
+        self.data = None
+        # What self.data was last in step with on disk, to tell our
+        # changes from other processes' in write().
+        self.base = None
+
+    @contextmanager
+    def lock(self):
+        with self.thread_lock:
+            if self.lock_depth:
+                # flock() locks aren't reentrant across file handles.
+                self.lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self.lock_depth -= 1
+                return
+            for path in (self.path, self.lock_path):
+                parent_dir = os.path.dirname(path)
+                if parent_dir and not os.path.isdir(parent_dir):
+                    os.makedirs(parent_dir)
+            fh = open(self.lock_path, 'a')
+            try:
+                if fcntl:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+                self.lock_depth = 1
+                yield
+            finally:
+                self.lock_depth = 0
+                if fcntl:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+                fh.close()
+
+    def _copy(self, data):
+        return json.loads(json.dumps(data))
+
+    def _load(self):
+        """ Return the json with the journal replayed over it, and how many
+            journal entries there were.  Call with the lock held.
+            """
+        data = {}
+        if os.path.exists(self.path):
+            fh = open(self.path, 'r')
+            try:
+                data = json.load(fh)
+            finally:
+                fh.close()
+        entries = 0
+        if os.path.exists(self.journal_path):
+            fh = open(self.journal_path, 'r+b')
+            try:
+                offset = 0
+                while True:
+                    line = fh.readline()
+                    if not line:
+                        break
+                    if not line.endswith('\n'):
+                        # Partially written before a crash.
+                        fh.truncate(offset)
+                        break
+                    offset += len(line)
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    data.setdefault('repos', {})[entry['repo']] = entry['status']
+                    entries += 1
+            finally:
+                fh.close()
+        return data, entries
+
+    def read(self):
+        """ Return the current contents.  This is read from disk once;
+            afterwards the same dict is returned, and changes to it are
+            saved with update_repo() and write().
+            """
+        with self.lock():
+            if self.data is None:
+                self.data, self.journal_entries = self._load()
+                self.base = self._copy(self.data)
+            return self.data
+
+    def update_repo(self, repo_name, status=None):
+        """ Record repo_name's entry (status, or what's in read()'s dict).
+            """
+        with self.lock():
+            data = self.read()
+            if status is None:
+                status = data.get('repos', {}).get(repo_name, {})
+            else:
+                data.setdefault('repos', {})[repo_name] = status
+            self.base.setdefault('repos', {})[repo_name] = self._copy(status)
+            if self.journal_entries >= self.max_journal_entries:
+                # Compact what's on disk, which may have other processes'
+                # updates that we haven't seen.
+                disk_data = self._load()[0]
+                disk_data.setdefault('repos', {})[repo_name] = status
+                self._replace(disk_data)
+                return
+            line = json.dumps({'repo': repo_name, 'status': status},
+                              sort_keys=True) + '\n'
+            fd = os.open(self.journal_path,
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            try:
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.journal_entries += 1
+
+    def write(self, data):
+        """ Save data and empty the journal.
+
+            data is merged with what's on disk: top-level keys and repos
+            that data changed since they were last read or saved are
+            taken from data, and the rest from disk, so entries other
+            processes saved meanwhile are kept.
+            """
+        with self.lock():
+            base = self.base or {}
+            merged = self._load()[0]
+            self._merge(merged, data, base, skip='repos')
+            repos = merged.get('repos', {})
+            self._merge(repos, data.get('repos', {}), base.get('repos', {}))
+            if repos:
+                merged['repos'] = repos
+            merged = self._copy(merged)
+            self._replace(merged)
+            if self.data is None:
+                self.data = data
+            self.data.clear()
+            self.data.update(merged)
+            self.base = self._copy(merged)
+
+    def _merge(self, merged, ours, base, skip=None):
+        for key in set(ours) | set(base):
+            if key == skip:
+                continue
+            if key not in ours:
+                # We deleted it.
+                merged.pop(key, None)
+            elif ours[key] != base.get(key):
+                merged[key] = ours[key]
+
+    def _replace(self, data):
+        """ Atomically replace the json with data, and empty the journal.
+            Call with the lock held.
+            """
+        tmp_path = '%s.tmp' % self.path
+        fh = open(tmp_path, 'w')
+        try:
+            fh.write(json.dumps(data, sort_keys=True, indent=4))
+            fh.flush()
+            os.fsync(fh.fileno())
+        finally:
+            fh.close()
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.journal_entries = 0
+
+
 # VCSSyncScript {{{1
 class VCSSyncScript(VCSScript):
     start_time = time.time()
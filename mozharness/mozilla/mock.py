@@ -7,16 +7,256 @@
 """Code to integrate with mock
 """
 
+import atexit
 import os.path
 import hashlib
+import pipes
+import re
+import select
+import shutil
+import signal
+import socket
+import struct
 import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import traceback
 import os
 
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+from mozharness.base.log import LogMixin
+
 ERROR_MSGS = {
     'undetermined_buildroot_lock': 'buildroot_lock_path does not exist.\
 Nothing to remove.'
 }
 
+# Where copy_mock_files() copies its tarball to, inside the chroot.
+MOCK_FILES_TARBALL = '/tmp/mozharness-mock-files.tar'
+
+# Runs one command in a MockSession: sends it the cwd and shell command
+# given as arguments, and relays the command's output and exit code.
+MOCK_SESSION_CLIENT_SCRIPT = """
+import socket, struct, sys
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+def read(f, size):
+    data = f.read(size)
+    if len(data) < size:
+        sys.stderr.write('Lost the mock session!\\n')
+        sys.exit(1)
+    return data
+
+s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+s.connect(sys.argv[1])
+request = json.dumps({'cwd': sys.argv[2] or None, 'command': sys.argv[3]})
+s.sendall(struct.pack('!I', len(request)) + request)
+f = s.makefile('rb')
+while True:
+    channel = read(f, 1)
+    data = read(f, struct.unpack('!I', read(f, 4))[0])
+    if channel == 'x':
+        sys.exit(int(data))
+    out = channel == 'o' and sys.stdout or sys.stderr
+    out.write(data)
+    out.flush()
+"""
+
+
+class MockSessionError(Exception):
+    pass
+
+
+# MockSession {{{1
+class MockSession(LogMixin, object):
+    """One long-lived unprivileged shell inside a mock chroot.
+
+    Entering mock costs about a second, so rather than running
+    `mock_mozilla --shell` per command, query_client_command() returns
+    a command that hands its shell command to this session's shell,
+    through a unix socket served by a thread in this process, and
+    relays the output and exit code back.  The client command can be
+    run with run_command() or get_output_from_command() as usual.
+
+    Commands run one at a time, each in a subshell, so cd and variables
+    don't leak between them.  The session runs in its own process group;
+    if a client goes away mid-command (e.g. killed for output_timeout),
+    that whole group is killed as soon as the client's socket closes,
+    and the next command starts a new session.
+    """
+    def __init__(self, mock_target, log_obj=None, config=None):
+        self.mock_target = mock_target
+        self.log_obj = log_obj
+        self.config = config or {}
+        self.token = '__MOZHARNESS_MOCK_%s__' % \
+            hashlib.sha1(os.urandom(16)).hexdigest()
+        marker = re.escape('\n' + self.token)
+        self.stdout_pattern = re.compile(marker + r':(\d+)\n')
+        self.stderr_pattern = re.compile(marker + r'\n')
+        self.shell = None
+        self.server = None
+        self.thread = None
+        self.tmp_dir = None
+        self.socket_path = None
+
+    def query_shell_command(self):
+        return ['mock_mozilla', '-r', self.mock_target, '-q', '--unpriv',
+                '--shell', '/bin/sh']
+
+    def start(self):
+        """Start serving clients; the shell is started by the first one."""
+        if self.server:
+            return
+        self.tmp_dir = tempfile.mkdtemp(prefix='mozharness-mock-')
+        self.socket_path = os.path.join(self.tmp_dir, 'session.sock')
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen(5)
+        self.thread = threading.Thread(target=self._serve,
+                                       name='MockSession')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def query_client_command(self, command, cwd=None):
+        """Return the command that runs shell command `command` in cwd
+        inside this session."""
+        self.start()
+        return [sys.executable, '-c', MOCK_SESSION_CLIENT_SCRIPT,
+                self.socket_path, cwd or '', command]
+
+    def stop(self):
+        if self.server:
+            try:
+                # Wakes up accept() in _serve().
+                self.server.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.server.close()
+            self.server = None
+            self.thread.join()
+            self.thread = None
+        self._stop_shell()
+        if self.tmp_dir:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            self.tmp_dir = None
+
+    def _start_shell(self):
+        command = self.query_shell_command()
+        self.info("Starting mock session: %s" %
+                  subprocess.list2cmdline(command))
+        self.shell = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE,
+                                      close_fds=True,
+                                      preexec_fn=os.setpgrp)
+
+    def _stop_shell(self, kill=False):
+        if not self.shell:
+            return
+        shell, self.shell = self.shell, None
+        if shell.poll() is None:
+            try:
+                if kill:
+                    # Take the command it's running along with it.
+                    os.killpg(shell.pid, signal.SIGKILL)
+                else:
+                    # sh exits when it runs out of commands.
+                    shell.stdin.close()
+            except (IOError, OSError):
+                pass
+        shell.wait()
+
+    def _serve(self):
+        while True:
+            try:
+                conn = self.server.accept()[0]
+            except (socket.error, AttributeError):
+                # stop() closed the server.
+                return
+            try:
+                try:
+                    self._handle(conn)
+                except Exception:
+                    self.warning("Mock session command failed; stopping the session: %s" %
+                                 traceback.format_exc())
+                    self._stop_shell(kill=True)
+            finally:
+                conn.close()
+
+    def _recv(self, conn, size):
+        data = ''
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                raise MockSessionError("Client went away")
+            data += chunk
+        return data
+
+    def _send(self, conn, channel, data):
+        if data:
+            conn.sendall(channel + struct.pack('!I', len(data)) + data)
+
+    def _handle(self, conn):
+        request = json.loads(self._recv(conn, struct.unpack('!I', self._recv(conn, 4))[0]))
+        if not self.shell or self.shell.poll() is not None:
+            try:
+                self._start_shell()
+            except OSError, e:
+                self._send(conn, 'e', "Can't start mock session: %s\n" % str(e))
+                self._send(conn, 'x', '1')
+                return
+        script = '( %s\n) </dev/null' % request['command']
+        if request['cwd']:
+            script = 'cd %s && %s' % (pipes.quote(request['cwd']), script)
+        script += "; printf '\\n%s:%%d\\n' $?; printf '\\n%s\\n' >&2\n" % \
+            (self.token, self.token)
+        self.shell.stdin.write(script)
+        self.shell.stdin.flush()
+        streams = {
+            self.shell.stdout.fileno(): ['o', self.stdout_pattern, ''],
+            self.shell.stderr.fileno(): ['e', self.stderr_pattern, ''],
+        }
+        # How much to hold back in case it's the start of a marker.
+        hold = len(self.token) + 16
+        returncode = None
+        while streams:
+            readable = select.select(streams.keys() + [conn], [], [])[0]
+            if conn in readable:
+                # The client sends nothing after its request, so this is
+                # it going away.
+                if not conn.recv(4096):
+                    raise MockSessionError("Client went away")
+                readable.remove(conn)
+            for fd in readable:
+                data = os.read(fd, 65536)
+                if not data:
+                    raise MockSessionError("The mock session exited")
+                channel, pattern, buf = streams[fd]
+                buf += data
+                match = pattern.search(buf)
+                if match:
+                    self._send(conn, channel, buf[:match.start()])
+                    if channel == 'o':
+                        returncode = match.group(1)
+                    del streams[fd]
+                    continue
+                end = buf.rfind('\n', max(0, len(buf) - hold))
+                if end == -1:
+                    end = len(buf)
+                self._send(conn, channel, buf[:end])
+                streams[fd][2] = buf[end:]
+        self._send(conn, 'x', returncode)
+
 
 
 # MockMixin {{{1
@@ -28,9 +268,11 @@ class MockMixin(object):
     """
     done_mock_setup = False
     mock_enabled = False
+    mock_session = None
 
     def init_mock(self, mock_target):
         "Initialize mock environment defined by `mock_target`"
+        self.stop_mock_session()
         cmd = ['mock_mozilla', '-r', mock_target, '--init']
         return super(MockMixin, self).run_command(cmd, halt_on_failure=True,
                                                   fatal_exit_code=3)
@@ -46,25 +288,52 @@ class MockMixin(object):
         """Delete files from the mock environment `mock_target`. `files` should
         be an iterable of 2-tuples: (src, dst). Only the dst component is
         deleted."""
-        cmd_base = ['mock_mozilla', '-r', mock_target, '--shell']
-        for src, dest in files:
-            cmd = cmd_base + ['rm -rf %s' % dest]
-            super(MockMixin, self).run_command(cmd, halt_on_failure=True,
-                                               fatal_exit_code=3)
+        dests = [dest for src, dest in files]
+        if not dests:
+            return
+        cmd = ['mock_mozilla', '-r', mock_target, '--shell',
+               'rm -rf %s' % ' '.join(dests)]
+        super(MockMixin, self).run_command(cmd, halt_on_failure=True,
+                                           fatal_exit_code=3)
 
     def copy_mock_files(self, mock_target, files):
         """Copy files into the mock environment `mock_target`. `files` should
-        be an iterable of 2-tuples: (src, dst)"""
-        cmd_base = ['mock_mozilla', '-r', mock_target, '--copyin', '--unpriv']
-        for src, dest in files:
-            cmd = cmd_base + [src, dest]
-            super(MockMixin, self).run_command(cmd, halt_on_failure=True,
-                                               fatal_exit_code=3)
+        be an iterable of 2-tuples: (src, dst)
+
+        The files are copied in as one tarball, and unpacked and chowned
+        with one more mock invocation, however many there are."""
+        files = list(files)
+        if not files:
+            return
+        fd, tarball = tempfile.mkstemp(suffix='.tar', prefix='mock-files-')
+        os.close(fd)
+        try:
+            tar = tarfile.open(tarball, 'w')
+            try:
+                for src, dest in files:
+                    # Like mock --copyin, follow src if it's a symlink.
+                    tar.add(os.path.realpath(src), arcname=dest.lstrip('/'))
+            finally:
+                tar.close()
+        except (IOError, OSError), e:
+            os.remove(tarball)
+            self.fatal("Can't pack %s for mock: %s" % (src, str(e)),
+                       exit_code=3)
+        try:
             super(MockMixin, self).run_command(
-                ['mock_mozilla', '-r', mock_target, '--shell',
-                 'chown -R mock_mozilla %s' % dest],
+                ['mock_mozilla', '-r', mock_target, '--copyin', '--unpriv',
+                 tarball, MOCK_FILES_TARBALL],
                 halt_on_failure=True,
                 fatal_exit_code=3)
+        finally:
+            os.remove(tarball)
+        super(MockMixin, self).run_command(
+            ['mock_mozilla', '-r', mock_target, '--shell',
+             'tar -C / -xf %s && rm -f %s && chown -R mock_mozilla %s' %
+             (MOCK_FILES_TARBALL, MOCK_FILES_TARBALL,
+              ' '.join([dest for src, dest in files]))],
+            halt_on_failure=True,
+            fatal_exit_code=3)
 
     def enable_mock(self):
         """Wrap self.run_command and self.get_output_from_command to run inside
@@ -84,17 +353,31 @@ class MockMixin(object):
         self.run_command = super(MockMixin, self).run_command
         self.get_output_from_command = super(MockMixin, self).get_output_from_command
 
+    def query_mock_session(self, mock_target):
+        """Return the MockSession for `mock_target` if
+        self.config['mock_persistent_session'] is set, otherwise None."""
+        if not self.config.get('mock_persistent_session'):
+            return None
+        if self.mock_session and self.mock_session.mock_target != mock_target:
+            self.stop_mock_session()
+        if not self.mock_session:
+            self.mock_session = MockSession(mock_target, log_obj=self.log_obj,
+                                            config=self.config)
+            atexit.register(self.mock_session.stop)
+        return self.mock_session
+
+    def stop_mock_session(self):
+        """Stop the persistent mock session, if there is one."""
+        if self.mock_session:
+            self.mock_session.stop()
+            self.mock_session = None
+
     def _do_mock_command(self, func, mock_target, command, cwd=None, env=None, **kwargs):
         """Internal helper for preparing commands to run under mock. Used by
-        run_mock_command and get_mock_output_from_command."""
-        cmd = ['mock_mozilla', '-r', mock_target, '-q']
-        if cwd:
-            cmd += ['--cwd', cwd]
-
-        if not kwargs.get('privileged'):
-            cmd += ['--unpriv']
-        cmd += ['--shell']
+        run_mock_command and get_mock_output_from_command.
 
+        Unprivileged commands go through the persistent mock session if
+        self.config['mock_persistent_session'] is set."""
         if not isinstance(command, basestring):
             command = subprocess.list2cmdline(command)
 
@@ -110,9 +393,20 @@ class MockMixin(object):
                     continue
                 value = value.replace(";", "\\;")
                 env_cmd += ['%s=%s' % (key, value)]
-            cmd.append(subprocess.list2cmdline(env_cmd) + " " + command)
+            command = subprocess.list2cmdline(env_cmd) + " " + command
+
+        session = None
+        if not kwargs.get('privileged'):
+            session = self.query_mock_session(mock_target)
+        if session:
+            cmd = session.query_client_command(command, cwd)
         else:
-            cmd.append(command)
+            cmd = ['mock_mozilla', '-r', mock_target, '-q']
+            if cwd:
+                cmd += ['--cwd', cwd]
+            if not kwargs.get('privileged'):
+                cmd += ['--unpriv']
+            cmd += ['--shell', command]
         return func(cmd, cwd=cwd, **kwargs)
 
     def run_mock_command(self, mock_target, command, cwd=None, env=None, **kwargs):
@@ -139,6 +433,7 @@ class MockMixin(object):
         buildroot_lock_path = os.path.join(c.get('mock_mozilla_dir', ''),
                                            mock_target,
                                            'buildroot.lock')
+        self.stop_mock_session()
         self.info("Removing buildroot lock at path if exists:O")
         self.info(buildroot_lock_path)
         if not os.path.exists(buildroot_lock_path):
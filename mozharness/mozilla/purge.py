@@ -60,6 +60,14 @@ class PurgeMixin(object):
         for s in skip:
             cmd.extend(['--not', s])
 
+        if c.get('purge_jobs'):
+            cmd.extend(['--jobs', str(c['purge_jobs'])])
+
+        # Let the deletion finish while the build runs; the space being
+        # freed counts towards min_size.
+        if c.get('purge_in_background'):
+            cmd.append('--background')
+
         cmd.extend(basedirs)
 
         # purge_builds.py can also clean up old shared hg repos if we set
@@ -97,6 +105,9 @@ class PurgeMixin(object):
         if periodic_clobber:
             cmd.extend(['-t', str(periodic_clobber)])
 
+        if c.get('background_clobber'):
+            cmd.append('--background')
+
         cmd.extend([clobberer_url, branch, buildername, builddir, slave, master])
         error_list = [{
             'substr': 'Error contacting server', 'level': ERROR,
@@ -130,7 +141,7 @@ class PurgeMixin(object):
                 if always_clobber_dirs is None:
                     always_clobber_dirs = []
                 for path in always_clobber_dirs:
-                    self.rmtree(path)
+                    self.rmtree(path, background=c.get('background_clobber'))
             # run purge_builds / check clobberer
             self.purge_builds()
         else:
@@ -200,28 +200,20 @@ You can set this by:
         dirs = self.query_abs_dirs()
         zipfile = self.download_file(url, parent_dir=dirs['abs_work_dir'],
                                      error_level=FATAL)
-        command = self.query_exe('unzip', return_type='list')
-        command.extend(['-q', '-o', zipfile])
-        self.run_command(command, cwd=parent_dir, halt_on_failure=True,
-                         fatal_exit_code=3, output_timeout=1760)
+        self.unzip(zipfile, parent_dir, error_level=FATAL, exit_code=3)
 
     def _extract_test_zip(self, target_unzip_dirs=None):
         dirs = self.query_abs_dirs()
-        unzip = self.query_exe("unzip")
         test_install_dir = dirs.get('abs_test_install_dir',
                                     os.path.join(dirs['abs_work_dir'], 'tests'))
-        self.mkdir_p(test_install_dir)
-        # adding overwrite flag otherwise subprocess.Popen hangs on waiting for
-        # input in a hidden pipe whenever this action is run twice without
-        # clobber
-        unzip_cmd = [unzip, '-q', '-o', self.test_zip_path]
-        if target_unzip_dirs:
-            unzip_cmd.extend(target_unzip_dirs)
-        # TODO error_list
-        # unzip return code 11 is 'no matching files were found'
-        self.run_command(unzip_cmd, cwd=test_install_dir,
-                         halt_on_failure=True, success_codes=[0, 11],
-                         fatal_exit_code=3)
+        # Only the members matching target_unzip_dirs are extracted.  On
+        # an unclobbered slave, the manifest lets us skip the files that
+        # haven't changed since the last run, and remove deleted ones.
+        manifest_path = os.path.join(test_install_dir,
+                                     '.tests_zip_manifest.json')
+        self.unzip(self.test_zip_path, test_install_dir,
+                   members=target_unzip_dirs, manifest_path=manifest_path,
+                   error_level=FATAL, exit_code=3)
 
     def _read_tree_config(self):
         """Reads an in-tree config file"""
@@ -274,8 +266,8 @@ You can set this by:
                                     error_level=FATAL)
         self.set_buildbot_property("symbols_url", self.symbols_url,
                                    write_to_file=True)
-        self.run_command(['unzip', '-q', source], cwd=self.symbols_path,
-                         halt_on_failure=True, fatal_exit_code=3)
+        self.unzip(source, self.symbols_path, error_level=FATAL,
+                   exit_code=3)
 
     def download_and_extract(self, target_unzip_dirs=None):
         """
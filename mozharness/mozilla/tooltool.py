@@ -1,5 +1,16 @@
+import hashlib
 import os
+import socket
+import urllib2
+from multiprocessing.pool import ThreadPool
 
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+from mozharness.base.cache import ContentCache
 from mozharness.base.errors import PythonErrorList
 from mozharness.base.log import ERROR, FATAL
 
@@ -7,6 +18,34 @@ TooltoolErrorList = PythonErrorList + [{
     'substr': 'ERROR - ', 'level': ERROR
 }]
 
+# How many files tooltool_fetch() fetches at once, by default.
+TOOLTOOL_JOBS = 4
+
+
+class TooltoolDigestError(Exception):
+    """A fetched file didn't match its manifest entry."""
+
+
+def parse_tooltool_manifest(manifest):
+    """Return the list of file entries in the tooltool manifest file
+    `manifest`.  Raises ValueError if it isn't a valid manifest.
+    """
+    fh = open(manifest)
+    try:
+        records = json.load(fh)
+    finally:
+        fh.close()
+    if not isinstance(records, list):
+        raise ValueError("%s isn't a list of files" % manifest)
+    for record in records:
+        for key in ('filename', 'size', 'algorithm', 'digest'):
+            if key not in record:
+                raise ValueError("%s: %s has no %s" % (manifest, record, key))
+        if os.path.basename(record['filename']) != record['filename']:
+            raise ValueError("%s: %s isn't a plain filename" %
+                             (manifest, record['filename']))
+    return records
+
 
 class TooltoolMixin(object):
     """Mixin class for handling tooltool manifests.
@@ -14,23 +53,32 @@ class TooltoolMixin(object):
     """
     def tooltool_fetch(self, manifest, bootstrap_cmd=None,
                        output_dir=None, privileged=False):
-        """docstring for tooltool_fetch"""
-        tooltool = self.query_exe('tooltool.py', return_type='list')
-        cmd = tooltool
-        for s in self.config['tooltool_servers']:
-            cmd.extend(['--url', s])
-        cmd.extend(['fetch', '-m', manifest, '-o'])
-        self.retry(
-            self.run_command,
-            args=(cmd, ),
-            kwargs={'cwd': output_dir,
-                    'error_list': TooltoolErrorList,
-                    'privileged': privileged,
-                    },
-            good_statuses=(0, ),
-            error_message="Tooltool %s fetch failed!" % manifest,
-            error_level=FATAL,
-        )
+        """Fetch the files in tooltool manifest `manifest` into output_dir,
+        then run bootstrap_cmd there.
+
+        If self.config['tooltool_cache_dir'] is set, the files are fetched
+        by mozharness itself (see _tooltool_fetch_native()); otherwise
+        tooltool.py fetches them.
+        """
+        if self.config.get('tooltool_cache_dir'):
+            self._tooltool_fetch_native(manifest, output_dir)
+        else:
+            tooltool = self.query_exe('tooltool.py', return_type='list')
+            cmd = tooltool
+            for s in self.config['tooltool_servers']:
+                cmd.extend(['--url', s])
+            cmd.extend(['fetch', '-m', manifest, '-o'])
+            self.retry(
+                self.run_command,
+                args=(cmd, ),
+                kwargs={'cwd': output_dir,
+                        'error_list': TooltoolErrorList,
+                        'privileged': privileged,
+                        },
+                good_statuses=(0, ),
+                error_message="Tooltool %s fetch failed!" % manifest,
+                error_level=FATAL,
+            )
         if bootstrap_cmd is not None:
             self.retry(
                 self.run_command,
@@ -44,6 +92,127 @@ class TooltoolMixin(object):
                 error_level=FATAL,
             )
 
+    def _tooltool_fetch_native(self, manifest, output_dir=None):
+        """Fetch the files in `manifest` into output_dir, up to
+        self.config['tooltool_jobs'] at a time.
+
+        sha512 files are kept in a ContentCache in
+        self.config['tooltool_cache_dir'], shared by every job on the
+        machine and bounded by self.config['tooltool_cache_size'] bytes,
+        and hardlinked into output_dir.  Missing ones are fetched from
+        each of self.config['tooltool_servers'] in turn, and their size
+        and digest are checked as they're downloaded.
+        """
+        output_dir = os.path.abspath(output_dir or os.getcwd())
+        try:
+            records = parse_tooltool_manifest(manifest)
+        except (IOError, ValueError), e:
+            self.fatal("Can't read tooltool manifest %s: %s" %
+                       (manifest, str(e)))
+        self.mkdir_p(output_dir, error_level=FATAL)
+        cache = ContentCache(self.config['tooltool_cache_dir'],
+                             max_size=self.config.get('tooltool_cache_size'),
+                             log_obj=self.log_obj, config=self.config)
+        if not records:
+            return
+        pool = ThreadPool(min(self.config.get('tooltool_jobs', TOOLTOOL_JOBS),
+                              len(records)))
+        try:
+            results = pool.map(
+                lambda record: self._fetch_tooltool_record(record, output_dir,
+                                                           cache),
+                records)
+        finally:
+            pool.close()
+            pool.join()
+        cache.evict()
+        failed = [r['filename'] for r, ok in zip(records, results) if not ok]
+        if failed:
+            self.fatal("Tooltool %s fetch failed for %s!" %
+                       (manifest, ', '.join(failed)))
+
+    def _fetch_tooltool_record(self, record, output_dir, cache):
+        """Fetch one manifest entry into output_dir.  Returns True on
+        success."""
+        dest = os.path.join(output_dir, record['filename'])
+        if record['algorithm'] != 'sha512':
+            # The cache is sha512-addressed; fetch these straight to dest.
+            tmp_file_name = dest + '.tmp'
+            if not self._retry_tooltool_download(record, tmp_file_name):
+                self.rmtree(tmp_file_name)
+                return False
+            self.move(tmp_file_name, dest)
+            return True
+        digest = record['digest']
+        # Jobs fetching the same file wait for each other.
+        with cache.lock(digest):
+            if cache.query_blob(digest):
+                self.info("Using cached %s (sha512 %s)" %
+                          (record['filename'], digest))
+            else:
+                tmp_file_name = cache.query_temp_path()
+                if not self._retry_tooltool_download(record, tmp_file_name):
+                    self.rmtree(tmp_file_name)
+                    return False
+                cache.add(tmp_file_name, digest=digest, verify=False)
+        return cache.materialize(digest, dest) is not None
+
+    def _retry_tooltool_download(self, record, file_name):
+        return self.retry(
+            self._download_tooltool_record,
+            args=(record, file_name),
+            good_statuses=(True, ),
+            failure_status=False,
+            error_message="Can't fetch %s from any tooltool server!" %
+                          record['filename'].replace('%', '%%'),
+            error_level=ERROR,
+        )
+
+    def _download_tooltool_record(self, record, file_name):
+        """Download `record` to file_name from the first of
+        self.config['tooltool_servers'] that has it intact.  Returns
+        True on success."""
+        for server in self.config['tooltool_servers']:
+            url = '%s/%s/%s' % (server.rstrip('/'), record['algorithm'],
+                                record['digest'])
+            try:
+                self._download_tooltool_file(url, record, file_name)
+            except (urllib2.URLError, socket.timeout, socket.error, IOError,
+                    ValueError, TooltoolDigestError), e:
+                self.warning("Can't fetch %s from %s: %s" %
+                             (record['filename'], url, str(e)))
+                continue
+            self.info("Fetched %s from %s" % (record['filename'], url))
+            return True
+        return False
+
+    def _download_tooltool_file(self, url, record, file_name):
+        """Stream url to file_name, checking its size and digest against
+        `record` as it's written.  Raises TooltoolDigestError if they
+        don't match."""
+        digest = hashlib.new(record['algorithm'])
+        size = 0
+        response = urllib2.urlopen(url, timeout=30)
+        try:
+            fh = open(file_name, 'wb')
+            try:
+                while True:
+                    block = response.read(1024 ** 2)
+                    if not block:
+                        break
+                    digest.update(block)
+                    size += len(block)
+                    fh.write(block)
+            finally:
+                fh.close()
+        finally:
+            response.close()
+        if size != record['size'] or digest.hexdigest() != record['digest']:
+            raise TooltoolDigestError(
+                "got %d bytes with %s %s, expected %d bytes with %s" %
+                (size, record['algorithm'], digest.hexdigest(),
+                 record['size'], record['digest']))
+
     def create_tooltool_manifest(self, contents, path=None):
         """ Currently just creates a manifest, given the contents.
         We may want a template and individual values in the future?
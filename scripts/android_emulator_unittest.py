@@ -654,6 +654,7 @@ class AndroidEmulatorTest(BlobUploadMixin, TestingMixin, TooltoolMixin, Emulator
                         error_list=self.error_list)
                     for line in output.splitlines():
                         parser.parse_single_line(line)
+                    parser.finish()
 
                     # After parsing each line we should know what the summary for this suite should be
                     tbpl_status, log_level = parser.evaluate_parser(return_code)
@@ -534,6 +534,7 @@ class DesktopSingleLocale(LocalesMixin, ReleaseMixin, MobileSigningMixin,
             parser = OutputParser(config=self.config, log_obj=self.log_obj,
                                   error_list=MakefileErrorList)
             parser.add_lines(output)
+            parser.finish()
             if parser.num_errors:
                 msg = "%s failed in make upload!" % (locale)
                 self.add_failure(locale, message=msg)
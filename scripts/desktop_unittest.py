@@ -16,6 +16,9 @@ import sys
 import copy
 import shutil
 import glob
+import multiprocessing
+import subprocess
+import time
 
 # load modules from parent dir
 sys.path.insert(1, os.path.dirname(sys.path[0]))
@@ -25,6 +28,7 @@ from mozharness.base.log import INFO, ERROR
 from mozharness.base.script import PreScriptAction
 from mozharness.base.vcs.vcsbase import MercurialScript
 from mozharness.mozilla.blob_upload import BlobUploadMixin, blobupload_config_options
+from mozharness.mozilla.buildbot import TBPL_WORST_LEVEL_TUPLE
 from mozharness.mozilla.mozbase import MozbaseMixin
 from mozharness.mozilla.testing.testbase import TestingMixin, testing_config_options
 from mozharness.mozilla.testing.unittest import DesktopUnittestOutputParser
@@ -374,51 +378,88 @@ class DesktopUnittest(TestingMixin, MercurialScript, BlobUploadMixin, MozbaseMix
         for f in files:
             self.move(f, abs_app_dir)
 
+    def _query_suite_cmd_and_env(self, suite_category, suite, suite_def,
+                                 abs_base_cmd, upload_dir):
+        """Return the command line and env to run suite with, with its
+        uploads and minidumps going to upload_dir."""
+        c = self.config
+        cmd = abs_base_cmd[:]
+        replace_dict = {
+            'abs_app_dir': self.query_abs_app_dir(),
+        }
+        options_list = []
+        env = {}
+        if isinstance(suite_def, dict):
+            options_list = suite_def['options']
+            # Only top-level string values are set below, so a shallow
+            # copy of the (possibly locked) env will do.
+            env = dict(suite_def['env'])
+        else:
+            options_list = suite_def
+
+        for arg in options_list:
+            cmd.append(arg % replace_dict)
+
+        if c.get('minidump_stackwalk_path'):
+            env['MINIDUMP_STACKWALK'] = c['minidump_stackwalk_path']
+        env['MOZ_UPLOAD_DIR'] = upload_dir
+        env['MINIDUMP_SAVE_PATH'] = upload_dir
+        if not os.path.isdir(env['MOZ_UPLOAD_DIR']):
+            self.mkdir_p(env['MOZ_UPLOAD_DIR'])
+        env = self.query_env(partial_env=env, log_level=INFO)
+        return cmd, env
+
+    def _query_suite_parser(self, suite_category):
+        error_list = BaseErrorList + [{
+            'regex': re.compile(r'''PROCESS-CRASH.*application crashed'''),
+            'level': ERROR,
+        }]
+        return DesktopUnittestOutputParser(suite_category,
+                                           config=self.config,
+                                           error_list=error_list,
+                                           log_obj=self.log_obj)
+
+    def _query_parallel_suite_limit(self, num_suites):
+        """How many suites to run at once: no more than
+        config['max_parallel_suites'] (the number of CPUs by default), or
+        than fit in available memory at config['parallel_suite_memory']
+        MB apiece."""
+        c = self.config
+        limit = min(num_suites,
+                    c.get('max_parallel_suites') or multiprocessing.cpu_count())
+        try:
+            # psutil comes from the virtualenv; see ResourceMonitoringMixin.
+            import psutil
+            available = psutil.virtual_memory().available
+        except (ImportError, AttributeError):
+            available = None
+        if available:
+            suite_memory = c.get('parallel_suite_memory', 1024) * 1024 * 1024
+            limit = min(limit, available // suite_memory)
+        return max(1, limit)
+
     def _run_category_suites(self, suite_category, preflight_run_method=None):
         """run suite(s) to a specific category"""
-        c = self.config
         dirs = self.query_abs_dirs()
         abs_base_cmd = self._query_abs_base_cmd(suite_category)
         suites = self._query_specified_suites(suite_category)
-        abs_app_dir = self.query_abs_app_dir()
 
         if preflight_run_method:
             preflight_run_method(suites)
         if suites:
             self.info('#### Running %s suites' % suite_category)
+            if len(suites) > 1 and \
+                    suite_category in self.config.get('parallel_suite_categories', []):
+                self._run_suites_in_parallel(suite_category, suites,
+                                             abs_base_cmd)
+                return
             for suite in suites:
-                cmd = abs_base_cmd[:]
-                replace_dict = {
-                    'abs_app_dir': abs_app_dir,
-                }
-                options_list = []
-                env = {}
-                if isinstance(suites[suite], dict):
-                    options_list = suites[suite]['options']
-                    env = copy.deepcopy(suites[suite]['env'])
-                else:
-                    options_list = suites[suite]
-
-                for arg in options_list:
-                    cmd.append(arg % replace_dict)
-
+                cmd, env = self._query_suite_cmd_and_env(
+                    suite_category, suite, suites[suite], abs_base_cmd,
+                    dirs['abs_blob_upload_dir'])
                 suite_name = suite_category + '-' + suite
                 tbpl_status, log_level = None, None
-                error_list = BaseErrorList + [{
-                    'regex': re.compile(r'''PROCESS-CRASH.*application crashed'''),
-                    'level': ERROR,
-                }]
-                parser = DesktopUnittestOutputParser(suite_category,
-                                                     config=self.config,
-                                                     error_list=error_list,
-                                                     log_obj=self.log_obj)
-                if c.get('minidump_stackwalk_path'):
-                    env['MINIDUMP_STACKWALK'] = c['minidump_stackwalk_path']
-                env['MOZ_UPLOAD_DIR'] = self.query_abs_dirs()['abs_blob_upload_dir']
-                env['MINIDUMP_SAVE_PATH'] = self.query_abs_dirs()['abs_blob_upload_dir']
-                if not os.path.isdir(env['MOZ_UPLOAD_DIR']):
-                    self.mkdir_p(env['MOZ_UPLOAD_DIR'])
-                env = self.query_env(partial_env=env, log_level=INFO)
+                parser = self._query_suite_parser(suite_category)
                 return_code = self.run_command(cmd, cwd=dirs['abs_work_dir'],
                                                output_timeout=1000,
                                                output_parser=parser,
@@ -441,6 +482,110 @@ class DesktopUnittest(TestingMixin, MercurialScript, BlobUploadMixin, MozbaseMix
         else:
             self.debug('There were no suites to run for %s' % suite_category)
 
+    def _run_suites_in_parallel(self, suite_category, suites, abs_base_cmd,
+                                output_timeout=1000):
+        """Run the suites of suite_category concurrently, for categories
+        listed in config['parallel_suite_categories'].
+
+        Each suite writes its output to its own file in abs_log_dir, and
+        its uploads to its own MOZ_UPLOAD_DIR; as each one finishes, its
+        output is run through its own parser into our log, and its uploads
+        are moved into abs_blob_upload_dir.  The worst status of all the
+        suites is reported, as in AndroidEmulatorTest.run_tests().
+        """
+        dirs = self.query_abs_dirs()
+        pending = list(suites)
+        running = []
+        limit = self._query_parallel_suite_limit(len(pending))
+        self.info("Running up to %d %s suites at once" % (limit, suite_category))
+        joint_tbpl_status = None
+        joint_log_level = None
+        while pending or running:
+            while pending and len(running) < limit:
+                suite = pending.pop(0)
+                suite_name = suite_category + '-' + suite
+                upload_dir = os.path.join(dirs['abs_blob_upload_dir'],
+                                          suite_name)
+                cmd, env = self._query_suite_cmd_and_env(
+                    suite_category, suite, suites[suite], abs_base_cmd,
+                    upload_dir)
+                output_file = os.path.join(dirs['abs_log_dir'],
+                                           '%s_output.log' % suite_name)
+                self.info("Starting %s: %s; output in %s" %
+                          (suite_name, subprocess.list2cmdline(cmd),
+                           output_file))
+                fh = open(output_file, 'w')
+                # In its own process group, so a timeout can kill the
+                # browser and whatever else the harness started too.
+                process = subprocess.Popen(cmd, cwd=dirs['abs_work_dir'],
+                                           env=env, stdout=fh,
+                                           stderr=subprocess.STDOUT,
+                                           **self.query_process_group_kwargs())
+                running.append({
+                    'suite': suite,
+                    'suite_name': suite_name,
+                    'process': process,
+                    'fh': fh,
+                    'output_file': output_file,
+                    'upload_dir': upload_dir,
+                    'output_size': 0,
+                    'last_output': time.time(),
+                })
+            time.sleep(1)
+            for p in running[:]:
+                return_code = p['process'].poll()
+                if return_code is None:
+                    output_size = os.path.getsize(p['output_file'])
+                    if output_size != p['output_size']:
+                        p['output_size'] = output_size
+                        p['last_output'] = time.time()
+                    elif time.time() - p['last_output'] > output_timeout:
+                        self.warning("%s timed out after %d seconds of no output; killing it." %
+                                     (p['suite_name'], output_timeout))
+                        self.kill_process_group(p['process'])
+                        # Don't kill it again every second until it's gone.
+                        p['last_output'] = time.time()
+                    continue
+                running.remove(p)
+                p['fh'].close()
+                tbpl_status, log_level = self._finish_parallel_suite(
+                    suite_category, p, return_code)
+                joint_tbpl_status = self.worst_level(tbpl_status,
+                                                     joint_tbpl_status,
+                                                     TBPL_WORST_LEVEL_TUPLE)
+                joint_log_level = self.worst_level(log_level, joint_log_level)
+        self.buildbot_status(joint_tbpl_status, level=joint_log_level)
+
+    def _finish_parallel_suite(self, suite_category, p, return_code):
+        """Parse a finished suite's output into our log, move its uploads
+        into abs_blob_upload_dir, and return its tbpl_status and log
+        level."""
+        dirs = self.query_abs_dirs()
+        self.info("##### %s log begins" % p['suite_name'])
+        parser = self._query_suite_parser(suite_category)
+        fh = open(p['output_file'])
+        try:
+            for line in fh:
+                parser.parse_single_line(line.rstrip())
+        finally:
+            fh.close()
+        parser.finish()
+        tbpl_status, log_level = parser.evaluate_parser(return_code)
+        parser.append_tinderboxprint_line(p['suite_name'])
+        self.info("##### %s log ends" % p['suite_name'])
+        self.log("The %s suite: %s ran with return status: %s" %
+                 (suite_category, p['suite'], tbpl_status), level=log_level)
+
+        # Blobber only uploads the top level of abs_blob_upload_dir.
+        for name in os.listdir(p['upload_dir']):
+            dest = os.path.join(dirs['abs_blob_upload_dir'], name)
+            if os.path.exists(dest):
+                dest = os.path.join(dirs['abs_blob_upload_dir'],
+                                    '%s-%s' % (p['suite_name'], name))
+            self.move(os.path.join(p['upload_dir'], name), dest)
+        self.rmtree(p['upload_dir'])
+        return tbpl_status, log_level
+
 
 # main {{{1
 if __name__ == '__main__':
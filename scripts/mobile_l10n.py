@@ -182,6 +182,7 @@ class MobileSingleLocale(MockMixin, LocalesMixin, ReleaseMixin,
         parser = OutputParser(config=self.config, log_obj=self.log_obj,
                               error_list=MakefileErrorList)
         parser.add_lines(output)
+        parser.finish()
         self.make_ident_output = output
         return output
 
@@ -228,6 +229,7 @@ class MobileSingleLocale(MockMixin, LocalesMixin, ReleaseMixin,
         parser = OutputParser(config=self.config, log_obj=self.log_obj,
                               error_list=MakefileErrorList)
         parser.add_lines(output)
+        parser.finish()
         return output.strip()
 
     def query_base_package_name(self):
@@ -453,6 +455,7 @@ class MobileSingleLocale(MockMixin, LocalesMixin, ReleaseMixin,
             parser = OutputParser(config=self.config, log_obj=self.log_obj,
                                   error_list=MakefileErrorList)
             parser.add_lines(output)
+            parser.finish()
             if parser.num_errors:
                 self.add_failure(locale, message="%s failed in make upload!" % (locale))
                 continue
@@ -11,18 +11,14 @@ type conversions, as well as many-to-many (l10n, build repos, etc.)
 """
 
 from copy import deepcopy
-import mmap
 import os
 import pprint
 import re
+import subprocess
 import sys
+import threading
 import time
-
-try:
-    import simplejson as json
-    assert json
-except ImportError:
-    import json
+from multiprocessing.pool import ThreadPool
 
 sys.path.insert(1, os.path.dirname(os.path.dirname(sys.path[0])))
 
@@ -35,8 +31,10 @@ external_tools_path = os.path.join(
 from mozharness.base.errors import HgErrorList, GitErrorList
 from mozharness.base.log import INFO, ERROR, FATAL
 from mozharness.base.python import VirtualenvMixin, virtualenv_config_options
+from mozharness.base.script import PreScriptAction
 from mozharness.base.transfer import TransferMixin
-from mozharness.base.vcs.vcssync import VCSSyncScript
+from mozharness.base.vcs.mapfile import MapfileIndex
+from mozharness.base.vcs.vcssync import RepoUpdateStore, VCSSyncScript
 from mozharness.mozilla.tooltool import TooltoolMixin
 
 
@@ -52,9 +50,10 @@ class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
         script with some changes.
         """
 
-    mapfile_binary_search = None
     all_repos = None
     successful_repos = []
+    ref_snapshots = {}
+    repo_update_store = None
     config_options = [
         [["--no-check-incoming"], {
             "action": "store_false",
@@ -93,6 +92,9 @@ class HgGitScript(VirtualenvMixin, TooltoolMixin, TransferMixin, VCSSyncScript):
             ],
             require_config_file=require_config_file
         )
+        # Guards repo_update.json and self.failures when repos are processed
+        # in parallel; see _for_each_repo().
+        self.repo_lock = threading.RLock()
 
     # Helper methods {{{1
     def query_abs_dirs(self):
@@ -294,6 +296,76 @@ intree=1
             self.all_repos += self._query_project_repos()
         return self.all_repos
 
+    def _for_each_repo(self, method, args=(), serialize_conversion_dirs=False):
+        """ Call method(repo_config, *args) for each repo that hasn't
+            failed, up to config['repo_parallelism'] repos at once (default 1),
+            so one slow repo doesn't hold up the rest.
+
+            With serialize_conversion_dirs, repos that share a conversion
+            dir are handled one after another in the same worker.
+
+            A fatal() stops the loop straight away when repos are handled
+            one at a time; otherwise it's re-raised once the other repos
+            are done.
+
+            Returns a list of (repo_config, return value) in repo order.
+            """
+        groups = []
+        conversion_dirs = {}
+        for repo_config in self.query_all_repos():
+            if self.query_failure(repo_config['repo_name']):
+                self.info("Skipping %s." % repo_config['repo_name'])
+                continue
+            if serialize_conversion_dirs:
+                conversion_dir = self.query_abs_conversion_dir(repo_config)
+                if conversion_dir in conversion_dirs:
+                    conversion_dirs[conversion_dir].append(repo_config)
+                    continue
+                conversion_dirs[conversion_dir] = [repo_config]
+                groups.append(conversion_dirs[conversion_dir])
+            else:
+                groups.append([repo_config])
+
+        def worker(group, catch_exit=True):
+            results = []
+            for repo_config in group:
+                try:
+                    results.append((repo_config,
+                                    method(repo_config, *args), None))
+                except SystemExit, e:
+                    if not catch_exit:
+                        raise
+                    # fatal() in a worker thread; re-raise it in the main
+                    # thread once the other repos are done.
+                    results.append((repo_config, None, e))
+                    break
+            return results
+
+        parallelism = min(self.config.get('repo_parallelism', 1), len(groups))
+        if parallelism > 1:
+            self.info("Processing %d repos, %d at a time." %
+                      (sum([len(g) for g in groups]), parallelism))
+            pool = ThreadPool(parallelism)
+            try:
+                group_results = pool.map(worker, groups)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            group_results = [worker(group, catch_exit=False)
+                             for group in groups]
+        results = []
+        for group_result in group_results:
+            results.extend(group_result)
+        for repo_config, value, exception in results:
+            if exception is not None:
+                raise exception
+        return [(repo_config, value) for (repo_config, value, _) in results]
+
+    def add_failure(self, key, *args, **kwargs):
+        with self.repo_lock:
+            super(HgGitScript, self).add_failure(key, *args, **kwargs)
+
     def _query_repo_previous_status(self, repo_name, repo_map=None):
         """ Return False if previous run was unsuccessful.
             Return None if no previous run information.
@@ -305,11 +377,13 @@ intree=1
     def _update_repo_previous_status(self, repo_name, successful_flag, repo_map=None, write_update=False):
         """ Set the repo_name to successful_flag (False for unsuccessful, True for successful)
             """
-        if repo_map is None:
-            repo_map = self._read_repo_update_json()
-        repo_map.setdefault('repos', {}).setdefault(repo_name, {})['previous_push_successful'] = successful_flag
-        if write_update:
-            self._write_repo_update_json(repo_map)
+        with self.repo_lock:
+            if repo_map is None:
+                repo_map = self._read_repo_update_json()
+            repo_map.setdefault('repos', {}).setdefault(repo_name, {})['previous_push_successful'] = successful_flag
+            if write_update:
+                self._query_repo_update_store().update_repo(
+                    repo_name, repo_map['repos'][repo_name])
         return repo_map
 
     def _update_stage_repo(self, repo_config, retry=True, clobber=False):
@@ -403,28 +477,103 @@ intree=1
 #            else:
 #                self.fatal("Can't verify %s!" % source_dest)
 
-    def _do_push_repo(self, base_command, refs_list=None, kwargs=None):
+    def _query_git_refs(self, command, cwd, env=None):
+        """ Run command (|git for-each-ref| or |git ls-remote|) and return a
+            dict of ref names to shas, or None if it fails.
+            """
+        try:
+            output = self.get_output_from_command(command, cwd=cwd, env=env,
+                                                  silent=True,
+                                                  throw_exception=True)
+        except subprocess.CalledProcessError:
+            return None
+        refs = {}
+        for line in (output or '').splitlines():
+            fields = line.split()
+            if len(fields) == 2:
+                refs[fields[1]] = fields[0]
+        return refs
+
+    def _query_changed_refs(self, remote, refs_list, kwargs):
+        """ Return the refspecs in refs_list whose source ref differs from
+            (or is missing from) the destination ref on remote.  If we can't
+            tell, all of refs_list is returned.
+            """
+        git = self.query_exe('git', return_type='list')
+        env = self.query_env(partial_env=kwargs.get('partial_env'))
+        local_refs = self._query_git_refs(
+            git + ['for-each-ref', '--format=%(objectname) %(refname)'],
+            cwd=kwargs.get('cwd'),
+        )
+        remote_refs = self._query_git_refs(
+            git + ['ls-remote', remote], cwd=kwargs.get('cwd'), env=env,
+        )
+        if local_refs is None or remote_refs is None:
+            self.warning("Can't compare refs with %s; pushing all of them." % remote)
+            return refs_list
+        changed_refs = []
+        for refspec in refs_list:
+            src, dest = refspec.lstrip('+').split(':', 1)
+            if src not in local_refs or remote_refs.get(dest) != local_refs[src]:
+                changed_refs.append(refspec)
+        return changed_refs
+
+    def _push_refs(self, base_command, refs_list, kwargs):
+        """ Push refs_list in one |git push|, with retry.  If some refs
+            were rejected, split it in half and push each half, down to
+            single refs, which get the full retry() treatment.  Returns -1
+            on failure.
+
+            git push exits 1 when refs were rejected, and 128 when it
+            couldn't talk to the remote at all; the latter is only retried,
+            since splitting up the push wouldn't help.
+            """
+        command = base_command + refs_list
+        if len(refs_list) == 1:
+            if self.retry(self.run_command, args=(command, ), kwargs=kwargs):
+                return -1
+            return
+        status = self.retry(self.run_command, args=(command, ), kwargs=kwargs,
+                            good_statuses=(0, 1))
+        if not status:
+            return
+        if status != 1:
+            return -1
+        self.info("Some of %d refs were rejected; splitting them up." % len(refs_list))
+        middle = len(refs_list) // 2
+        status = None
+        for refs in (refs_list[:middle], refs_list[middle:]):
+            if self._push_refs(base_command, refs, kwargs):
+                status = -1
+        return status
+
+    def _do_push_repo(self, base_command, refs_list=None, kwargs=None,
+                      remote=None):
         """ Helper method for _push_repo() since it has to be able to break
             out of the target_repo list loop, and the commands loop borks that.
+
+            If remote is given, only the refs in refs_list that don't already
+            match remote are pushed.
             """
-        commands = []
-        if refs_list:
-            while len(refs_list) > 10:
-                commands.append(base_command + refs_list[0:10])
-                refs_list = refs_list[10:]
-            commands.append(base_command + refs_list)
-        else:
-            commands = [base_command]
         if kwargs is None:
             kwargs = {}
-        for command in commands:
+        if not refs_list:
             # Do the push, with retry!
             if self.retry(
                 self.run_command,
-                args=(command, ),
+                args=(base_command, ),
                 kwargs=kwargs,
             ):
                 return -1
+            return
+        if remote:
+            changed_refs = self._query_changed_refs(remote, refs_list, kwargs)
+            self.info("%d of %d refs need pushing to %s." %
+                      (len(changed_refs), len(refs_list), remote))
+            refs_list = changed_refs
+            if not refs_list:
+                return
+        return self._push_refs(base_command, refs_list, kwargs)
 
     def _push_repo(self, repo_config):
         """ Push a repo to a path ("test_push") or remote server.
@@ -460,12 +609,13 @@ intree=1
                 if force_push:
                     base_command.append("-f")
                 if test_push:
-                    base_command.append(target_name)
+                    remote = target_name
                 else:
-                    base_command.append(remote_config['repo'])
+                    remote = remote_config['repo']
                     # Allow for using a custom git ssh key.
                     env['GIT_SSH_KEY'] = remote_config['ssh_key']
                     env['GIT_SSH'] = os.path.join(external_tools_path, 'git-ssh-wrapper.sh')
+                base_command.append(remote)
                 # Allow for pushing a subset of repo branches to the target.
                 # If we specify that subset, we can also specify different
                 # names for those branches (e.g. b2g18 -> master for a
@@ -498,9 +648,7 @@ intree=1
                     for (tag, target_tag) in tag_config['tags'].items():
                         refs_list += ['+refs/tags/%s:refs/tags/%s' % (tag, target_tag)]
                 if tag_config.get('tag_regexes'):
-                    regex_list = []
-                    for regex in tag_config['tag_regexes']:
-                        regex_list.append(re.compile(regex))
+                    matcher = self._query_regex_matcher(tag_config['tag_regexes'])
                     tag_list = self.get_output_from_command(
                         hg + ['tags'],
                         cwd=source_dir,
@@ -513,10 +661,8 @@ intree=1
                             self.warning("Bogus tag_line? %s" % str(tag_line))
                             continue
                         tag_name = tag_parts[0]
-                        for regex in regex_list:
-                            if tag_name != 'tip' and regex.search(tag_name) is not None:
-                                refs_list += ['+refs/tags/%s:refs/tags/%s' % (tag_name, tag_name)]
-                                continue
+                        if tag_name != 'tip' and matcher.search(tag_name) is not None:
+                            refs_list += ['+refs/tags/%s:refs/tags/%s' % (tag_name, tag_name)]
                 error_msg = "%s: Can't push %s to %s!\n" % (repo_config['repo_name'], conversion_dir, target_name)
                 if self._do_push_repo(
                     base_command,
@@ -526,7 +672,8 @@ intree=1
                         'cwd': os.path.join(conversion_dir, '.git'),
                         'error_list': GitErrorList,
                         'partial_env': env,
-                    }
+                    },
+                    remote=remote,
                 ):
                     if target_config.get("test_push"):
                         error_msg += "This was a test push that failed; not proceeding any further with %s!\n" % repo_config['repo_name']
@@ -542,24 +689,14 @@ intree=1
                 return_status += error_msg
         return return_status
 
-    def _query_mapped_revision(self, revision=None, mapfile=None):
-        """ Use the virtualenv mapper module to search a mapfile for a
-            revision.
+    def _query_mapfile_index(self, mapfile):
+        """ Return a MapfileIndex for mapfile, kept next to it and brought
+            up to date with whatever gexport has added since last time.
             """
-        if not callable(self.mapfile_binary_search):
-            site_packages_path = self.query_python_site_packages_path()
-            sys.path.append(os.path.join(site_packages_path, 'mapper'))
-            try:
-                from bsearch import mapfile_binary_search
-                global log
-                log = self.log_obj
-                self.mapfile_binary_search = mapfile_binary_search
-            except ImportError, e:
-                self.fatal("Can't import mapfile_binary_search! %s\nDid you create-virtualenv?" % str(e))
-        # I wish mapper did this for me, but ...
-        fd = open(mapfile, 'rb')
-        m = mmap.mmap(fd.fileno(), 0, mmap.MAP_PRIVATE, mmap.PROT_READ)
-        return self.mapfile_binary_search(m, revision)
+        index = MapfileIndex('%s.sqlite' % mapfile, log_obj=self.log_obj,
+                             config=self.config)
+        index.update(mapfile)
+        return index
 
     def _post_fatal(self, message=None, exit_code=None):
         """ After we call fatal(), run this method before exiting.
@@ -568,24 +705,31 @@ intree=1
             self.notify(message=message, fatal=True)
         self.copy_logs_to_upload_dir()
 
+    def _query_repo_update_store(self):
+        """ repo_update.json lives in the upload dir; its journal of
+            per-repo updates lives in the work dir.
+            """
+        if not self.repo_update_store:
+            dirs = self.query_abs_dirs()
+            self.repo_update_store = RepoUpdateStore(
+                os.path.join(dirs['abs_upload_dir'], 'repo_update.json'),
+                state_dir=dirs['abs_work_dir'],
+                thread_lock=self.repo_lock,
+            )
+        return self.repo_update_store
+
     def _read_repo_update_json(self):
         """ repo_update.json is a file we create with information about each
             repo we're converting: git/hg branch names, git/hg revisions,
             pull datetime/timestamp, and push datetime/timestamp.
 
             Since we want to be able to incrementally update portions of this
-            file as we pull/push each branch, we need to be able to read the
-            json into memory, so we can update the dict and re-write the json
-            to disk.
+            file as we pull/push each branch, this returns the in-memory
+            repo_map shared by every caller; per-repo changes are saved with
+            _update_repo_previous_status(..., write_update=True), and the
+            whole map with _write_repo_update_json().
             """
-        repo_map = {}
-        dirs = self.query_abs_dirs()
-        path = os.path.join(dirs['abs_upload_dir'], 'repo_update.json')
-        if os.path.exists(path):
-            fh = open(path, 'r')
-            repo_map = json.load(fh)
-            fh.close()
-        return repo_map
+        return self._query_repo_update_store().read()
 
     def query_abs_conversion_dir(self, repo_config):
         dirs = self.query_abs_dirs()
@@ -599,13 +743,7 @@ intree=1
     def _write_repo_update_json(self, repo_map):
         """ The write portion of _read_repo_update_json().
             """
-        dirs = self.query_abs_dirs()
-        contents = json.dumps(repo_map, sort_keys=True, indent=4)
-        self.write_to_file(
-            os.path.join(dirs['abs_upload_dir'], 'repo_update.json'),
-            contents,
-            create_parent_dir=True
-        )
+        self._query_repo_update_store().write(repo_map)
 
     def _query_hg_exe(self):
         """Returns the hg executable command as a list
@@ -620,6 +758,96 @@ intree=1
         exe_command.extend(hg_options)
         return exe_command
 
+    @PreScriptAction
+    def _clear_ref_snapshots(self, action):
+        """ Repos change between actions, so start each one with fresh
+            _query_refs() snapshots.
+            """
+        self.ref_snapshots = {}
+
+    def _query_refs(self, repo_path, vcs='hg'):
+        """ Return a snapshot of the branches and bookmarks of repo_path,
+            from |hg log| or |git for-each-ref|, cached for the rest of the
+            action:
+
+                {'branches': {name: revision}, 'active_branches': set([name]),
+                 'bookmarks': {name: revision}}
+
+            hg revisions are short hashes, like |hg id| prints; a branch's
+            revision is its tipmost open head, or its tipmost head if they're
+            all closed.  Like |hg branches -a|, a branch is active if one of
+            its open heads is also a head of the whole repo, i.e. it hasn't
+            been merged into another branch.  git branches have no revision,
+            and are all active.
+            """
+        if (vcs, repo_path) in self.ref_snapshots:
+            return self.ref_snapshots[(vcs, repo_path)]
+        refs = {'branches': {}, 'active_branches': set(), 'bookmarks': {}}
+        if vcs == 'hg':
+            hg = self._query_hg_exe()
+            output = self.get_output_from_command(
+                hg + ['log', '-r', 'heads(all())', '--template', '{rev}\\n'],
+                cwd=repo_path
+            )
+            repo_heads = set((output or '').split())
+            output = self.get_output_from_command(
+                hg + ['log', '-r', 'head()', '--template',
+                      '{rev}\\t{node|short}\\t{branch}\\t{extras}\\t{bookmarks}\\n'],
+                cwd=repo_path
+            )
+            tips = {}
+            for line in (output or '').splitlines():
+                fields = line.split('\t')
+                if len(fields) != 5:
+                    self.warning("Bogus |hg log| line? %s" % line)
+                    continue
+                rev, node, branch, extras, bookmarks = fields
+                is_open = 'close=1' not in extras.split()
+                # Prefer open heads, then higher revs.
+                key = (is_open, int(rev))
+                if branch not in tips or key > tips[branch][0]:
+                    tips[branch] = (key, node)
+                if is_open and rev in repo_heads:
+                    refs['active_branches'].add(branch)
+                for bookmark in bookmarks.split():
+                    refs['bookmarks'][bookmark] = node
+            for branch, (key, node) in tips.items():
+                refs['branches'][branch] = node
+        elif vcs == 'git':
+            git = self.query_exe("git", return_type="list")
+            output = self.get_output_from_command(
+                git + ['for-each-ref', '--format=%(refname:short)',
+                       'refs/heads/'],
+                cwd=repo_path
+            )
+            for branch in (output or '').split():
+                refs['branches'][branch] = None
+                refs['active_branches'].add(branch)
+        self.ref_snapshots[(vcs, repo_path)] = refs
+        return refs
+
+    def _query_hg_revision(self, name, repo_path):
+        """ Return the short hg revision that name (a bookmark or branch)
+            points to in repo_path, or None.  Falls back to |hg id| for
+            anything that isn't in the _query_refs() snapshot.
+            """
+        refs = self._query_refs(repo_path)
+        for ref_type in ('bookmarks', 'branches'):
+            if name in refs[ref_type]:
+                return refs[ref_type][name]
+        output = self.get_output_from_command(
+            self._query_hg_exe() + ['id', '-r', name],
+            cwd=repo_path
+        )
+        if output:
+            return output.split(' ')[0]
+
+    def _query_regex_matcher(self, regex_list):
+        """ Compile regex_list into a single regex that searches for any of
+            them.
+            """
+        return re.compile('|'.join(['(?:%s)' % regex for regex in regex_list]))
+
     def query_branches(self, branch_config, repo_path, vcs='hg'):
         """ Given a branch_config of branches and branch_regexes, return
             a dict of existing branch names to target branch names.
@@ -627,35 +855,12 @@ intree=1
         branch_map = {}
         if "branches" in branch_config:
             branch_map = deepcopy(branch_config['branches'])
-        if "branch_regexes" in branch_config:
-            regex_list = list(branch_config['branch_regexes'])
-            full_branch_list = []
-            if vcs == 'hg':
-                hg = self._query_hg_exe()
-                # This assumes we always want closed branches as well.
-                # If not we may need more options.
-                output = self.get_output_from_command(
-                    hg + ['branches', '-a'],
-                    cwd=repo_path
-                )
-                if output:
-                    for line in output.splitlines():
-                        full_branch_list.append(line.split()[0])
-            elif vcs == 'git':
-                git = self.query_exe("git", return_type="list")
-                output = self.get_output_from_command(
-                    git + ['branch', '-l'],
-                    cwd=repo_path
-                )
-                if output:
-                    for line in output.splitlines():
-                        full_branch_list.append(line.replace('*', '').split()[0])
-            for regex in regex_list:
-                for branch in full_branch_list:
-                    m = re.search(regex, branch)
-                    if m:
-                        # Don't overwrite branch_map[branch] if it exists
-                        branch_map.setdefault(branch, branch)
+        if branch_config.get("branch_regexes"):
+            matcher = self._query_regex_matcher(branch_config['branch_regexes'])
+            for branch in self._query_refs(repo_path, vcs=vcs)['active_branches']:
+                if matcher.search(branch):
+                    # Don't overwrite branch_map[branch] if it exists
+                    branch_map.setdefault(branch, branch)
         return branch_map
 
     def _combine_mapfiles(self, mapfiles, combined_mapfile, cwd=None):
@@ -675,25 +880,25 @@ intree=1
             else:
                 self.warning("%s doesn't exist!" % f_path)
         combined_mapfile_path = os.path.join(cwd, combined_mapfile)
+        # The index outlives the upload dir, so only new lines in each
+        # mapfile need to be read.
+        index_path = os.path.join(self.query_abs_dirs()['abs_work_dir'],
+                                  '%s.sqlite' % combined_mapfile)
+        index = MapfileIndex(index_path, log_obj=self.log_obj,
+                             config=self.config)
+        # Forget mapfiles that aren't combined any more, as if the combined
+        # mapfile were made from scratch.
+        changed = index.prune([os.path.join(cwd, f) for f in existing_mapfiles])
+        for f in existing_mapfiles:
+            changed += index.update(os.path.join(cwd, f))
         if os.path.exists(combined_mapfile_path):
-            combined_timestamp = os.path.getmtime(combined_mapfile_path)
-            for f in existing_mapfiles:
-                f_path = os.path.join(cwd, f)
-                if os.path.getmtime(f_path) > combined_timestamp:
-                    # Yes, we want to combine mapfiles
-                    break
-            else:
+            if not changed:
                 self.info("No new mapfiles to combine.")
+                index.close()
                 return
             self.move(combined_mapfile_path, "%s.old" % combined_mapfile_path)
-        output = self.get_output_from_command(
-            ['sort', '--unique', '-t', ' ',
-             '--key=2'] + existing_mapfiles,
-            silent=True, halt_on_failure=True,
-            cwd=cwd,
-        )
-        self.write_to_file(combined_mapfile_path, output, verbose=False,
-                           error_level=FATAL)
+        index.write_mapfile(combined_mapfile_path)
+        index.close()
         self.run_command(['ln', '-sf', combined_mapfile,
                           '%s-latest' % combined_mapfile],
                          cwd=cwd)
@@ -733,76 +938,75 @@ intree=1
             We pull the stage mirror into the work mirror, where the conversion
             is done.
             """
-        for repo_config in self.query_all_repos():
-            self._update_stage_repo(repo_config)
+        self._for_each_repo(self._update_stage_repo)
 
     def update_work_mirror(self):
         """ Pull the latest changes into the work mirror, update the repo_map
             json, and run |hg gexport| to convert those latest changes into
             the git conversion repo.
             """
-        hg = self._query_hg_exe()
-        git = self.query_exe("git", return_type="list")
-        dirs = self.query_abs_dirs()
         repo_map = self._read_repo_update_json()
         timestamp = int(time.time())
         datetime = time.strftime('%Y-%m-%d %H:%M %Z')
         repo_map['last_pull_timestamp'] = timestamp
         repo_map['last_pull_datetime'] = datetime
-        for repo_config in self.query_all_repos():
-            repo_name = repo_config['repo_name']
-            source = os.path.join(dirs['abs_source_dir'], repo_name)
-            dest = self.query_abs_conversion_dir(repo_config)
-            if not dest:
-                self.fatal("No conversion_dir for %s!" % repo_name)
-            if not os.path.exists(dest):
-#                self.run_command(hg + ["init", dest], halt_on_failure=True)
-#                self.run_command(hg + ['pull', source],
-#                                 cwd=os.path.dirname(dest))
-                self.mkdir_p(os.path.dirname(dest))
-                self.run_command(hg + ['clone', '--noupdate', source, dest],
-                                 error_list=HgErrorList,
-                                 halt_on_failure=True)
-                self.write_hggit_hgrc(dest)
-                self.init_git_repo('%s/.git' % dest, additional_args=['--bare'])
-                self.run_command(
-                    git + ['--git-dir', '%s/.git' % dest, 'config', 'gc.auto', '0'],
-                )
-            elif self.query_failure(repo_name):
-                self.info("Skipping %s." % repo_config['repo_name'])
-                continue
-            # Build branch map.
-            branch_map = self.query_branches(
-                repo_config.get('branch_config', {}),
-                source,
+        # Repos converted into the same dir share its hg and git repos.
+        self._for_each_repo(self._update_work_repo, args=(repo_map, ),
+                            serialize_conversion_dirs=True)
+        self._write_repo_update_json(repo_map)
+
+    def _update_work_repo(self, repo_config, repo_map):
+        """ update_work_mirror() for a single repo.
+            """
+        hg = self._query_hg_exe()
+        git = self.query_exe("git", return_type="list")
+        dirs = self.query_abs_dirs()
+        repo_name = repo_config['repo_name']
+        source = os.path.join(dirs['abs_source_dir'], repo_name)
+        dest = self.query_abs_conversion_dir(repo_config)
+        if not dest:
+            self.fatal("No conversion_dir for %s!" % repo_name)
+        if not os.path.exists(dest):
+#            self.run_command(hg + ["init", dest], halt_on_failure=True)
+#            self.run_command(hg + ['pull', source],
+#                             cwd=os.path.dirname(dest))
+            self.mkdir_p(os.path.dirname(dest))
+            self.run_command(hg + ['clone', '--noupdate', source, dest],
+                             error_list=HgErrorList,
+                             halt_on_failure=True)
+            self.write_hggit_hgrc(dest)
+            self.init_git_repo('%s/.git' % dest, additional_args=['--bare'])
+            self.run_command(
+                git + ['--git-dir', '%s/.git' % dest, 'config', 'gc.auto', '0'],
             )
-            for (branch, target_branch) in branch_map.items():
-                output = self.get_output_from_command(
-                    hg + ['id', '-r', branch],
-                    cwd=source
-                )
-                if output:
-                    rev = output.split(' ')[0]
-                else:
-                    self.fatal("Branch %s doesn't exist in %s!" % (branch, repo_name))
-                timestamp = int(time.time())
-                datetime = time.strftime('%Y-%m-%d %H:%M %Z')
-                if self.run_command(hg + ['pull', '-r', rev, source], cwd=dest,
-                                    error_list=HgErrorList):
-                    # We shouldn't have an issue pulling!
-                    self.add_failure(
-                        repo_name,
-                        message="Unable to pull %s from stage_source; clobbering and skipping!" % repo_name,
-                        level=ERROR,
-                    )
-                    self._update_repo_previous_status(repo_name, successful_flag=False, write_update=True)
-                    self.rmtree(source)
-                    break
-                self.run_command(
-                    hg + ['bookmark', '-f', '-r', rev, target_branch],
-                    cwd=dest, error_list=HgErrorList,
+        # Build branch map.
+        branch_map = self.query_branches(
+            repo_config.get('branch_config', {}),
+            source,
+        )
+        for (branch, target_branch) in branch_map.items():
+            rev = self._query_hg_revision(branch, source)
+            if not rev:
+                self.fatal("Branch %s doesn't exist in %s!" % (branch, repo_name))
+            timestamp = int(time.time())
+            datetime = time.strftime('%Y-%m-%d %H:%M %Z')
+            if self.run_command(hg + ['pull', '-r', rev, source], cwd=dest,
+                                error_list=HgErrorList):
+                # We shouldn't have an issue pulling!
+                self.add_failure(
+                    repo_name,
+                    message="Unable to pull %s from stage_source; clobbering and skipping!" % repo_name,
+                    level=ERROR,
                 )
-                # This might get a little large.
+                self._update_repo_previous_status(repo_name, successful_flag=False, write_update=True)
+                self.rmtree(source)
+                return
+            self.run_command(
+                hg + ['bookmark', '-f', '-r', rev, target_branch],
+                cwd=dest, error_list=HgErrorList,
+            )
+            # This might get a little large.
+            with self.repo_lock:
                 repo_map.setdefault('repos', {}).setdefault(repo_name, {}).setdefault('branches', {})[branch] = {
                     'hg_branch': branch,
                     'hg_revision': rev,
@@ -810,30 +1014,28 @@ intree=1
                     'pull_timestamp': timestamp,
                     'pull_datetime': datetime,
                 }
-            if self.query_failure(repo_name):
-                # We hit an error in the for loop above
-                continue
-            self.retry(
-                self.run_command,
-                args=(hg + ['-v', 'gexport'], ),
-                kwargs={
-                    'output_timeout': 15 * 60,
-                    'cwd': dest,
-                    'error_list': HgErrorList,
-                },
-                error_level=FATAL,
-            )
-            generated_mapfile = os.path.join(dest, '.hg', 'git-mapfile')
-            self.copy_to_upload_dir(
-                generated_mapfile,
-                dest=repo_config.get('mapfile_name', self.config.get('mapfile_name', "gecko-mapfile")),
-                log_level=INFO
-            )
-            for (branch, target_branch) in branch_map.items():
-                git_revision = self._query_mapped_revision(
-                    revision=rev, mapfile=generated_mapfile)
-                repo_map['repos'][repo_name]['branches'][branch]['git_revision'] = git_revision
-        self._write_repo_update_json(repo_map)
+        self.retry(
+            self.run_command,
+            args=(hg + ['-v', 'gexport'], ),
+            kwargs={
+                'output_timeout': 15 * 60,
+                'cwd': dest,
+                'error_list': HgErrorList,
+            },
+            error_level=FATAL,
+        )
+        generated_mapfile = os.path.join(dest, '.hg', 'git-mapfile')
+        self.copy_to_upload_dir(
+            generated_mapfile,
+            dest=repo_config.get('mapfile_name', self.config.get('mapfile_name', "gecko-mapfile")),
+            log_level=INFO
+        )
+        mapfile_index = self._query_mapfile_index(generated_mapfile)
+        for (branch, target_branch) in branch_map.items():
+            branch_info = repo_map['repos'][repo_name]['branches'][branch]
+            branch_info['git_revision'] = mapfile_index.query_git_revision(
+                branch_info['hg_revision'])
+        mapfile_index.close()
 
     def combine_mapfiles(self):
         """ This method is for any job (l10n, project-branches) that needs to combine
@@ -869,19 +1071,28 @@ intree=1
             """
         self.create_test_targets()
         repo_map = self._read_repo_update_json()
-        failure_msg = ""
         timestamp = int(time.time())
         datetime = time.strftime('%Y-%m-%d %H:%M %Z')
         repo_map['last_push_timestamp'] = timestamp
         repo_map['last_push_datetime'] = datetime
-        for repo_config in self.query_all_repos():
-            if self.query_failure(repo_config['repo_name']):
-                self.info("Skipping %s." % repo_config['repo_name'])
-                continue
-            timestamp = int(time.time())
-            datetime = time.strftime('%Y-%m-%d %H:%M %Z')
-            status = self._push_repo(repo_config)
-            repo_name = repo_config['repo_name']
+        results = self._for_each_repo(self._push_one_repo, args=(repo_map, ),
+                                      serialize_conversion_dirs=True)
+        failure_msg = ''.join([status for (repo_config, status) in results])
+        if not failure_msg:
+            repo_map['last_successful_push_timestamp'] = repo_map['last_push_timestamp']
+            repo_map['last_successful_push_datetime'] = repo_map['last_push_datetime']
+        self._write_repo_update_json(repo_map)
+        if failure_msg:
+            self.fatal("Unable to push these repos:\n%s" % failure_msg)
+
+    def _push_one_repo(self, repo_config, repo_map):
+        """ push() for a single repo.  Returns an error message, or ''.
+            """
+        timestamp = int(time.time())
+        datetime = time.strftime('%Y-%m-%d %H:%M %Z')
+        status = self._push_repo(repo_config)
+        repo_name = repo_config['repo_name']
+        with self.repo_lock:
             if not status:  # good
                 if repo_name not in self.successful_repos:
                     self.successful_repos.append(repo_name)
@@ -893,20 +1104,14 @@ intree=1
                 elif previous_status is False:
                     self.add_summary("Previously unsuccessful push of %s is now successful!" % repo_name)
                 self._update_repo_previous_status(repo_name, successful_flag=True, repo_map=repo_map, write_update=True)
-            else:
-                self.add_failure(
-                    repo_name,
-                    message="Unable to push %s." % repo_name,
-                    level=ERROR,
-                )
-                failure_msg += status + "\n"
-                self._update_repo_previous_status(repo_name, successful_flag=False, repo_map=repo_map, write_update=True)
-        if not failure_msg:
-            repo_map['last_successful_push_timestamp'] = repo_map['last_push_timestamp']
-            repo_map['last_successful_push_datetime'] = repo_map['last_push_datetime']
-        self._write_repo_update_json(repo_map)
-        if failure_msg:
-            self.fatal("Unable to push these repos:\n%s" % failure_msg)
+                return ''
+            self.add_failure(
+                repo_name,
+                message="Unable to push %s." % repo_name,
+                level=ERROR,
+            )
+            self._update_repo_previous_status(repo_name, successful_flag=False, repo_map=repo_map, write_update=True)
+        return status + "\n"
 
     def preflight_upload(self):
         if not self.config.get("copy_logs_post_run", True):
@@ -0,0 +1,69 @@
+import os
+import shutil
+import time
+import unittest
+
+from mozharness.base.cache import ContentCache, query_file_digest
+
+CACHE_DIR = 'test_cache'
+
+
+class TestContentCache(unittest.TestCase):
+    def setUp(self):
+        self.cleanup()
+        self.cache = ContentCache(CACHE_DIR)
+
+    def tearDown(self):
+        self.cleanup()
+
+    def cleanup(self):
+        for path in (CACHE_DIR, 'test_dir'):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+    def _add(self, contents):
+        path = self.cache.query_temp_path()
+        fh = open(path, 'wb')
+        fh.write(contents)
+        fh.close()
+        return self.cache.add(path)
+
+    def test_add(self):
+        digest = self._add('foo')
+        self.assertEqual(digest, query_file_digest(self.cache.query_blob(digest)))
+        self.assertEqual(len(digest), 128)
+
+    def test_add_wrong_digest(self):
+        path = self.cache.query_temp_path()
+        self.assertEqual(self.cache.add(path, digest='0' * 128), None)
+        self.assertTrue(os.path.exists(path))
+
+    def test_corrupt_blob(self):
+        digest = self._add('foo')
+        fh = open(self.cache.query_blob_path(digest), 'wb')
+        fh.write('bar')
+        fh.close()
+        self.assertEqual(self.cache.query_blob(digest), None)
+        self.assertFalse(os.path.exists(self.cache.query_blob_path(digest)))
+
+    def test_materialize(self):
+        digest = self._add('foo')
+        os.mkdir('test_dir')
+        dest = os.path.join('test_dir', 'foo')
+        self.assertEqual(self.cache.materialize(digest, dest), dest)
+        self.assertEqual(open(dest).read(), 'foo')
+        self.assertEqual(self.cache.materialize('0' * 128, dest), None)
+
+    def test_entries(self):
+        self.assertEqual(self.cache.query_entry('key'), None)
+        self.cache.set_entry('key', {'sha512': 'abc'})
+        self.assertEqual(self.cache.query_entry('key'), {'sha512': 'abc'})
+
+    def test_evict(self):
+        old_digest = self._add('a' * 10)
+        os.utime(self.cache.query_blob_path(old_digest),
+                 (time.time() - 60, time.time() - 60))
+        new_digest = self._add('b' * 10)
+        self.cache.evict(max_size=15)
+        self.assertFalse(os.path.exists(self.cache.query_blob_path(old_digest)))
+        self.assertTrue(os.path.exists(self.cache.query_blob_path(new_digest)))
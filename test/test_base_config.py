@@ -1,4 +1,8 @@
+import BaseHTTPServer
+import mock
 import os
+import shutil
+import threading
 import unittest
 
 JSON_TYPE = None
@@ -12,7 +16,7 @@ else:
     JSON_TYPE = 'simplejson'
 
 import mozharness.base.config as config
-from copy import deepcopy
+from copy import copy, deepcopy
 
 MH_DIR = os.path.dirname(os.path.dirname(__file__))
 
@@ -247,6 +251,54 @@ class TestReadOnlyDict(unittest.TestCase):
         c['e'] = 'hey'
         self.assertEqual(c['e'], 'hey', "can't set var in ROD after deepcopy")
 
+    def test_locked_deepcopy_nested_set(self):
+        r = self.get_locked_ROD()
+        c = deepcopy(r)
+        c['d']['turtles'].append('turtle2')
+        c['e'][2]['turtles'].append('turtle3')
+        self.assertEqual(c['d']['turtles'], ['turtle1', 'turtle2'])
+        self.assertEqual(c['e'][2]['turtles'], ['turtle1', 'turtle3'])
+        self.assertEqual(r['d']['turtles'], ('turtle1',),
+                         "deepcopy changes leaked into locked ROD")
+        self.assertEqual(r['e'][2]['turtles'], ('turtle1',),
+                         "deepcopy changes leaked into locked ROD")
+
+    def test_locked_deepcopy_dict_merge(self):
+        r = self.get_locked_ROD()
+        c = deepcopy(r)
+        merged = dict(c)
+        merged['d']['turtles'].append('turtle2')
+        merged['e'][2]['turtles'].append('turtle3')
+        self.assertEqual(r['d']['turtles'], ('turtle1',))
+
+        def kwargs(**kw):
+            return kw
+        kwargs(**c)['c']['d'] = '5'
+        self.assertEqual(r['c']['d'], '4')
+
+    def test_locked_deepcopy_of_copy(self):
+        r = self.get_locked_ROD()
+        c = deepcopy(r)
+        c['b'] = '3'
+        c2 = deepcopy(c)
+        c2['d']['turtles'].append('turtle2')
+        self.assertEqual(c2['b'], '3')
+        self.assertEqual(c['d']['turtles'], ['turtle1'])
+
+    def test_locked_copy(self):
+        r = self.get_locked_ROD()
+        self.assertTrue(copy(r) is r)
+        self.assertTrue(copy(r['e']) is r['e'])
+
+    def test_override(self):
+        r = self.get_locked_ROD()
+        o = r.override({'b': '3'}, e=['h'])
+        self.assertEqual(o['b'], '3')
+        self.assertEqual(o['e'], ('h',))
+        self.assertTrue(o['d'] is r['d'])
+        self.assertEqual(r['b'], '2')
+        self.assertRaises(AssertionError, o.update, {})
+
 
 class TestActions(unittest.TestCase):
     all_actions = ['a', 'b', 'c', 'd', 'e']
@@ -304,5 +356,88 @@ class TestActions(unittest.TestCase):
         self.assertEqual(['a', 'e'], c.get_actions(),
                          msg="--ACTION broken")
 
+class ConfigHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves config_contents with an ETag, and 304s revalidations."""
+    config_contents = 'config = {"from_url": 1}\n'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(self.config_contents)))
+        self.end_headers()
+        self.wfile.write(self.config_contents)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestConfigCache(unittest.TestCase):
+    cache_dir = 'test_config_cache'
+    config_file = os.path.join('test_dir', 'cached_config.py')
+
+    def setUp(self):
+        self.cleanup()
+        os.makedirs('test_dir')
+        self._write_config('config = {"cached": 1}\n')
+
+    def tearDown(self):
+        self.cleanup()
+
+    def cleanup(self):
+        for path in (self.cache_dir, 'test_dir'):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+    def _write_config(self, contents):
+        fh = open(self.config_file, 'w')
+        fh.write(contents)
+        fh.close()
+
+    def _get_config(self, config_file=None):
+        return config.BaseConfig(option_args=[
+            '--cfg', config_file or self.config_file,
+            '--config-cache-dir', self.cache_dir])
+
+    def test_config_cache_hit(self):
+        self.assertEqual(self._get_config()._config['cached'], 1)
+        with mock.patch.object(config.BaseConfig, 'get_cfgs_from_files') as m:
+            c = self._get_config()
+            self.assertFalse(m.called)
+        self.assertEqual(c._config['cached'], 1)
+        self.assertEqual(c.all_cfg_files_and_dicts,
+                         [(self.config_file, {'cached': 1})])
+
+    def test_config_cache_changed_file(self):
+        self._get_config()
+        self._write_config('config = {"cached": 2}\n')
+        self.assertEqual(self._get_config()._config['cached'], 2)
+
+    def test_config_cache_url(self):
+        ConfigHandler.requests = []
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), ConfigHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cwd = os.getcwd()
+        os.chdir('test_dir')
+        try:
+            url = 'http://127.0.0.1:%d/url_config.py' % server.server_address[1]
+            self.cache_dir = os.path.join(cwd, self.cache_dir)
+            self.assertEqual(self._get_config(url)._config['from_url'], 1)
+            os.remove('url_config.py')
+            self.assertEqual(self._get_config(url)._config['from_url'], 1)
+            self.assertTrue(os.path.exists('url_config.py'))
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+        self.assertEqual(ConfigHandler.requests, [None, '"v1"'])
+
+
 if __name__ == '__main__':
     unittest.main()
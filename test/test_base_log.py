@@ -1,9 +1,12 @@
 import os
+import re
 import shutil
 import subprocess
 import unittest
 
+import mozharness.base.errors as errors
 import mozharness.base.log as log
+from mozharness.base.log import INFO, WARNING, ERROR, IGNORE
 
 tmp_dir = "test_log_dir"
 log_name = "test"
@@ -38,5 +41,115 @@ class TestLog(unittest.TestCase):
         self.assertTrue(os.path.exists(get_log_file_path()))
         del(l)
 
+
+class TestErrorListMatcher(unittest.TestCase):
+    error_list = [
+        {'regex': re.compile(r'^Error: LOL J/K'), 'level': IGNORE},
+        {'substr': 'Error:', 'level': ERROR},
+        {'regex': re.compile(r'warning', re.I), 'level': WARNING},
+        {'regex': re.compile(r'(\w+) \1'), 'level': WARNING},
+    ]
+
+    def _first_match(self, error_list, line):
+        for index, error_check in enumerate(error_list):
+            if 'substr' in error_check:
+                if error_check['substr'] in line:
+                    return index
+            elif error_check['regex'].search(line):
+                return index
+
+    def test_first_match_wins(self):
+        matcher = log.get_error_list_matcher(self.error_list)
+        self.assertEqual(matcher.match('Error: LOL J/K'), 0)
+        self.assertEqual(matcher.match('an Error: here'), 1)
+        self.assertEqual(matcher.match('a WARNING here'), 2)
+        self.assertEqual(matcher.match('the the'), 3)
+        self.assertEqual(matcher.match('nothing to see'), None)
+
+    def test_matches_linear_scan(self):
+        error_list = errors.MakefileErrorList + errors.SSHErrorList + \
+            errors.HgErrorList
+        matcher = log.get_error_list_matcher(error_list)
+        lines = ['abort: push creates new remote head',
+                 'make[3]: *** [libs] Error 2',
+                 'foo.cpp:12: warning: unused variable',
+                 'rsync error: some files could not be transferred',
+                 'Warning: Identity file not accessible',
+                 'gcc -o foo.o -c foo.cpp',
+                 'make: *** No rule to make target `foo\'.  Stop.']
+        for line in lines:
+            self.assertEqual(matcher.match(line),
+                             self._first_match(error_list, line),
+                             msg=line)
+
+    def test_matcher_cached(self):
+        self.assertTrue(log.get_error_list_matcher(errors.HgErrorList) is
+                        log.get_error_list_matcher(list(errors.HgErrorList)))
+
+    def test_parser_levels(self):
+        parser = log.OutputParser(config={'log_to_console': False},
+                                  error_list=self.error_list)
+        parser.add_lines(['Error: LOL J/K', 'some output', 'Error: real'])
+        self.assertEqual(parser.num_errors, 1)
+        self.assertEqual(parser.worst_log_level, ERROR)
+        parser.add_lines('warning')
+        self.assertEqual(parser.num_warnings, 1)
+
+    def test_parser_no_error_list(self):
+        parser = log.OutputParser(config={'log_to_console': False})
+        parser.add_lines('Error: foo')
+        self.assertEqual(parser.num_errors, 0)
+        self.assertEqual(parser.worst_log_level, INFO)
+
+class RecordingOutputParser(log.OutputParser):
+    def __init__(self, **kwargs):
+        super(RecordingOutputParser, self).__init__(**kwargs)
+        self.logged = []
+
+    def log(self, message, level=INFO, exit_code=-1):
+        self.logged.append((message.strip(), level))
+
+
+class TestOutputParserContextLines(unittest.TestCase):
+    lines = ['one', 'two', 'three', 'boom', 'four', 'five', 'six']
+
+    def _parse(self, context_lines, lines=None):
+        parser = RecordingOutputParser(error_list=[
+            {'substr': 'boom', 'level': ERROR, 'context_lines': context_lines},
+            {'substr': 'meh', 'level': WARNING},
+        ])
+        parser.add_lines(lines or self.lines)
+        parser.finish()
+        return parser
+
+    def test_no_context(self):
+        parser = self._parse(None)
+        self.assertEqual([level for message, level in parser.logged],
+                         [INFO, INFO, INFO, ERROR, INFO, INFO, INFO])
+
+    def test_pre_and_post_context(self):
+        parser = self._parse('2:1')
+        self.assertEqual(parser.logged, [
+            ('one', INFO), ('two', ERROR), ('three', ERROR), ('boom', ERROR),
+            ('four', ERROR), ('five', INFO), ('six', INFO)])
+        self.assertEqual(parser.num_errors, 1)
+        self.assertEqual(parser.num_pre_context_lines, 2)
+
+    def test_post_only_context(self):
+        parser = self._parse(':2')
+        self.assertEqual([level for message, level in parser.logged],
+                         [INFO, INFO, INFO, ERROR, ERROR, ERROR, INFO])
+
+    def test_matched_lines_keep_level(self):
+        parser = self._parse('1:1', ['meh', 'boom', 'meh', 'ok'])
+        self.assertEqual(parser.logged, [
+            ('meh', WARNING), ('boom', ERROR), ('meh', WARNING), ('ok', INFO)])
+        self.assertEqual(parser.num_warnings, 2)
+
+    def test_pre_context_buffer_bounded(self):
+        parser = self._parse('2:', ['line %d' % i for i in range(100)])
+        self.assertEqual(len(parser.context_buffer), 0)
+        self.assertEqual(len(parser.logged), 100)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,19 @@
+import BaseHTTPServer
 import gc
+import glob
+import json
 import mock
 import os
 import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
 import types
 import unittest
+import urllib2
+import zipfile
 PYWIN32 = False
 if os.name == 'nt':
     try:
@@ -45,6 +55,14 @@ def get_debug_script_obj():
     return s
 
 
+def parse_metrics_file():
+    fh = open(os.path.join('test_logs', script.METRICS_FILE))
+    try:
+        return [json.loads(line) for line in fh]
+    finally:
+        fh.close()
+
+
 def _post_fatal(self, **kwargs):
     fh = open('tmpfile_stdout', 'w')
     print >>fh, test_string
@@ -163,6 +181,48 @@ class TestScript(unittest.TestCase):
                     "--dump-config does not equal self.config "
             )
 
+    def _get_metrics_script_obj(self):
+        return script.BaseScript(config={'metrics_file': script.METRICS_FILE},
+                                 initial_config_file='test/test.json')
+
+    def test_run_command_metrics(self):
+        self.s = self._get_metrics_script_obj()
+        self.s.run_command([sys.executable, '-c', 'print "foo"; print "bar"'])
+        record = self.s.metrics.query_records('command')[-1]
+        self.assertEqual(record['returncode'], 0)
+        self.assertEqual(record['output_lines'], 2)
+        self.assertEqual(record['output_bytes'], len('foo\nbar\n'))
+        self.assertEqual(record['errors'], 0)
+        self.assertTrue(record['wall'] >= 0)
+        if hasattr(os, 'wait4'):
+            self.assertTrue('user' in record and 'maxrss' in record)
+        self.assertEqual(parse_metrics_file()[-1]['command'], record['command'])
+
+    def test_get_output_metrics(self):
+        self.s = self._get_metrics_script_obj()
+        output = self.s.get_output_from_command(
+            [sys.executable, '-c', 'import sys; print "foo"; sys.exit(3)'])
+        self.assertEqual(output, 'foo')
+        record = self.s.metrics.query_records('command')[-1]
+        self.assertEqual(record['returncode'], 3)
+        self.assertEqual(record['output_lines'], 1)
+
+    def test_metrics_off_by_default(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.assertEqual(self.s.metrics, None)
+        self.assertEqual(self.s.run_command([sys.executable, '-c', 'pass']), 0)
+        self.assertFalse(os.path.exists(
+            os.path.join('test_logs', script.METRICS_FILE)))
+
+    @unittest.skipIf(os.name == "nt", "Not for Windows")
+    def test_run_command_killed_returncode(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        status = self.s.run_command(
+            [sys.executable, '-c', 'import os, signal; '
+             'os.kill(os.getpid(), signal.SIGTERM)'],
+            success_codes=[-15])
+        self.assertEqual(status, -15)
+
     def test_nonexistent_mkdir_p(self):
         self.s = script.BaseScript(initial_config_file='test/test.json')
         self.s.mkdir_p('test_dir/foo/bar/baz')
@@ -285,6 +345,128 @@ class TestHelperFunctions(unittest.TestCase):
         self.assertEqual(test_string, contents,
                          msg="get_output_from_command('cat file') differs from fh.write")
 
+    def test_download_file_cache(self):
+        self._create_temp_file()
+        self.s = script.BaseScript(config={'download_cache_dir': 'test_dir/cache'},
+                                   initial_config_file='test/test.json')
+        url = 'file://%s' % os.path.abspath(self.temp_file)
+        for name in ('first', 'second'):
+            path = self.s.download_file(url, file_name=name, parent_dir='test_dir')
+            self.assertEqual(path, os.path.join('test_dir', name))
+            self.assertEqual(open(path).read(), test_string)
+        self.assertEqual(len(os.listdir('test_dir/cache/blobs')), 1)
+        self.assertEqual(len(os.listdir('test_dir/cache/entries')), 1)
+
+    def _create_test_zip(self, members):
+        os.mkdir('test_dir')
+        bundle = zipfile.ZipFile('test_dir/test.zip', 'w', zipfile.ZIP_DEFLATED)
+        for name, contents in members.items():
+            info = zipfile.ZipInfo(name)
+            info.external_attr = 0755 << 16
+            bundle.writestr(info, contents)
+        bundle.close()
+
+    def test_unzip(self):
+        self._create_test_zip({'bin/xpcshell': test_string * 1000,
+                               'bin/components/': '',
+                               'mochitest/foo.html': 'foo',
+                               'reftest/bar.html': 'bar'})
+        self.s = script.BaseScript(config={'unzip_parallelism': 2},
+                                   initial_config_file='test/test.json')
+        self.assertEqual(self.s.unzip('test_dir/test.zip', 'test_dir/tests',
+                                      members=['bin/*', 'mochitest/*']), None)
+        self.assertEqual(open('test_dir/tests/bin/xpcshell').read(),
+                         test_string * 1000)
+        self.assertTrue(os.path.isdir('test_dir/tests/bin/components'))
+        self.assertTrue(os.access('test_dir/tests/bin/xpcshell', os.X_OK))
+        self.assertTrue(os.path.exists('test_dir/tests/mochitest/foo.html'))
+        self.assertFalse(os.path.exists('test_dir/tests/reftest'))
+
+    def test_unzip_skips_current_files(self):
+        self._create_test_zip({'a.txt': 'a', 'b.txt': 'b'})
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.s.unzip('test_dir/test.zip', 'test_dir/tests')
+        fh = open('test_dir/tests/b.txt', 'w')
+        fh.write('c')
+        fh.close()
+        with mock.patch.object(shutil, 'copyfileobj',
+                               side_effect=shutil.copyfileobj) as copy:
+            self.s.unzip('test_dir/test.zip', 'test_dir/tests')
+        self.assertEqual(copy.call_count, 1)
+        self.assertEqual(open('test_dir/tests/b.txt').read(), 'b')
+
+    def test_unzip_manifest(self):
+        self._create_test_zip({'a.txt': 'a', 'b.txt': 'b', 'old/c.txt': 'c'})
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        manifest_path = 'test_dir/tests/.manifest.json'
+        self.s.unzip('test_dir/test.zip', 'test_dir/tests',
+                     manifest_path=manifest_path)
+        self.assertEqual(sorted(self.s._query_zip_manifest(manifest_path)),
+                         ['a.txt', 'b.txt', 'old/c.txt'])
+        self.s.rmtree('test_dir/test.zip')
+        bundle = zipfile.ZipFile('test_dir/test.zip', 'w')
+        bundle.writestr('a.txt', 'a')
+        bundle.writestr('b.txt', 'bb')
+        bundle.close()
+        with mock.patch.object(self.s, '_zip_member_is_current') as is_current:
+            with mock.patch.object(shutil, 'copyfileobj',
+                                   side_effect=shutil.copyfileobj) as copy:
+                self.s.unzip('test_dir/test.zip', 'test_dir/tests',
+                             manifest_path=manifest_path)
+        self.assertFalse(is_current.called)
+        self.assertEqual(copy.call_count, 1)
+        self.assertEqual(open('test_dir/tests/b.txt').read(), 'bb')
+        self.assertFalse(os.path.exists('test_dir/tests/old'))
+        self.assertEqual(sorted(self.s._query_zip_manifest(manifest_path)),
+                         ['a.txt', 'b.txt'])
+
+    def test_unzip_no_match(self):
+        self._create_test_zip({'a.txt': 'a'})
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.assertEqual(self.s.unzip('test_dir/test.zip', 'test_dir/tests',
+                                      members=['bin/*']), None)
+
+    def test_unzip_bad_zip(self):
+        self._create_temp_file()
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.assertEqual(self.s.unzip(self.temp_file, 'test_dir/tests'), -1)
+
+    def test_get_output_from_command_max_lines(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        command = ["bash", "-c", "seq 1 10"]
+        self.assertEqual(self.s.get_output_from_command(command, max_output_lines=3),
+                         "1\n2\n3")
+        self.assertEqual(self.s.get_output_from_command(command, max_output_lines=3,
+                                                        keep_output='last'),
+                         "8\n9\n10")
+
+    def test_get_output_from_command_large_stderr(self):
+        self.s = get_debug_script_obj()
+        # Enough stderr to fill a pipe buffer before stdout is written.
+        command = ["bash", "-c", "head -c 200000 /dev/zero | tr '\\0' x >&2; echo done"]
+        contents = self.s.get_output_from_command(command)
+        self.assertEqual(contents, "done")
+        error_logsize = os.path.getsize("test_logs/test_error.log")
+        self.assertTrue(error_logsize > 0, msg="stderr not logged as errors")
+
+    def test_get_output_from_command_silent(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        contents = self.s.get_output_from_command(["bash", "-c", "echo foo"],
+                                                  silent=True)
+        self.assertEqual(contents, "foo\n")
+
+    def test_iter_output_from_command(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        lines = list(self.s.iter_output_from_command(["bash", "-c", "seq 1 3"]))
+        self.assertEqual(lines, ["1", "2", "3"])
+
+    def test_iter_output_from_command_throw_exception(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        output = self.s.iter_output_from_command(["bash", "-c", "echo foo; exit 3"],
+                                                 throw_exception=True)
+        self.assertEqual(output.next(), "foo")
+        self.assertRaises(subprocess.CalledProcessError, list, output)
+
     def test_run_command(self):
         self._create_temp_file()
         self.s = script.BaseScript(initial_config_file='test/test.json')
@@ -293,6 +475,55 @@ class TestHelperFunctions(unittest.TestCase):
                                             cwd="test_dir"), 0,
                          msg="run_command('cat file') did not exit 0")
 
+    def test_run_command_partial_last_line(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        parser = log.OutputParser(config=self.s.config,
+                                  error_list=[{'substr': 'bar', 'level': ERROR}])
+        self.s.run_command(["bash", "-c", "printf 'foo\\nbar'"],
+                           output_parser=parser)
+        self.assertEqual(parser.num_errors, 1)
+
+    def test_run_command_output_timeout(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        start = time.time()
+        status = self.s.run_command(["bash", "-c", "echo foo; sleep 30"],
+                                    output_timeout=1)
+        self.assertTrue(time.time() - start < 20,
+                        msg="output_timeout didn't kill the command")
+        self.assertNotEqual(status, 0)
+
+    @unittest.skipIf(os.name == "nt", "Not for Windows")
+    def test_run_command_timeout_kills_children(self):
+        self._create_temp_file()
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        pid_file = os.path.join('test_dir', 'grandchild.pid')
+        self.s.run_command(["bash", "-c",
+                            "sleep 30 & echo $! > %s; wait" % pid_file],
+                           output_timeout=1)
+        pid = int(open(pid_file).read())
+        # Dead, or a zombie waiting for init to reap it.
+        for i in range(50):
+            try:
+                stat = open('/proc/%d/stat' % pid).read()
+            except IOError:
+                break
+            if stat.split(') ')[1].startswith('Z'):
+                break
+            time.sleep(.1)
+        else:
+            os.kill(pid, 9)
+            self.fail("timeout didn't kill the command's children")
+
+    def test_run_command_timeout(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        start = time.time()
+        status = self.s.run_command(
+            ["bash", "-c", "while true; do echo foo; sleep 0.2; done"],
+            timeout=1)
+        self.assertTrue(time.time() - start < 20,
+                        msg="timeout didn't kill the command")
+        self.assertNotEqual(status, 0)
+
     def test_move1(self):
         self._create_temp_file()
         self.s = script.BaseScript(initial_config_file='test/test.json')
@@ -327,6 +558,21 @@ class TestHelperFunctions(unittest.TestCase):
         self.assertFalse(os.path.exists('test_dir'),
                          msg="rmtree unsuccessful")
 
+    def test_background_rmtree(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.s.mkdir_p('test_dir/foo/bar/baz')
+        self.s.write_to_file('test_dir/foo/bar/baz/file', 'contents')
+        status = self.s.rmtree('test_dir', background=True)
+        self.assertFalse(status, msg="background rmtree error")
+        self.assertFalse(os.path.exists('test_dir'),
+                         msg="background rmtree didn't move test_dir aside")
+        for _ in range(100):
+            if not glob.glob('test_dir.*.deleteme'):
+                break
+            time.sleep(.1)
+        self.assertEqual(glob.glob('test_dir.*.deleteme'), [],
+                         msg="background rmtree didn't remove the tombstone")
+
     def test_nonexistent_rmtree(self):
         self.s = script.BaseScript(initial_config_file='test/test.json')
         status = self.s.rmtree('test_dir')
@@ -390,6 +636,40 @@ class TestHelperFunctions(unittest.TestCase):
         script_env = self.s.query_env(partial_env={'PATH': partial_path})
         self.assertEqual(script_env['PATH'], full_path)
 
+    def test_env_partial_memoized(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        env1 = self.s.query_env(partial_env={'foo': 'bar'})
+        env1['baz'] = '1'
+        env2 = self.s.query_env(partial_env={'foo': 'bar'})
+        self.assertFalse(env1 is env2)
+        self.assertFalse('baz' in env2)
+        self.assertEqual(env2['foo'], 'bar')
+        self.assertEqual(len(self.s._env_overlays), 1)
+        env3 = self.s.query_env(partial_env={'foo': 'bar'}, purge_env=['foo'])
+        self.assertFalse('foo' in env3)
+        self.assertEqual(self.s.query_env(partial_env={'foo': 'bar'})['foo'],
+                         'bar')
+
+    def test_env_follows_environ(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        self.s.query_env(partial_env={})
+        with mock.patch.dict(os.environ, {'MH_TEST_ENV': 'x'}):
+            self.assertEqual(self.s.query_env(partial_env={})['MH_TEST_ENV'],
+                             'x')
+        self.assertFalse('MH_TEST_ENV' in self.s.query_env(partial_env={}))
+
+    def test_env_log_changes_only(self):
+        self.s = script.BaseScript(initial_config_file='test/test.json')
+        partial_env = {'foo': 'bar', 'LOCALE': '%(locale)s'}
+        self.s.query_env(partial_env=partial_env, replace_dict={'locale': 'de'})
+        with mock.patch.object(self.s, 'log') as log_mock:
+            self.s.query_env(partial_env=partial_env,
+                             replace_dict={'locale': 'fr'},
+                             log_changes_only=True)
+        messages = [c[0][0] for c in log_mock.call_args_list]
+        self.assertEqual(messages, ['ENV: LOCALE is now fr',
+                                    'ENV: 1 other variables are unchanged'])
+
     def test_query_exe(self):
         self.s = script.BaseScript(
             initial_config_file='test/test.json',
@@ -422,6 +702,119 @@ class TestHelperFunctions(unittest.TestCase):
         self.assertEqual(contents, None)
 
 
+# TestDownloadFile {{{1
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve server.body, honoring Range requests unless
+    server.ignore_ranges, and cutting the first server.truncate responses
+    short.
+    """
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond()
+
+    def _respond(self, send_body=True):
+        body = self.server.body
+        start, end = 0, len(body) - 1
+        range_header = self.headers.get('Range')
+        if send_body:
+            self.server.ranges.append(range_header)
+        status = 200
+        if range_header and not self.server.ignore_ranges and \
+                self.headers.get('If-Range', '"v1"') == '"v1"':
+            first, last = range_header[len('bytes='):].split('-')
+            start = int(first)
+            if last:
+                end = int(last)
+            status = 206
+        self.send_response(status)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (start, end, len(body)))
+        self.end_headers()
+        if send_body:
+            if self.server.truncate:
+                self.server.truncate -= 1
+                end = start + (end - start) // 2
+            self.wfile.write(body[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownloadFile(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        os.mkdir('test_dir')
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.body = ''.join([chr(i % 256) for i in range(100000)])
+        self.server.ignore_ranges = False
+        self.server.truncate = 0
+        self.server.ranges = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/tests.zip' % self.server.server_port
+        self.s = None
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.s:
+            del(self.s)
+        cleanup()
+
+    def _get_script(self, **kwargs):
+        return script.BaseScript(config=kwargs,
+                                 initial_config_file='test/test.json')
+
+    def test_resume(self):
+        self.s = self._get_script()
+        self.server.truncate = 1
+        file_name = 'test_dir/tests.zip'
+        self.assertRaises(urllib2.URLError, self.s._download_file,
+                          self.url, file_name)
+        self.assertTrue(os.path.exists(file_name + '.part'))
+        self.assertEqual(self.s._download_file(self.url, file_name), file_name)
+        self.assertEqual(open(file_name, 'rb').read(), self.server.body)
+        self.assertEqual(self.server.ranges, [None, 'bytes=50000-'])
+        self.assertEqual(os.listdir('test_dir'), ['tests.zip'])
+
+    def test_resume_ignored(self):
+        self.s = self._get_script()
+        self.server.truncate = 1
+        file_name = 'test_dir/tests.zip'
+        self.assertRaises(urllib2.URLError, self.s._download_file,
+                          self.url, file_name)
+        self.server.ignore_ranges = True
+        self.s._download_file(self.url, file_name)
+        self.assertEqual(open(file_name, 'rb').read(), self.server.body)
+
+    def test_segments(self):
+        self.s = self._get_script(download_segments=4,
+                                  download_segment_min_size=1)
+        self.server.truncate = 1
+        file_name = 'test_dir/tests.zip'
+        self.assertRaises(urllib2.URLError, self.s._download_file,
+                          self.url, file_name)
+        self.s._download_file(self.url, file_name)
+        self.assertEqual(open(file_name, 'rb').read(), self.server.body)
+        self.assertEqual(len([r for r in self.server.ranges if r]), 5)
+        self.assertEqual(os.listdir('test_dir'), ['tests.zip'])
+
+    def test_segments_ignored(self):
+        self.s = self._get_script(download_segments=4,
+                                  download_segment_min_size=1)
+        self.server.ignore_ranges = True
+        file_name = 'test_dir/tests.zip'
+        self.s._download_file(self.url, file_name)
+        self.assertEqual(open(file_name, 'rb').read(), self.server.body)
+
+
 # TestScriptLogging {{{1
 class TestScriptLogging(unittest.TestCase):
     # I need a log watcher helper function, here and in test_log.
@@ -687,6 +1080,33 @@ class BaseScriptWithDecorators(script.BaseScript):
             raise Exception(self.raise_during_build)
 
 
+class BaseScriptWithDependencies(script.BaseScript):
+    def __init__(self, **kwargs):
+        super(BaseScriptWithDependencies, self).__init__(
+            all_actions=['setup', 'fetch', 'compile', 'package'],
+            initial_config_file='test/test.json', **kwargs)
+        self.finished = []
+        self.compile_started = threading.Event()
+        self.fetch_saw_compile = False
+
+    def setup(self):
+        self.finished.append('setup')
+
+    @script.DependsOnActions('setup')
+    def fetch(self):
+        # Only returns True if compile runs alongside us.
+        self.fetch_saw_compile = self.compile_started.wait(10)
+        self.finished.append('fetch')
+
+    @script.DependsOnActions('setup')
+    def compile(self):
+        self.compile_started.set()
+        self.finished.append('compile')
+
+    def package(self):
+        self.finished.append('package')
+
+
 class TestScriptDecorators(unittest.TestCase):
     def setUp(self):
         cleanup()
@@ -740,6 +1160,44 @@ class TestScriptDecorators(unittest.TestCase):
 
         self.assertEqual(self.s.post_run_1_args[0], ((), {}))
 
+    def test_action_metrics(self):
+        self.s = BaseScriptWithDecorators(
+            config={'metrics_file': script.METRICS_FILE},
+            initial_config_file='test/test.json')
+        self.s.run()
+        records = self.s.metrics.query_records('action')
+        self.assertEqual([r['action'] for r in records], ['clobber', 'build'])
+        self.assertTrue(records[1]['success'])
+        self.assertEqual(records[1]['commands'], 0)
+        self.assertEqual(self.s.metrics.query_action('build'), records[1])
+        self.assertEqual(len(parse_metrics_file()), 2)
+
+    def test_action_dependencies(self):
+        self.s = BaseScriptWithDependencies()
+        self.assertEqual(self.s.query_action_dependencies(), {
+            'setup': set(),
+            'fetch': set(['setup']),
+            'compile': set(['setup']),
+            'package': set(['setup', 'fetch', 'compile']),
+        })
+
+    def test_parallel_actions(self):
+        self.s = BaseScriptWithDependencies(config={'max_parallel_actions': 2})
+        self.s.run()
+        self.assertTrue(self.s.fetch_saw_compile)
+        self.assertEqual(self.s.finished[0], 'setup')
+        self.assertEqual(self.s.finished[1:3], ['compile', 'fetch'])
+        self.assertEqual(self.s.finished[3], 'package')
+
+    def test_parallel_action_failure(self):
+        self.s = BaseScriptWithDecorators(initial_config_file='test/test.json',
+                                          config={'max_parallel_actions': 2})
+        self.s.raise_during_build = 'Testing parallel failure.'
+        with self.assertRaises(SystemExit):
+            self.s.run()
+        self.assertEqual(self.s.post_action_1_args[1][1], dict(success=False))
+        self.assertEqual(len(self.s.post_run_1_args), 1)
+
     def test_post_always_fired(self):
         self.s = BaseScriptWithDecorators(initial_config_file='test/test.json')
         self.s.raise_during_build = 'Testing post always fired.'
@@ -0,0 +1,64 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from mozharness.base.timeline import ResourceTimeline, query_resource_source
+
+TIMELINE_FILE = 'test_timeline.jsonl'
+
+
+@unittest.skipUnless(query_resource_source(), "Needs psutil or /proc")
+class TestResourceTimeline(unittest.TestCase):
+    def setUp(self):
+        self.cleanup()
+
+    def tearDown(self):
+        self.cleanup()
+
+    def cleanup(self):
+        if os.path.exists(TIMELINE_FILE):
+            os.remove(TIMELINE_FILE)
+
+    def _read_records(self):
+        fh = open(TIMELINE_FILE)
+        try:
+            return [json.loads(line) for line in fh]
+        finally:
+            fh.close()
+
+    def test_timeline(self):
+        timeline = ResourceTimeline(TIMELINE_FILE, interval=60)
+        self.assertTrue(timeline.start())
+        timeline.mark('action_start', action='build')
+        child = subprocess.Popen([sys.executable, '-c',
+                                  'import sys; sys.stdin.read()'],
+                                 stdin=subprocess.PIPE)
+        try:
+            timeline.sample()
+        finally:
+            child.communicate()
+        timeline.mark('action_end', action='build', success=True)
+        timeline.stop()
+        records = self._read_records()
+        self.assertEqual([r['type'] for r in records],
+                         ['start', 'action_start', 'sample', 'action_end',
+                          'end'])
+        self.assertEqual(records[0]['pid'], os.getpid())
+        self.assertEqual(records[1]['action'], 'build')
+        self.assertTrue(records[3]['success'])
+        procs = dict([(p[0], p) for p in records[2]['procs']])
+        self.assertTrue(os.getpid() in procs)
+        self.assertTrue(child.pid in procs)
+        self.assertEqual(procs[child.pid][1], os.getpid())
+        self.assertTrue(procs[child.pid][3] > 0)
+
+    def test_sampling_thread(self):
+        timeline = ResourceTimeline(TIMELINE_FILE, interval=.05)
+        timeline.start()
+        timeline.stop_event.wait(.3)
+        timeline.stop()
+        samples = [r for r in self._read_records() if r['type'] == 'sample']
+        self.assertTrue(samples)
+        self.assertTrue(all([r['mem'] > 0 for r in samples]))
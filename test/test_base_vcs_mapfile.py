@@ -0,0 +1,114 @@
+import os
+import shutil
+import sqlite3
+import unittest
+
+from mozharness.base.vcs.mapfile import MapfileIndex
+
+TEST_DIR = 'test_mapfile'
+MAPFILE = os.path.join(TEST_DIR, 'git-mapfile')
+INDEX = os.path.join(TEST_DIR, 'git-mapfile.sqlite')
+
+
+def write_mapfile(lines, mode='w'):
+    fh = open(MAPFILE, mode)
+    fh.write(''.join(['%s %s\n' % (git, hg) for git, hg in lines]))
+    fh.close()
+
+
+class TestMapfileIndex(unittest.TestCase):
+    def setUp(self):
+        self.tearDown()
+        os.mkdir(TEST_DIR)
+        self.index = MapfileIndex(INDEX)
+
+    def tearDown(self):
+        if hasattr(self, 'index'):
+            self.index.close()
+        if os.path.exists(TEST_DIR):
+            shutil.rmtree(TEST_DIR)
+
+    def test_lookups(self):
+        write_mapfile([('a' * 40, '1' * 40), ('b' * 40, '2' * 40)])
+        self.assertEqual(self.index.update(MAPFILE), 2)
+        self.assertEqual(self.index.query_git_revision('1' * 40), 'a' * 40)
+        self.assertEqual(self.index.query_git_revision('2' * 12), 'b' * 40)
+        self.assertEqual(self.index.query_hg_revision('a' * 40), '1' * 40)
+        self.assertEqual(self.index.query_git_revision('3' * 12), None)
+
+    def test_ambiguous_short_hash(self):
+        write_mapfile([('a' * 40, '12' + '0' * 38), ('b' * 40, '13' + '0' * 38)])
+        self.index.update(MAPFILE)
+        self.assertEqual(self.index.query_git_revision('1'), None)
+
+    def test_append(self):
+        write_mapfile([('a' * 40, '1' * 40)])
+        self.index.update(MAPFILE)
+        self.assertEqual(self.index.update(MAPFILE), 0)
+        write_mapfile([('b' * 40, '2' * 40)], mode='a')
+        self.assertEqual(self.index.update(MAPFILE), 1)
+        self.assertEqual(self.index.query_git_revision('2' * 40), 'b' * 40)
+
+    def test_rewrite(self):
+        write_mapfile([('b' * 40, '2' * 40)])
+        self.index.update(MAPFILE)
+        write_mapfile([('a' * 40, '1' * 40), ('c' * 40, '3' * 40)])
+        # Two new revisions, and one that's gone.
+        self.assertEqual(self.index.update(MAPFILE), 3)
+        self.assertEqual(self.index.query_git_revision('1' * 40), 'a' * 40)
+        self.assertEqual(self.index.query_git_revision('2' * 40), None)
+
+    def test_rewrite_changed_shas(self):
+        write_mapfile([('a' * 40, '1' * 40), ('b' * 40, '2' * 40)])
+        self.index.update(MAPFILE)
+        # The git repo was regenerated, so every git sha is new.
+        write_mapfile([('c' * 40, '1' * 40), ('d' * 40, '2' * 40),
+                       ('e' * 40, '3' * 40)])
+        self.assertEqual(self.index.update(MAPFILE), 3)
+        self.assertEqual(self.index.query_git_revision('1' * 40), 'c' * 40)
+        self.assertEqual(self.index.query_git_revision('2' * 40), 'd' * 40)
+        self.assertEqual(self.index.query_hg_revision('a' * 40), None)
+        self.assertEqual(self.index.query_hg_revision('d' * 40), '2' * 40)
+
+    def test_combined_mapfiles(self):
+        other = os.path.join(TEST_DIR, 'other-mapfile')
+        write_mapfile([('a' * 40, '1' * 40), ('b' * 40, '2' * 40)])
+        fh = open(other, 'w')
+        fh.write('%s %s\n%s %s\n' % ('b' * 40, '2' * 40, 'c' * 40, '3' * 40))
+        fh.close()
+        self.index.update(MAPFILE)
+        self.index.update(other)
+        combined = os.path.join(TEST_DIR, 'combined')
+        self.index.write_mapfile(combined)
+        self.assertEqual(len(open(combined).readlines()), 3)
+        # other is no longer combined; what only it had goes.
+        self.assertEqual(self.index.prune([MAPFILE]), 2)
+        self.assertEqual(self.index.query_git_revision('2' * 40), 'b' * 40)
+        self.assertEqual(self.index.query_git_revision('3' * 40), None)
+        self.index.write_mapfile(combined)
+        self.assertEqual(open(combined).read(), '%s %s\n%s %s\n' % (
+            'a' * 40, '1' * 40, 'b' * 40, '2' * 40))
+        # Combining it again reads all of it.
+        self.assertEqual(self.index.update(other), 2)
+
+    def test_old_index_rebuilt(self):
+        self.index.close()
+        os.remove(INDEX)
+        db = sqlite3.connect(INDEX)
+        db.executescript("""
+            CREATE TABLE revisions (hg TEXT PRIMARY KEY, git TEXT NOT NULL);
+            INSERT INTO revisions VALUES ('%s', '%s');
+        """ % ('9' * 40, 'f' * 40))
+        db.close()
+        self.index = MapfileIndex(INDEX)
+        self.assertEqual(self.index.query_git_revision('9' * 40), None)
+        write_mapfile([('a' * 40, '1' * 40)])
+        self.assertEqual(self.index.update(MAPFILE), 1)
+
+    def test_write_mapfile(self):
+        write_mapfile([('b' * 40, '2' * 40), ('a' * 40, '1' * 40)])
+        self.index.update(MAPFILE)
+        combined = os.path.join(TEST_DIR, 'combined')
+        self.index.write_mapfile(combined)
+        self.assertEqual(open(combined).read(), '%s %s\n%s %s\n' % (
+            'a' * 40, '1' * 40, 'b' * 40, '2' * 40))
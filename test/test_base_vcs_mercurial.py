@@ -6,6 +6,7 @@ import unittest
 
 import mozharness.base.errors as errors
 import mozharness.base.vcs.mercurial as mercurial
+import mozharness.base.vcs.vcsbase as vcsbase
 
 test_string = '''foo
 bar
@@ -73,6 +74,46 @@ class TestMakeAbsolute(unittest.TestCase):
             self.assertEquals(m._make_absolute("file://foo/bar"), "file://%s/foo/bar" % os.getcwd())
 
 
+class FakeVCS(mercurial.MercurialVCS):
+    def ensure_repo_and_revision(self):
+        if not os.path.exists(self.vcs_config['dest']):
+            os.makedirs(self.vcs_config['dest'])
+        self.info("Checked out %s" % self.vcs_config['repo'])
+        return 'rev-%s' % self.vcs_config['dest']
+
+
+class TestVCSCheckoutRepos(unittest.TestCase):
+    repo_list = [{'repo': 'http://hg.example.com/l10n/%s' % locale}
+                 for locale in ('de', 'fr', 'ja', 'pl')]
+
+    def setUp(self):
+        cleanup()
+        vcsbase.VCS_DICT['fake'] = FakeVCS
+
+    def tearDown(self):
+        del vcsbase.VCS_DICT['fake']
+        cleanup()
+
+    def _checkout(self, parallelism):
+        s = vcsbase.VCSScript(initial_config_file='test/test.json',
+                              config={'default_vcs': 'fake',
+                                      'vcs_checkout_parallelism': parallelism})
+        cwd = os.getcwd()
+        revisions = s.vcs_checkout_repos(self.repo_list,
+                                         parent_dir='test_dir')
+        self.assertEqual(os.getcwd(), cwd)
+        return revisions
+
+    def test_parallel_matches_serial(self):
+        serial = self._checkout(1)
+        parallel = self._checkout(3)
+        self.assertEqual(serial, parallel)
+        self.assertEqual(parallel['de'], {'repo': self.repo_list[0]['repo'],
+                                          'revision': 'rev-de'})
+        for locale in ('de', 'fr', 'ja', 'pl'):
+            self.assertTrue(os.path.isdir(os.path.join('test_dir', locale)))
+
+
 class TestHg(unittest.TestCase):
     def _init_hg_repo(self, hg_obj, repodir):
         hg_obj.run_command(["bash",
@@ -0,0 +1,104 @@
+import os
+import shutil
+import unittest
+
+try:
+    import simplejson as json
+    assert json
+except ImportError:
+    import json
+
+from mozharness.base.vcs.vcssync import RepoUpdateStore
+
+TEST_DIR = 'test_vcssync'
+JSON_PATH = os.path.join(TEST_DIR, 'upload', 'repo_update.json')
+STATE_DIR = os.path.join(TEST_DIR, 'work')
+
+
+def get_store(**kwargs):
+    return RepoUpdateStore(JSON_PATH, state_dir=STATE_DIR, **kwargs)
+
+
+class TestRepoUpdateStore(unittest.TestCase):
+    def setUp(self):
+        self.tearDown()
+
+    def tearDown(self):
+        if os.path.exists(TEST_DIR):
+            shutil.rmtree(TEST_DIR)
+
+    def test_update_repo(self):
+        store = get_store()
+        store.write({'last_pull_timestamp': 1, 'repos': {'a': {'x': 1}}})
+        store.update_repo('b', {'x': 2})
+        store.read()['repos']['a']['x'] = 3
+        store.update_repo('a')
+        # The json itself isn't rewritten...
+        self.assertEqual(json.load(open(JSON_PATH))['repos'], {'a': {'x': 1}})
+        # ...but a fresh store sees the updates.
+        self.assertEqual(get_store().read(), {
+            'last_pull_timestamp': 1,
+            'repos': {'a': {'x': 3}, 'b': {'x': 2}},
+        })
+
+    def test_truncated_journal(self):
+        store = get_store()
+        store.update_repo('a', {'x': 1})
+        fh = open(store.journal_path, 'a')
+        fh.write('{"repo": "b", "sta')
+        fh.close()
+        self.assertEqual(get_store().read(), {'repos': {'a': {'x': 1}}})
+
+    def test_truncated_journal_append(self):
+        store = get_store()
+        store.update_repo('a', {'x': 1})
+        fh = open(store.journal_path, 'a')
+        fh.write('{"repo": "b", "sta')
+        fh.close()
+        store = get_store()
+        store.read()
+        store.update_repo('c', {'x': 3})
+        self.assertEqual(get_store().read(),
+                         {'repos': {'a': {'x': 1}, 'c': {'x': 3}}})
+
+    def test_write_keeps_other_updates(self):
+        store = get_store()
+        store.write({'repos': {'a': {'x': 1}, 'b': {'x': 1}}})
+        other = get_store()
+        other.read()
+        other.update_repo('b', {'x': 2})
+        data = store.read()
+        data['repos']['a']['x'] = 3
+        data['last_push_timestamp'] = 4
+        store.write(data)
+        self.assertEqual(json.load(open(JSON_PATH)), {
+            'last_push_timestamp': 4,
+            'repos': {'a': {'x': 3}, 'b': {'x': 2}},
+        })
+        self.assertEqual(store.read()['repos']['b'], {'x': 2})
+
+    def test_compaction_keeps_other_updates(self):
+        store = get_store(max_journal_entries=1)
+        store.read()
+        other = get_store()
+        other.update_repo('b', {'x': 2})
+        store.update_repo('a', {'x': 1})
+        store.update_repo('a', {'x': 2})
+        self.assertFalse(os.path.exists(store.journal_path))
+        self.assertEqual(json.load(open(JSON_PATH)),
+                         {'repos': {'a': {'x': 2}, 'b': {'x': 2}}})
+
+    def test_write_empties_journal(self):
+        store = get_store()
+        store.update_repo('a', {'x': 1})
+        self.assertTrue(os.path.exists(store.journal_path))
+        store.write(store.read())
+        self.assertFalse(os.path.exists(store.journal_path))
+        self.assertEqual(json.load(open(JSON_PATH)), {'repos': {'a': {'x': 1}}})
+
+    def test_compaction(self):
+        store = get_store(max_journal_entries=2)
+        for i in range(3):
+            store.update_repo('a', {'x': i})
+        self.assertFalse(os.path.exists(store.journal_path))
+        self.assertEqual(json.load(open(JSON_PATH)), {'repos': {'a': {'x': 2}}})
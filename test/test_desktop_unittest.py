@@ -0,0 +1,132 @@
+import gc
+import imp
+import os
+import sys
+import time
+import unittest
+
+import mozharness.base.log as log
+from mozharness.base.log import ERROR
+import mozharness.base.script as script
+from mozharness.mozilla.buildbot import BuildbotMixin, TBPL_WARNING, \
+    TBPL_FAILURE
+
+MH_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+desktop_unittest = imp.load_source(
+    'desktop_unittest', os.path.join(MH_DIR, 'scripts', 'desktop_unittest.py'))
+DesktopUnittest = desktop_unittest.DesktopUnittest
+
+
+class CleanupObj(script.ScriptMixin, log.LogMixin):
+    def __init__(self):
+        super(CleanupObj, self).__init__()
+        self.log_obj = None
+        self.config = {'log_level': ERROR}
+
+
+def cleanup():
+    gc.collect()
+    c = CleanupObj()
+    for f in ('test_logs', 'test_dir'):
+        c.rmtree(f)
+
+
+class ParallelSuiteScript(BuildbotMixin, script.BaseScript):
+    """Just enough of DesktopUnittest to run its parallel suite runner,
+    with each suite definition being python code to run."""
+    _run_suites_in_parallel = DesktopUnittest.__dict__['_run_suites_in_parallel']
+    _finish_parallel_suite = DesktopUnittest.__dict__['_finish_parallel_suite']
+    _query_suite_parser = DesktopUnittest.__dict__['_query_suite_parser']
+    _query_parallel_suite_limit = DesktopUnittest.__dict__['_query_parallel_suite_limit']
+
+    def query_abs_dirs(self):
+        if self.abs_dirs:
+            return self.abs_dirs
+        abs_dirs = super(ParallelSuiteScript, self).query_abs_dirs()
+        abs_dirs['abs_blob_upload_dir'] = os.path.abspath(
+            os.path.join('test_dir', 'blobber'))
+        self.abs_dirs = abs_dirs
+        return self.abs_dirs
+
+    def _query_suite_cmd_and_env(self, suite_category, suite, suite_def,
+                                 abs_base_cmd, upload_dir):
+        self.mkdir_p(upload_dir)
+        return [sys.executable, '-c', suite_def], dict(os.environ,
+                                                       MOZ_UPLOAD_DIR=upload_dir)
+
+
+PASSING_SUITE = """
+import os
+open(os.path.join(os.environ['MOZ_UPLOAD_DIR'], 'report.txt'), 'w').close()
+print 'INFO | Passed: 5'
+print 'INFO | Failed: 0'
+"""
+FAILING_SUITE = """
+print 'INFO | Passed: 3'
+print 'INFO | Failed: 2'
+"""
+BROKEN_SUITE = """
+import sys
+print 'runtests.py: command not found'
+sys.exit(1)
+"""
+
+
+# TestParallelSuites {{{1
+class TestParallelSuites(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        os.makedirs(os.path.join('test_dir', 'build'))
+        os.makedirs(os.path.join('test_dir', 'test_logs'))
+        self.s = ParallelSuiteScript(
+            config={'max_parallel_suites': 3,
+                    'base_work_dir': os.path.abspath('test_dir')},
+            initial_config_file='test/test.json')
+
+    def tearDown(self):
+        del(self.s)
+        cleanup()
+
+    def test_parallel_suites_pass(self):
+        self.s._run_suites_in_parallel('xpcshell', {'a': PASSING_SUITE,
+                                                    'b': PASSING_SUITE}, [])
+        self.assertEqual(self.s.return_code, 0)
+        blobber_dir = self.s.query_abs_dirs()['abs_blob_upload_dir']
+        self.assertEqual(sorted(os.listdir(blobber_dir)),
+                         ['report.txt', 'xpcshell-b-report.txt'])
+
+    def test_parallel_suites_worst_status(self):
+        self.s._run_suites_in_parallel('xpcshell', {'a': PASSING_SUITE,
+                                                    'b': FAILING_SUITE}, [])
+        self.assertEqual(self.s.worst_buildbot_status, TBPL_WARNING)
+
+    def test_parallel_suites_failure(self):
+        self.s._run_suites_in_parallel('xpcshell', {'a': FAILING_SUITE,
+                                                    'b': BROKEN_SUITE}, [])
+        self.assertEqual(self.s.worst_buildbot_status, TBPL_FAILURE)
+
+    @unittest.skipIf(os.name == "nt", "Not for Windows")
+    def test_parallel_suite_timeout_kills_children(self):
+        pid_file = os.path.abspath(os.path.join('test_dir', 'child.pid'))
+        hanging_suite = """
+import subprocess
+child = subprocess.Popen(['sleep', '60'])
+open(%r, 'w').write(str(child.pid))
+child.wait()
+""" % pid_file
+        start = time.time()
+        self.s._run_suites_in_parallel('xpcshell', {'a': hanging_suite}, [],
+                                       output_timeout=2)
+        self.assertTrue(time.time() - start < 30)
+        pid = int(open(pid_file).read())
+        try:
+            stat = open('/proc/%d/stat' % pid).read()
+        except IOError:
+            return
+        if not stat.split(') ')[1].startswith('Z'):
+            os.kill(pid, 9)
+            self.fail("timeout didn't kill the suite's children")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import gc
+import mock
+import os
+import subprocess
+import time
+import unittest
+
+import mozharness.base.log as log
+from mozharness.base.log import ERROR
+import mozharness.base.script as script
+from mozharness.mozilla.mock import MockMixin, MockSession
+
+
+class CleanupObj(script.ScriptMixin, log.LogMixin):
+    def __init__(self):
+        super(CleanupObj, self).__init__()
+        self.log_obj = None
+        self.config = {'log_level': ERROR}
+
+
+def cleanup():
+    gc.collect()
+    c = CleanupObj()
+    for f in ('test_logs', 'test_dir', 'tmpfile_stdout', 'tmpfile_stderr'):
+        c.rmtree(f)
+
+
+class MockScript(MockMixin, script.BaseScript):
+    def __init__(self, **kwargs):
+        super(MockScript, self).__init__(**kwargs)
+
+
+# TestMockSession {{{1
+@unittest.skipIf(os.name == "nt", "mock is Linux only")
+class TestMockSession(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        os.mkdir('test_dir')
+        # Stand in for the chroot with a plain shell.
+        patcher = mock.patch.object(MockSession, 'query_shell_command',
+                                    return_value=['/bin/sh'])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.s = MockScript(config={'mock_target': 'test-target',
+                                    'mock_persistent_session': True},
+                            initial_config_file='test/test.json')
+
+    def tearDown(self):
+        self.s.stop_mock_session()
+        del(self.s)
+        cleanup()
+
+    def test_mock_session_output(self):
+        output = self.s.get_mock_output_from_command(
+            'test-target', ['printenv', 'FOO'], env={'FOO': 'bar'})
+        self.assertEqual(output, 'bar')
+        output = self.s.get_mock_output_from_command(
+            'test-target', 'pwd; echo err >&2',
+            cwd=os.path.abspath('test_dir'))
+        self.assertEqual(output, os.path.abspath('test_dir'))
+
+    def test_mock_session_reused(self):
+        # $$ is the session's shell, even in the subshell commands run in.
+        self.s.run_mock_command('test-target', 'echo $$ > test_dir/pid1; cd /')
+        self.s.run_mock_command('test-target', 'echo $$ > test_dir/pid2')
+        self.assertEqual(open('test_dir/pid1').read(),
+                         open('test_dir/pid2').read())
+
+    def test_mock_session_exit_code(self):
+        self.assertEqual(self.s.run_mock_command('test-target', 'exit 3'), 3)
+        self.assertEqual(self.s.run_mock_command('test-target', 'true'), 0)
+
+    def test_mock_session_restart(self):
+        self.assertEqual(self.s.run_mock_command('test-target', 'kill $$'),
+                         1)
+        self.assertEqual(self.s.get_mock_output_from_command(
+            'test-target', 'echo again'), 'again')
+
+    def test_mock_session_client_killed(self):
+        session = self.s.query_mock_session('test-target')
+        client = subprocess.Popen(session.query_client_command(
+            'echo started; sleep 30'), stdout=subprocess.PIPE)
+        # The newline is held back in case it starts the end marker.
+        self.assertEqual(client.stdout.read(7), 'started')
+        client.kill()
+        client.wait()
+        start = time.time()
+        self.assertEqual(self.s.get_mock_output_from_command(
+            'test-target', 'echo again'), 'again')
+        self.assertTrue(time.time() - start < 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
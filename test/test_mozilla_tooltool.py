@@ -0,0 +1,130 @@
+import BaseHTTPServer
+import gc
+import hashlib
+import json
+import os
+import threading
+import unittest
+
+import mozharness.base.log as log
+from mozharness.base.log import ERROR
+import mozharness.base.script as script
+from mozharness.mozilla.tooltool import TooltoolMixin
+
+FILES = {
+    'a.bin': 'a' * 100000,
+    'b.bin': ''.join([chr(i % 256) for i in range(50000)]),
+}
+
+
+class CleanupObj(script.ScriptMixin, log.LogMixin):
+    def __init__(self):
+        super(CleanupObj, self).__init__()
+        self.log_obj = None
+        self.config = {'log_level': ERROR}
+
+
+def cleanup():
+    gc.collect()
+    c = CleanupObj()
+    for f in ('test_logs', 'test_dir'):
+        c.rmtree(f)
+
+
+class TooltoolScript(TooltoolMixin, script.BaseScript):
+    def __init__(self, **kwargs):
+        super(TooltoolScript, self).__init__(**kwargs)
+
+
+class TooltoolHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve server.blobs by /sha512/<digest>, corrupted if
+    server.corrupt."""
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        body = self.server.blobs.get(self.path.split('/')[-1])
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.server.corrupt:
+            body = 'x' + body[1:]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# TestTooltoolFetch {{{1
+class TestTooltoolFetch(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        os.mkdir('test_dir')
+        blobs = dict([(hashlib.sha512(body).hexdigest(), body)
+                      for body in FILES.values()])
+        self.servers = []
+        for corrupt in (True, False):
+            server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                               TooltoolHandler)
+            server.blobs = blobs
+            server.corrupt = corrupt
+            server.requests = []
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.servers.append(server)
+        self.manifest = os.path.join('test_dir', 'test.tt')
+        self._write_manifest(FILES)
+        self.s = TooltoolScript(config={
+            'tooltool_servers': ['http://127.0.0.1:%d' % s.server_port
+                                 for s in self.servers],
+            'tooltool_cache_dir': 'test_dir/cache',
+            'global_retries': 1,
+        }, initial_config_file='test/test.json')
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        del(self.s)
+        cleanup()
+
+    def _write_manifest(self, files):
+        fh = open(self.manifest, 'w')
+        json.dump([{'filename': name, 'size': len(body),
+                    'algorithm': 'sha512',
+                    'digest': hashlib.sha512(body).hexdigest()}
+                   for name, body in files.items()], fh)
+        fh.close()
+
+    def test_fetch(self):
+        self.s.tooltool_fetch(self.manifest, output_dir='test_dir/out')
+        for name, body in FILES.items():
+            path = os.path.join('test_dir', 'out', name)
+            self.assertEqual(open(path, 'rb').read(), body)
+            # Linked from the cache.
+            self.assertEqual(os.stat(path).st_nlink, 2)
+        # The first server's copies were corrupt, so both were tried.
+        self.assertEqual(len(self.servers[0].requests), 2)
+        self.assertEqual(len(self.servers[1].requests), 2)
+
+    def test_fetch_cached(self):
+        self.s.tooltool_fetch(self.manifest, output_dir='test_dir/out')
+        self.s.tooltool_fetch(self.manifest, output_dir='test_dir/out2')
+        self.assertEqual(len(self.servers[1].requests), 2)
+        for name, body in FILES.items():
+            path = os.path.join('test_dir', 'out2', name)
+            self.assertEqual(open(path, 'rb').read(), body)
+
+    def test_fetch_missing(self):
+        self._write_manifest({'missing.bin': 'not on any server'})
+        self.assertRaises(SystemExit, self.s.tooltool_fetch, self.manifest,
+                          output_dir='test_dir/out')
+        self.assertFalse(os.path.exists(
+            os.path.join('test_dir', 'out', 'missing.bin')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,276 @@
+import gc
+import imp
+import mock
+import os
+import subprocess
+import threading
+import time
+import unittest
+
+import mozharness.base.log as log
+from mozharness.base.log import ERROR
+import mozharness.base.script as script
+
+MH_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+vcs_sync = imp.load_source(
+    'vcs_sync', os.path.join(MH_DIR, 'scripts', 'vcs-sync', 'vcs_sync.py'))
+HgGitScript = vcs_sync.HgGitScript
+
+GIT_ENV = dict(os.environ,
+               GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com',
+               GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@example.com')
+
+
+class CleanupObj(script.ScriptMixin, log.LogMixin):
+    def __init__(self):
+        super(CleanupObj, self).__init__()
+        self.log_obj = None
+        self.config = {'log_level': ERROR}
+
+
+def cleanup():
+    gc.collect()
+    c = CleanupObj()
+    for f in ('test_logs', 'test_dir'):
+        c.rmtree(f)
+
+
+def git(*args, **kwargs):
+    subprocess.check_call(['git'] + list(args), env=GIT_ENV,
+                          stdout=open(os.devnull, 'w'),
+                          stderr=subprocess.STDOUT, **kwargs)
+
+
+def query_git_revision(repo, ref):
+    return subprocess.check_output(['git', 'rev-parse', ref], cwd=repo).strip()
+
+
+class BranchScript(script.BaseScript):
+    """Just enough of HgGitScript to query branches."""
+    _query_refs = HgGitScript.__dict__['_query_refs']
+    _query_regex_matcher = HgGitScript.__dict__['_query_regex_matcher']
+    query_branches = HgGitScript.__dict__['query_branches']
+
+    def _query_hg_exe(self):
+        return ['hg']
+
+
+class RepoScript(script.BaseScript):
+    """Just enough of HgGitScript to loop over repos."""
+    _for_each_repo = HgGitScript.__dict__['_for_each_repo']
+
+    def query_all_repos(self):
+        return self.config['conversion_repos']
+
+    def query_abs_conversion_dir(self, repo_config):
+        return repo_config['conversion_dir']
+
+
+class PushScript(script.BaseScript):
+    """Just enough of HgGitScript to push refs."""
+    _push_refs = HgGitScript.__dict__['_push_refs']
+    _do_push_repo = HgGitScript.__dict__['_do_push_repo']
+    _query_changed_refs = HgGitScript.__dict__['_query_changed_refs']
+    _query_git_refs = HgGitScript.__dict__['_query_git_refs']
+
+
+# TestPushRefs {{{1
+class TestPushRefs(unittest.TestCase):
+    def setUp(self):
+        cleanup()
+        self.local = os.path.abspath(os.path.join('test_dir', 'local'))
+        self.remote = os.path.abspath(os.path.join('test_dir', 'remote.git'))
+        git('init', '-q', '-b', 'a', self.local)
+        git('commit', '-q', '--allow-empty', '-m', 'one', cwd=self.local)
+        git('branch', 'b', cwd=self.local)
+        git('init', '-q', '--bare', self.remote)
+        git('push', '-q', self.remote, 'a', 'b', cwd=self.local)
+        # Move both branches on locally; b's remote copy moves elsewhere,
+        # so pushing b is rejected.
+        git('commit', '-q', '--allow-empty', '-m', 'two', cwd=self.local)
+        git('branch', '-f', 'b', 'a', cwd=self.local)
+        git('push', '-q', self.remote, 'a~1:refs/heads/c', cwd=self.local)
+        other = os.path.join('test_dir', 'other')
+        git('clone', '-q', '-b', 'c', self.remote, other)
+        git('commit', '-q', '--allow-empty', '-m', 'other', cwd=other)
+        git('push', '-q', 'origin', 'c:b', cwd=other)
+        self.s = PushScript(config={'global_retries': 2},
+                            initial_config_file='test/test.json')
+
+    def tearDown(self):
+        del(self.s)
+        cleanup()
+
+    def test_push_refs_rejected(self):
+        refs = ['refs/heads/a:refs/heads/a', 'refs/heads/b:refs/heads/b']
+        self.assertEqual(self.s._push_refs(['git', 'push', self.remote], refs,
+                                           {'cwd': self.local}), -1)
+        # a still got pushed once b was split off.
+        self.assertEqual(query_git_revision(self.remote, 'a'),
+                         query_git_revision(self.local, 'a'))
+
+    def test_push_changed_refs_only(self):
+        # c is already on the remote as it is here.
+        git('branch', 'c', 'a~1', cwd=self.local)
+        refs = ['refs/heads/a:refs/heads/a', 'refs/heads/c:refs/heads/c']
+        command = ['git', 'push', self.remote]
+        with mock.patch.object(self.s, 'run_command',
+                               wraps=self.s.run_command) as run_command:
+            self.assertEqual(self.s._do_push_repo(command, refs,
+                                                  {'cwd': self.local},
+                                                  remote=self.remote), None)
+        self.assertEqual([c[0][0] for c in run_command.call_args_list],
+                         [command + refs[:1]])
+
+    def test_push_to_empty_remote(self):
+        # |git ls-remote| prints nothing for a new remote.
+        empty = os.path.abspath(os.path.join('test_dir', 'empty.git'))
+        git('init', '-q', '--bare', empty)
+        refs = ['refs/heads/a:refs/heads/a', 'refs/heads/b:refs/heads/b']
+        self.assertEqual(self.s._do_push_repo(['git', 'push', empty], refs,
+                                              {'cwd': self.local},
+                                              remote=empty), None)
+        for ref in ('a', 'b'):
+            self.assertEqual(query_git_revision(empty, ref),
+                             query_git_revision(self.local, ref))
+
+    @mock.patch('time.sleep')
+    def test_push_refs_unreachable(self, sleep):
+        refs = ['refs/heads/a:refs/heads/a', 'refs/heads/b:refs/heads/b']
+        command = ['git', 'push', os.path.join('test_dir', 'missing.git')]
+        with mock.patch.object(self.s, 'run_command',
+                               wraps=self.s.run_command) as run_command:
+            self.assertEqual(self.s._push_refs(command, refs,
+                                               {'cwd': self.local}), -1)
+        # Retried as a whole, rather than split into single ref pushes.
+        self.assertEqual([c[0][0] for c in run_command.call_args_list],
+                         [command + refs] * 2)
+
+
+# TestQueryBranches {{{1
+class TestQueryBranches(unittest.TestCase):
+    # |hg log -r head()|: rev, node, branch, extras, bookmarks.
+    BRANCH_HEADS = """0\t000000000000\tmerged\tbranch=merged\t
+2\t222222222222\tclosed\tbranch=closed close=1\t
+3\t333333333333\tdefault\tbranch=default\tbm
+"""
+    # |hg log -r heads(all())|: "merged" was merged into default, so
+    # its head, rev 0, is no longer a head of the repo.
+    REPO_HEADS = "2\n3\n"
+
+    def setUp(self):
+        cleanup()
+        self.s = BranchScript(initial_config_file='test/test.json')
+        self.s.ref_snapshots = {}
+
+    def tearDown(self):
+        del(self.s)
+        cleanup()
+
+    def _get_output(self, command, **kwargs):
+        if 'heads(all())' in command:
+            return self.REPO_HEADS
+        return self.BRANCH_HEADS
+
+    def test_query_branches_active_only(self):
+        with mock.patch.object(self.s, 'get_output_from_command',
+                               side_effect=self._get_output):
+            self.assertEqual(
+                self.s.query_branches({'branch_regexes': ['.*']}, 'repo'),
+                {'default': 'default'})
+            refs = self.s._query_refs('repo')
+        # Inactive branches still have revisions.
+        self.assertEqual(refs['branches'], {'merged': '000000000000',
+                                            'closed': '222222222222',
+                                            'default': '333333333333'})
+        self.assertEqual(refs['bookmarks'], {'bm': '333333333333'})
+
+
+# TestForEachRepo {{{1
+class TestForEachRepo(unittest.TestCase):
+    REPOS = [
+        {'repo_name': 'a', 'conversion_dir': 'x', 'sleep': 0.3},
+        {'repo_name': 'b', 'conversion_dir': 'x', 'sleep': 0.2},
+        {'repo_name': 'c', 'conversion_dir': 'y', 'sleep': 0.1},
+    ]
+
+    def setUp(self):
+        cleanup()
+        self.lock = threading.Lock()
+        self.started = []
+        self.running = set()
+        self.max_running = 0
+
+    def tearDown(self):
+        del(self.s)
+        cleanup()
+
+    def get_script(self, parallelism):
+        self.s = RepoScript(config={'conversion_repos': self.REPOS,
+                                    'repo_parallelism': parallelism},
+                            initial_config_file='test/test.json')
+        return self.s
+
+    def handle_repo(self, repo_config, suffix='!'):
+        name = repo_config['repo_name']
+        with self.lock:
+            self.started.append(name)
+            self.running.add(name)
+            self.max_running = max(self.max_running, len(self.running))
+        time.sleep(repo_config['sleep'])
+        with self.lock:
+            self.running.remove(name)
+        if name == getattr(self, 'fatal_repo', None):
+            self.s.fatal("%s broke" % name)
+        return name + suffix
+
+    def test_serial(self):
+        s = self.get_script(1)
+        results = s._for_each_repo(self.handle_repo, args=('?', ))
+        self.assertEqual([value for (repo_config, value) in results],
+                         ['a?', 'b?', 'c?'])
+        self.assertEqual(self.started, ['a', 'b', 'c'])
+        self.assertEqual(self.max_running, 1)
+
+    def test_parallel(self):
+        s = self.get_script(3)
+        results = s._for_each_repo(self.handle_repo)
+        # In repo order, however long each took.
+        self.assertEqual([value for (repo_config, value) in results],
+                         ['a!', 'b!', 'c!'])
+        self.assertEqual(self.max_running, 3)
+
+    def test_serialize_conversion_dirs(self):
+        s = self.get_script(3)
+        results = s._for_each_repo(self.handle_repo,
+                                   serialize_conversion_dirs=True)
+        self.assertEqual([value for (repo_config, value) in results],
+                         ['a!', 'b!', 'c!'])
+        # b waits for a, which shares its conversion dir, but not for c.
+        self.assertEqual(self.max_running, 2)
+        self.assertTrue(self.started.index('a') < self.started.index('b'))
+
+    def test_skips_failed_repos(self):
+        s = self.get_script(1)
+        s.add_failure('b')
+        results = s._for_each_repo(self.handle_repo)
+        self.assertEqual([value for (repo_config, value) in results],
+                         ['a!', 'c!'])
+
+    def test_serial_fatal(self):
+        s = self.get_script(1)
+        self.fatal_repo = 'a'
+        self.assertRaises(SystemExit, s._for_each_repo, self.handle_repo)
+        # Stopped at the first fatal().
+        self.assertEqual(self.started, ['a'])
+
+    def test_parallel_fatal(self):
+        s = self.get_script(2)
+        self.fatal_repo = 'c'
+        self.assertRaises(SystemExit, s._for_each_repo, self.handle_repo)
+        # The other repos still finished.
+        self.assertEqual(sorted(self.started), ['a', 'b', 'c'])
+
+
+if __name__ == '__main__':
+    unittest.main()